@@ -0,0 +1,195 @@
+"""Reorder thresholds and low-stock alerts, evaluated incrementally.
+
+A threshold is configured per (product, location). Its `is_low` flag mirrors
+`balance <= threshold` and is kept current from `balances_changed`: only the
+keys a write touched are looked up, inside the writer's transaction, and
+every flip of the flag appends a ``low`` or ``recovered`` event to the
+`stock_alerts` outbox in that same transaction. Consumers read the outbox in
+id order from `/api/alerts`.
+
+Ids are handed out at insert but become visible at commit, so a consumer
+could see id N+1 before a slower transaction commits N and then continue
+past N for good. `alerts_after` therefore only returns events older than
+``ALERTS_SETTLE_SECONDS`` (default 5) and stops at the first newer one;
+a writing transaction that stays open longer than that can still be
+skipped.
+
+Listing what is below its threshold is then a range on `ix_thresholds_low`
+instead of a scan of `product_balances`. After a full rebuild
+(`balances_rebuilt`) every threshold is re-evaluated.
+"""
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, insert, and_, tuple_
+from database import db
+from models import Product, Location, ProductBalance, ReorderThreshold, StockAlert
+from signals import balances_changed, balances_rebuilt
+
+EVAL_CHUNK = 500
+
+
+def _threshold_rows(*criteria):
+    return (
+        select(ReorderThreshold.id, ReorderThreshold.product_id, ReorderThreshold.location_id,
+               ReorderThreshold.threshold, ReorderThreshold.is_low, ProductBalance.balance)
+        .outerjoin(ProductBalance, and_(
+            ProductBalance.product_id == ReorderThreshold.product_id,
+            ProductBalance.location_id == ReorderThreshold.location_id,
+        ))
+        .where(*criteria)
+    )
+
+
+def _evaluate(rows):
+    """Flip `is_low` where it is stale and queue one alert per flip"""
+    now = datetime.utcnow()
+    events = []
+    for threshold_id, product_id, location_id, threshold, is_low, balance in rows:
+        balance = balance or 0
+        low = balance <= threshold
+        if low == is_low:
+            continue
+        # conditional, so two writers racing on the same key emit one event
+        flipped = db.session.execute(
+            update(ReorderThreshold)
+            .where(ReorderThreshold.id == threshold_id, ReorderThreshold.is_low == is_low)
+            .values(is_low=low, updated_at=now)
+        ).rowcount
+        if flipped:
+            events.append({
+                'kind': 'low' if low else 'recovered',
+                'product_id': product_id,
+                'location_id': location_id,
+                'balance': balance,
+                'threshold': threshold,
+                'created_at': now,
+            })
+    if events:
+        db.session.execute(insert(StockAlert), events)
+    return len(events)
+
+
+def evaluate_keys(keys):
+    """Re-evaluate the thresholds of the given (product_id, location_id) keys"""
+    keys = list(keys)
+    emitted = 0
+    with db.session.no_autoflush:
+        for start in range(0, len(keys), EVAL_CHUNK):
+            chunk = keys[start:start + EVAL_CHUNK]
+            rows = db.session.execute(_threshold_rows(
+                tuple_(ReorderThreshold.product_id, ReorderThreshold.location_id).in_(chunk)
+            )).all()
+            emitted += _evaluate(rows)
+    return emitted
+
+
+def evaluate_all(chunk_size=EVAL_CHUNK):
+    """Re-evaluate every threshold, committing after each chunk"""
+    emitted = 0
+    last = 0
+    while True:
+        rows = db.session.execute(
+            _threshold_rows(ReorderThreshold.id > last).order_by(ReorderThreshold.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            return emitted
+        emitted += _evaluate(rows)
+        db.session.commit()
+        last = rows[-1][0]
+
+
+def set_threshold(product_id, location_id, threshold):
+    """Create or change a threshold and evaluate it at once; caller commits"""
+    row = db.session.execute(
+        select(ReorderThreshold).where(
+            ReorderThreshold.product_id == product_id, ReorderThreshold.location_id == location_id)
+    ).scalar()
+    if row is None:
+        row = ReorderThreshold(product_id=product_id, location_id=location_id, is_low=False)
+        db.session.add(row)
+    row.threshold = threshold
+    row.updated_at = datetime.utcnow()
+    db.session.flush()
+    evaluate_keys([(product_id, location_id)])
+    db.session.refresh(row)
+    return row
+
+
+def remove_threshold(product_id, location_id):
+    row = db.session.execute(
+        select(ReorderThreshold).where(
+            ReorderThreshold.product_id == product_id, ReorderThreshold.location_id == location_id)
+    ).scalar()
+    if row is None:
+        return False
+    db.session.delete(row)
+    return True
+
+
+def thresholds_query(below=False):
+    """Thresholds with current balances and names; `below` keeps only low ones.
+
+    With `below` the filter and ordering are served by `ix_thresholds_low`.
+    """
+    query = (
+        select(
+            ReorderThreshold.product_id,
+            Product.name.label('product_name'),
+            ReorderThreshold.location_id,
+            Location.name.label('location_name'),
+            ReorderThreshold.threshold,
+            ReorderThreshold.is_low,
+            ProductBalance.balance,
+            ReorderThreshold.updated_at,
+        )
+        .join(Product, Product.product_id == ReorderThreshold.product_id)
+        .join(Location, Location.location_id == ReorderThreshold.location_id)
+        .outerjoin(ProductBalance, and_(
+            ProductBalance.product_id == ReorderThreshold.product_id,
+            ProductBalance.location_id == ReorderThreshold.location_id,
+        ))
+        .order_by(ReorderThreshold.is_low, ReorderThreshold.product_id, ReorderThreshold.location_id)
+    )
+    if below:
+        query = query.where(ReorderThreshold.is_low.is_(True))
+    return query
+
+
+def alerts_after(after=0, limit=100, kind=None, settle=None):
+    """Outbox events with id > `after`, oldest first, up to the first one
+    written less than `settle` seconds ago"""
+    if settle is None:
+        settle = current_app.config.get('ALERTS_SETTLE_SECONDS', 5)
+    cutoff = datetime.utcnow() - timedelta(seconds=settle)
+    query = select(StockAlert).where(StockAlert.id > after).order_by(StockAlert.id).limit(limit)
+    if kind:
+        query = query.where(StockAlert.kind == kind)
+    settled = []
+    for alert in db.session.execute(query).scalars():
+        if alert.created_at > cutoff:
+            break
+        settled.append(alert)
+    return settled
+
+
+def _enabled():
+    return current_app.config.get('ALERTS_ENABLED', False)
+
+
+def _on_balances_changed(sender, keys=None, changes=None):
+    # keys=None is a rebuild in progress; it is handled once it commits
+    if keys and _enabled():
+        evaluate_keys(keys)
+
+
+def _on_balances_rebuilt(sender):
+    if _enabled():
+        evaluate_all()
+
+
+def init_alerts(app):
+    app.config.setdefault('ALERTS_ENABLED', True)
+    app.config.setdefault('ALERTS_SETTLE_SECONDS', 5)
+    # receivers are process-wide and check the current app's flag; connecting again is a no-op
+    balances_changed.connect(_on_balances_changed, weak=False)
+    balances_rebuilt.connect(_on_balances_rebuilt, weak=False)
@@ -0,0 +1,460 @@
+"""In-process balance matrix for availability, top-N and aggregate queries.
+
+With ``BALANCE_INDEX_ENABLED`` (requires NumPy) each process keeps every
+non-zero row of `product_balances` in a dense int32 matrix: product and
+location ids are interned to row and column numbers, and per-product and
+per-location totals are maintained next to it. "Which locations hold 50
+of X (and 10 of Y)", "top products at L" and "total stock across these
+locations" become a few vector operations over one row or column instead
+of a scan of ORM objects.
+
+Freshness:
+
+* changes made in this process arrive through `balances_changed` and are
+  applied when their transaction commits (dropped on rollback); a rebuild
+  (``keys=None``) reloads the matrix after it commits;
+* writes by other processes are caught up every ``BALANCE_INDEX_REFRESH``
+  seconds by re-reading rows whose `last_updated` is newer than the last
+  catch-up (minus `CATCH_UP_OVERLAP`), and the whole matrix is reloaded
+  every ``BALANCE_INDEX_RELOAD`` seconds, which also drops deleted rows.
+
+`availability`, `top` and `totals` answer from the index when it is
+enabled and from `product_balances` otherwise, with the same results.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import event, select, func, and_, or_
+from sqlalchemy.orm import Session
+from database import db
+from models import ProductBalance
+from signals import balances_changed, balances_rebuilt
+
+logger = logging.getLogger(__name__)
+
+MAX_CELLS = 50_000_000
+CATCH_UP_OVERLAP = timedelta(seconds=2)
+_PENDING_KEY = 'balance_index_changes'
+_RELOAD = object()
+
+
+class IndexTooLarge(RuntimeError):
+    """The product x location matrix would exceed ``BALANCE_INDEX_MAX_CELLS``"""
+
+
+def _top(np, values, order, limit):
+    """Positions in `order` of the `limit` largest positive values, ties in `order`"""
+    ranked = values[order]
+    picked = np.flatnonzero(ranked > 0)
+    if picked.size > limit:
+        # everything at least as large as the limit-th largest value, then sort only those
+        cut = np.partition(ranked[picked], picked.size - limit)[picked.size - limit]
+        picked = picked[ranked[picked] >= cut]
+    return picked[np.argsort(-ranked[picked], kind='stable')][:limit], ranked
+
+
+class BalanceIndex:
+    """Dense product x location matrix of balances with interned ids"""
+
+    def __init__(self, max_cells=MAX_CELLS):
+        import numpy
+        self.np = numpy
+        self.max_cells = max_cells
+        self._lock = threading.Lock()
+        self._build([], [], [], [], [])
+
+    def _build(self, product_ids, location_ids, rows, cols, balances):
+        np = self.np
+        shape = (max(len(product_ids) * 5 // 4, 16), max(len(location_ids) * 5 // 4, 16))
+        if shape[0] * shape[1] > self.max_cells:
+            raise IndexTooLarge(f"{len(product_ids)} products x {len(location_ids)} locations")
+        matrix = np.zeros(shape, dtype=np.int32)
+        matrix[rows, cols] = balances
+        state = {
+            'product_ids': list(product_ids),
+            'location_ids': list(location_ids),
+            'product_rows': {product_id: row for row, product_id in enumerate(product_ids)},
+            'location_cols': {location_id: col for col, location_id in enumerate(location_ids)},
+            'matrix': matrix,
+            'product_totals': matrix.sum(axis=1, dtype=np.int64),
+            'location_totals': matrix.sum(axis=0, dtype=np.int64),
+            '_product_order': None,
+            '_location_order': None,
+        }
+        with self._lock:
+            self.__dict__.update(state)
+
+    def load(self, triples):
+        """Replace the contents with (product_id, location_id, balance) rows"""
+        np = self.np
+        triples = list(triples)
+        product_ids = sorted({product_id for product_id, _, _ in triples})
+        location_ids = sorted({location_id for _, location_id, _ in triples})
+        product_rows = {product_id: row for row, product_id in enumerate(product_ids)}
+        location_cols = {location_id: col for col, location_id in enumerate(location_ids)}
+        rows = np.fromiter((product_rows[p] for p, _, _ in triples), dtype=np.intp, count=len(triples))
+        cols = np.fromiter((location_cols[l] for _, l, _ in triples), dtype=np.intp, count=len(triples))
+        balances = np.fromiter((b for _, _, b in triples), dtype=np.int32, count=len(triples))
+        self._build(product_ids, location_ids, rows, cols, balances)
+
+    def _grow(self, rows, cols):
+        np = self.np
+        if rows * cols > self.max_cells:
+            raise IndexTooLarge(f"{rows} x {cols} cells")
+        old_rows, old_cols = self.matrix.shape
+        matrix = np.zeros((rows, cols), dtype=np.int32)
+        matrix[:old_rows, :old_cols] = self.matrix
+        self.matrix = matrix
+        self.product_totals = np.concatenate([self.product_totals, np.zeros(rows - old_rows, dtype=np.int64)])
+        self.location_totals = np.concatenate([self.location_totals, np.zeros(cols - old_cols, dtype=np.int64)])
+
+    def _cell(self, product_id, location_id):
+        """(row, col) of a key, interning new ids; call with the lock held"""
+        row = self.product_rows.get(product_id)
+        if row is None:
+            row = self.product_rows[product_id] = len(self.product_ids)
+            self.product_ids.append(product_id)
+            self._product_order = None
+        col = self.location_cols.get(location_id)
+        if col is None:
+            col = self.location_cols[location_id] = len(self.location_ids)
+            self.location_ids.append(location_id)
+            self._location_order = None
+        rows, cols = self.matrix.shape
+        if row >= rows or col >= cols:
+            self._grow(max(rows, row * 3 // 2 + 1), max(cols, col * 3 // 2 + 1))
+        return row, col
+
+    def apply(self, changes):
+        """Add {(product_id, location_id): change} deltas"""
+        with self._lock:
+            for (product_id, location_id), change in changes.items():
+                row, col = self._cell(product_id, location_id)
+                self.matrix[row, col] += change
+                self.product_totals[row] += change
+                self.location_totals[col] += change
+
+    def assign(self, triples):
+        """Overwrite balances with (product_id, location_id, balance) rows read from the table"""
+        with self._lock:
+            for product_id, location_id, balance in triples:
+                row, col = self._cell(product_id, location_id)
+                change = balance - int(self.matrix[row, col])
+                self.matrix[row, col] = balance
+                self.product_totals[row] += change
+                self.location_totals[col] += change
+
+    def _order(self, name, ids):
+        """Row or column numbers sorted by id, so ties rank like ORDER BY ..., id"""
+        order = getattr(self, name)
+        if order is None:
+            order = self.np.array(sorted(range(len(ids)), key=ids.__getitem__), dtype=self.np.intp)
+            setattr(self, name, order)
+        return order
+
+    def availability(self, items, locations=None, limit=100):
+        """Locations holding at least `qty` of every (product_id, qty) in `items`
+        (one entry per product).
+
+        Returns (total per item over the locations considered, [(location_id,
+        [balance per item]), ...] best first, number of matching locations).
+        Locations are ranked by the first item's balance, then id.
+        """
+        np = self.np
+        with self._lock:
+            if locations is None:
+                cols = self._order('_location_order', self.location_ids)
+            else:
+                cols = np.array([self.location_cols[l] for l in sorted(set(locations)) if l in self.location_cols],
+                                dtype=np.intp)
+            values = np.zeros((len(items), cols.size), dtype=np.int64)
+            for i, (product_id, _) in enumerate(items):
+                row = self.product_rows.get(product_id)
+                if row is not None:
+                    values[i] = self.matrix[row, cols]
+            wanted = np.array([qty for _, qty in items], dtype=np.int64)
+            matched = np.flatnonzero((values >= wanted[:, None]).all(axis=0))
+            best = matched[np.argsort(-values[0, matched], kind='stable')][:limit]
+            return (
+                values.sum(axis=1).tolist(),
+                [(self.location_ids[cols[j]], values[:, j].tolist()) for j in best],
+                int(matched.size),
+            )
+
+    def top_products(self, location_id=None, limit=20):
+        """Products with the most stock at `location_id`, or in total"""
+        with self._lock:
+            count = len(self.product_ids)
+            if location_id is None:
+                values = self.product_totals[:count]
+            elif location_id in self.location_cols:
+                values = self.matrix[:count, self.location_cols[location_id]]
+            else:
+                return []
+            order = self._order('_product_order', self.product_ids)
+            picked, ranked = _top(self.np, values, order, limit)
+            return [(self.product_ids[order[i]], int(ranked[i])) for i in picked]
+
+    def top_locations(self, product_id=None, limit=20):
+        """Locations with the most stock of `product_id`, or in total"""
+        with self._lock:
+            count = len(self.location_ids)
+            if product_id is None:
+                values = self.location_totals[:count]
+            elif product_id in self.product_rows:
+                values = self.matrix[self.product_rows[product_id], :count]
+            else:
+                return []
+            order = self._order('_location_order', self.location_ids)
+            picked, ranked = _top(self.np, values, order, limit)
+            return [(self.location_ids[order[i]], int(ranked[i])) for i in picked]
+
+    def totals(self, by, ids=None):
+        """{id: summed balance} per product or per location, for `ids` or every id with a balance"""
+        with self._lock:
+            if by == 'product':
+                index, totals, known = self.product_rows, self.product_totals, self.product_ids
+            else:
+                index, totals, known = self.location_cols, self.location_totals, self.location_ids
+            if ids is None:
+                return {key: int(totals[index[key]]) for key in sorted(known) if totals[index[key]]}
+            return {key: int(totals[index[key]]) if key in index else 0 for key in ids}
+
+    def stats(self):
+        with self._lock:
+            arrays = (self.matrix, self.product_totals, self.location_totals)
+            ids = (self.product_ids, self.location_ids, self.product_rows, self.location_cols)
+            id_bytes = sum(sys.getsizeof(container) for container in ids)
+            id_bytes += sum(sys.getsizeof(key) for key in self.product_ids + self.location_ids)
+            return {
+                'products': len(self.product_ids),
+                'locations': len(self.location_ids),
+                'cells': int(self.matrix.size),
+                'array_bytes': sum(array.nbytes for array in arrays),
+                'id_bytes': id_bytes,
+            }
+
+
+class BalanceIndexService:
+    """A process's `BalanceIndex` plus its loading and catch-up schedule"""
+
+    def __init__(self, app):
+        self.index = BalanceIndex(app.config['BALANCE_INDEX_MAX_CELLS'])
+        self.refresh = app.config['BALANCE_INDEX_REFRESH']
+        self.reload_every = app.config['BALANCE_INDEX_RELOAD']
+        self.loaded_at = None
+        self.synced_at = None
+        self._mark = None
+        self._stale = True
+        self._sync_lock = threading.Lock()
+        self.disabled = None
+
+    def mark_stale(self):
+        self._stale = True
+
+    def reload(self):
+        started = datetime.utcnow()
+        rows = db.session.execute(
+            select(ProductBalance.product_id, ProductBalance.location_id, ProductBalance.balance)
+            .where(ProductBalance.balance != 0)
+        ).all()
+        self._stale = False
+        self.index.load(rows)
+        self._mark = started
+        self.loaded_at = self.synced_at = time.monotonic()
+        logger.info("Balance index loaded: %d balances", len(rows))
+
+    def catch_up(self):
+        started = datetime.utcnow()
+        rows = db.session.execute(
+            select(ProductBalance.product_id, ProductBalance.location_id, ProductBalance.balance)
+            .where(ProductBalance.last_updated >= self._mark - CATCH_UP_OVERLAP)
+        ).all()
+        self.index.assign(rows)
+        self._mark = started
+        self.synced_at = time.monotonic()
+
+    def fresh(self):
+        """The index, loaded or caught up as the schedule requires; None if it could not be built"""
+        if self.disabled:
+            return None
+        now = time.monotonic()
+        if self._stale or now - self.loaded_at >= self.reload_every or now - self.synced_at >= self.refresh:
+            with self._sync_lock:
+                now = time.monotonic()
+                try:
+                    if self._stale or now - self.loaded_at >= self.reload_every:
+                        self.reload()
+                    elif now - self.synced_at >= self.refresh:
+                        self.catch_up()
+                except IndexTooLarge as exc:
+                    self.disable(exc)
+                    return None
+        return self.index
+
+    def disable(self, reason):
+        logger.warning("Balance index disabled, answering from the database: %s", reason)
+        self.disabled = str(reason)
+
+    def stats(self):
+        now = time.monotonic()
+        stats = {'enabled': True, 'disabled': self.disabled,
+                 'loaded_seconds_ago': round(now - self.loaded_at, 3) if self.loaded_at else None,
+                 'synced_seconds_ago': round(now - self.synced_at, 3) if self.synced_at else None}
+        stats.update(self.index.stats())
+        return stats
+
+
+def _service():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('balance_index')
+
+
+def _on_balances_changed(sender, keys=None, changes=None):
+    if _service() is None:
+        return
+    pending = db.session.info.setdefault(_PENDING_KEY, [])
+    pending.append(_RELOAD if keys is None or changes is None else dict(changes))
+
+
+def _on_balances_rebuilt(sender):
+    service = _service()
+    if service is not None:
+        service.mark_stale()
+
+
+def _after_commit(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    service = _service()
+    if not pending or service is None:
+        return
+    if any(changes is _RELOAD for changes in pending):
+        service.mark_stale()
+        return
+    merged = {}
+    for changes in pending:
+        for key, change in changes.items():
+            merged[key] = merged.get(key, 0) + change
+    try:
+        service.index.apply(merged)
+    except IndexTooLarge as exc:
+        service.disable(exc)
+
+
+def _after_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+
+
+def init_balance_index(app):
+    app.config.setdefault('BALANCE_INDEX_ENABLED',
+                          os.environ.get('BALANCE_INDEX_ENABLED', '').lower() in ('1', 'true', 'yes'))
+    app.config.setdefault('BALANCE_INDEX_REFRESH', 5)
+    app.config.setdefault('BALANCE_INDEX_RELOAD', 300)
+    app.config.setdefault('BALANCE_INDEX_MAX_CELLS', MAX_CELLS)
+    if not app.config['BALANCE_INDEX_ENABLED']:
+        return
+    try:
+        app.extensions['balance_index'] = BalanceIndexService(app)
+    except ImportError as exc:
+        raise RuntimeError("BALANCE_INDEX_ENABLED needs NumPy (pip install numpy)") from exc
+    # receivers are process-wide and do nothing for an app without a service
+    balances_changed.connect(_on_balances_changed, weak=False)
+    balances_rebuilt.connect(_on_balances_rebuilt, weak=False)
+    if not event.contains(Session, 'after_commit', _after_commit):
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_soft_rollback', _after_rollback)
+
+
+def current_index():
+    """This process's fresh `BalanceIndex`, or None to answer from the database"""
+    service = _service()
+    return service.fresh() if service is not None else None
+
+
+def availability(items, locations=None, limit=100):
+    """See `BalanceIndex.availability`; answered from the table when there is no index"""
+    index = current_index()
+    if index is not None:
+        return index.availability(items, locations, limit) + ('index',)
+
+    product_ids = [product_id for product_id, _ in items]
+    region = [ProductBalance.location_id.in_(sorted(set(locations)))] if locations is not None else []
+    held = dict(db.session.execute(
+        select(ProductBalance.product_id, func.sum(ProductBalance.balance))
+        .where(ProductBalance.product_id.in_(product_ids), *region)
+        .group_by(ProductBalance.product_id)
+    ).all())
+    totals = [int(held.get(product_id) or 0) for product_id in product_ids]
+
+    enough = or_(*[and_(ProductBalance.product_id == product_id, ProductBalance.balance >= qty)
+                   for product_id, qty in items])
+    fulfilling = (
+        select(ProductBalance.location_id).where(enough, *region)
+        .group_by(ProductBalance.location_id)
+        .having(func.count() == len(items))
+    )
+    first = items[0][0]
+    ranked = (
+        select(ProductBalance.location_id)
+        .where(ProductBalance.product_id == first, ProductBalance.location_id.in_(fulfilling))
+        .order_by(ProductBalance.balance.desc(), ProductBalance.location_id)
+    )
+    matching = db.session.execute(select(func.count()).select_from(fulfilling.subquery())).scalar()
+    best = db.session.execute(ranked.limit(limit)).scalars().all()
+    balances = {}
+    if best:
+        balances = {
+            (product_id, location_id): balance
+            for product_id, location_id, balance in db.session.execute(
+                select(ProductBalance.product_id, ProductBalance.location_id, ProductBalance.balance)
+                .where(ProductBalance.product_id.in_(product_ids), ProductBalance.location_id.in_(best))
+            )
+        }
+    return (
+        totals,
+        [(location_id, [balances.get((product_id, location_id), 0) for product_id in product_ids])
+         for location_id in best],
+        matching,
+        'database',
+    )
+
+
+def top(by, within=None, limit=20):
+    """Top `limit` products (`by='product'`, optionally at location `within`) or
+    locations (`by='location'`, optionally of product `within`) by stock"""
+    index = current_index()
+    if index is not None:
+        if by == 'product':
+            return index.top_products(within, limit), 'index'
+        return index.top_locations(within, limit), 'index'
+
+    key = ProductBalance.product_id if by == 'product' else ProductBalance.location_id
+    other = ProductBalance.location_id if by == 'product' else ProductBalance.product_id
+    if within is not None:
+        query = (select(key, ProductBalance.balance).where(other == within, ProductBalance.balance > 0)
+                 .order_by(ProductBalance.balance.desc(), key))
+    else:
+        total = func.sum(ProductBalance.balance)
+        query = select(key, total).group_by(key).having(total > 0).order_by(total.desc(), key)
+    return [(row[0], int(row[1])) for row in db.session.execute(query.limit(limit))], 'database'
+
+
+def totals(by, ids=None):
+    """{id: summed balance} per product or location (`by`), for `ids` or every id with a balance"""
+    index = current_index()
+    if index is not None:
+        return index.totals(by, ids), 'index'
+
+    key = ProductBalance.product_id if by == 'product' else ProductBalance.location_id
+    total = func.sum(ProductBalance.balance)
+    query = select(key, total).group_by(key).order_by(key)
+    if ids is not None:
+        held = dict(db.session.execute(query.where(key.in_(ids))).all())
+        return {value: int(held.get(value) or 0) for value in ids}, 'database'
+    return {value: int(amount) for value, amount in db.session.execute(query.having(total != 0))}, 'database'
@@ -0,0 +1,180 @@
+"""Concurrent read load: the sync Flask API vs the async ASGI read API.
+
+`clients` concurrent clients each send the same mix of requests: balance
+lookups concentrated on a few hot (product, location) keys, product
+lookups and a page of a product's movement history. The Flask app serves
+them from a pool of `workers` threads, as one gunicorn worker with
+``--threads`` would; the ASGI app serves them from one event loop, with
+and without coalescing of identical balance lookups.
+
+`latency-ms` adds that much delay to every SQL statement, inside the
+database driver's own thread, to stand in for a remote database: the
+sync worker thread blocks on it, the event loop does not. The Flask
+read-through cache is disabled so both sides query the database; note
+that the Flask balance view reads product, location and balance with
+three statements where the ASGI one uses a single query. Reports
+throughput, latency percentiles and how many balance queries reached the
+database.
+
+Usage: python bench_async.py [clients] [requests-per-client] [workers] [latency-ms]
+"""
+import asyncio
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+from bench_utils import create_bench_app, seed
+
+
+def workload(product_ids, location_ids, count, rng_seed):
+    rng = random.Random(rng_seed)
+    hot = [(product_ids[i], location_ids[i % len(location_ids)]) for i in range(5)]
+    urls = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.6:
+            product_id, location_id = rng.choice(hot)
+            urls.append(f'/api/balance/{product_id}/{location_id}')
+        elif roll < 0.7:
+            urls.append(f'/api/balance/{rng.choice(product_ids)}/{rng.choice(location_ids)}')
+        elif roll < 0.85:
+            urls.append(f'/api/products/{rng.choice(product_ids)}')
+        else:
+            urls.append(f'/api/movements?product_id={rng.choice(product_ids)}&limit=50')
+    return urls
+
+
+def add_latency(engine, latency, counts):
+    """Delay every statement in the driver thread and count balance queries"""
+    if latency:
+        @event.listens_for(engine, 'connect')
+        def slow(dbapi_connection, record):
+            raw = getattr(dbapi_connection, 'driver_connection', dbapi_connection)
+            raw = getattr(raw, '_conn', raw)  # aiosqlite wraps the sqlite3 connection
+            raw.set_trace_callback(lambda statement: time.sleep(latency))
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if 'product_balances' in statement:
+            counts['balance_queries'] += 1
+
+
+def summarize(name, samples, elapsed, counts):
+    samples.sort()
+    pick = lambda q: samples[min(int(len(samples) * q), len(samples) - 1)] * 1000
+    print(f"{name:<22} {len(samples) / elapsed:8.0f} req/s  p50={pick(0.5):7.1f}ms  p95={pick(0.95):7.1f}ms  "
+          f"p99={pick(0.99):7.1f}ms  balance_queries={counts['balance_queries']}")
+
+
+def run_sync(app, clients, per_client, workers, urls):
+    server = ThreadPoolExecutor(max_workers=workers)
+    local = threading.local()
+
+    def handle(url):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        response = local.client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+
+    samples = []
+    lock = threading.Lock()
+
+    def client(index):
+        mine = []
+        for url in urls[index * per_client:(index + 1) * per_client]:
+            started = time.perf_counter()
+            server.submit(handle, url).result()
+            mine.append(time.perf_counter() - started)
+        with lock:
+            samples.extend(mine)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    return samples, elapsed
+
+
+async def asgi_get(api, url):
+    """Send one GET through the ASGI interface; returns (status, body)"""
+    path, _, query = url.partition('?')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode('latin-1'),
+             'headers': []}
+    status, body = None, []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        else:
+            body.append(message.get('body', b''))
+
+    await api(scope, receive, send)
+    return status, b''.join(body)
+
+
+async def run_async(api, clients, per_client, urls):
+    samples = []
+
+    async def client(index):
+        for url in urls[index * per_client:(index + 1) * per_client]:
+            started = time.perf_counter()
+            status, body = await asgi_get(api, url)
+            assert status == 200, (url, status, body)
+            samples.append(time.perf_counter() - started)
+
+    await asgi_get(api, '/api/products')  # open the pool before timing
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    elapsed = time.perf_counter() - started
+    await api.dispose()
+    return samples, elapsed
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    latency = (float(sys.argv[4]) if len(sys.argv) > 4 else 5) / 1000
+
+    app = create_bench_app()
+    from database import db
+    from cache import cache
+    from asgi import ReadAPI
+    with app.app_context():
+        from rebuild import rebuild_balances
+        product_ids, location_ids = seed(products=500, locations=20, movements=20000)
+        rebuild_balances()
+        sync_engine = db.engine
+    app.config['CACHE_BACKEND'] = 'null'
+    cache.init_app(app)
+    urls = workload(product_ids, location_ids, clients * per_client, rng_seed=7)
+    print(f"{clients} clients x {per_client} requests, {workers} sync worker threads, "
+          f"{latency * 1000:.0f}ms per statement")
+
+    counts = {'balance_queries': 0}
+    add_latency(sync_engine, latency, counts)
+    sync_engine.dispose()
+    samples, elapsed = run_sync(app, clients, per_client, workers, urls)
+    summarize(f'flask ({workers} threads)', samples, elapsed, counts)
+
+    for coalesce in (False, True):
+        api = ReadAPI(app.config['SQLALCHEMY_DATABASE_URI'], coalesce=coalesce,
+                      engine_options={'pool_size': workers, 'max_overflow': 0})
+        counts = {'balance_queries': 0}
+        add_latency(api.engine.sync_engine, latency, counts)
+        samples, elapsed = asyncio.run(run_async(api, clients, per_client, urls))
+        summarize('asgi' + (' + coalescing' if coalesce else ''), samples, elapsed, counts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Balance index: memory footprint and query latency against the database.
+
+Fills `product_balances` with `products` x `locations` rows (`density` of
+the cells non-zero), then reports:
+
+* memory -- bytes held by every balance loaded as ORM objects (what a
+  Python-side scan would keep), against the balance index's NumPy arrays
+  plus its interned ids, both measured with tracemalloc;
+* latency -- microseconds per availability (one product, three products,
+  a 20-location region), top-N and per-location totals query, answered by
+  the index and by the equivalent SQL on the same data.
+
+Usage: python bench_balance_index.py [products] [locations] [density]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+
+def measure(build):
+    """(result, bytes still allocated by it) for `build()`"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, held
+
+
+def per_call(fn, seconds=0.5):
+    calls, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        fn()
+        calls += 1
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def main():
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    locations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    density = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+
+    os.environ['BALANCE_INDEX_ENABLED'] = '1'
+    from bench_utils import create_bench_app, seed
+    app = create_bench_app()
+    from datetime import datetime
+    from flask import current_app
+    from sqlalchemy import insert
+    from database import db
+    from models import ProductBalance
+    import balance_index
+
+    rng = random.Random(42)
+    with app.app_context():
+        product_ids, location_ids = seed(products=products, locations=locations, movements=0)
+        now = datetime.utcnow()
+        rows = [
+            {'product_id': product_id, 'location_id': location_id, 'balance': rng.randint(1, 500), 'last_updated': now}
+            for product_id in product_ids for location_id in location_ids if rng.random() < density
+        ]
+        for start in range(0, len(rows), 20000):
+            db.session.execute(insert(ProductBalance), rows[start:start + 20000])
+        db.session.commit()
+        print(f"{len(rows)} balances: {products} products x {locations} locations, density {density}")
+
+        orm, orm_bytes = measure(lambda: ProductBalance.query.all())
+        db.session.expunge_all()
+        del orm
+        service = current_app.extensions['balance_index']
+        _, index_bytes = measure(service.reload)
+        stats = service.index.stats()
+        print(f"memory  ORM objects {orm_bytes / 2**20:8.1f} MiB   index {index_bytes / 2**20:6.1f} MiB "
+              f"(arrays {stats['array_bytes'] / 2**20:.1f} MiB, {stats['cells']} cells)   "
+              f"{orm_bytes / max(index_bytes, 1):.0f}x smaller")
+
+        region = rng.sample(location_ids, 20)
+        queries = [
+            ('availability 1 product', lambda: balance_index.availability([(product_ids[7], 100)])),
+            ('availability 3 products', lambda: balance_index.availability(
+                [(product_ids[7], 100), (product_ids[8], 50), (product_ids[9], 10)])),
+            ('availability in region', lambda: balance_index.availability([(product_ids[7], 100)], region)),
+            ('top 20 at location', lambda: balance_index.top('product', location_ids[3], 20)),
+            ('top 20 locations overall', lambda: balance_index.top('location', None, 20)),
+            ('totals for 20 locations', lambda: balance_index.totals('location', region)),
+        ]
+        print(f"{'query':<26} {'index us':>10} {'database us':>12}")
+        for name, query in queries:
+            assert query()[-1] == 'index'
+            indexed = per_call(query)
+            current_app.extensions.pop('balance_index')
+            try:
+                assert query()[-1] == 'database'
+                database = per_call(query)
+            finally:
+                current_app.extensions['balance_index'] = service
+            print(f"{name:<26} {indexed:10.1f} {database:12.1f}   {database / indexed:6.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Request latency with and without the read-through cache.
+
+Runs the cached endpoints and the movement form through Flask's test client
+once per cache backend and prints mean/p95 latency plus hit ratios.
+
+Usage: python bench_cache.py [requests-per-endpoint] [products] [locations]
+"""
+import statistics
+import sys
+import time
+from bench_utils import create_bench_app, seed
+
+
+def measure(client, url, requests):
+    samples = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = client.get(url)
+        samples.append(time.perf_counter() - started)
+        assert response.status_code == 200, (url, response.status_code)
+    samples.sort()
+    return statistics.mean(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    products = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    locations = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    app = create_bench_app()
+    with app.app_context():
+        from rebuild import rebuild_balances
+        product_ids, location_ids = seed(products=products, locations=locations, movements=20000)
+        rebuild_balances()
+
+    from cache import cache
+    urls = [
+        '/api/products',
+        '/api/locations',
+        f'/api/balance/{product_ids[0]}/{location_ids[0]}',
+        '/movements/add',
+    ]
+    client = app.test_client()
+
+    for backend in ('null', 'lru', 'shared'):
+        app.config['CACHE_BACKEND'] = backend
+        cache.init_app(app)
+        with app.app_context():
+            cache.clear()
+            cache.reset_stats()
+        print(f"\n[{backend}]")
+        for url in urls:
+            mean, p95 = measure(client, url, requests)
+            print(f"  {url:45s} mean={mean * 1000:7.2f}ms  p95={p95 * 1000:7.2f}ms")
+        with app.app_context():
+            stats = cache.stats()
+        print(f"  hits={stats['hits']} misses={stats['misses']} hit_ratio={stats['hit_ratio']:.2%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Peak intake: a commit per movement vs the write-ahead queue with group commit.
+
+`clients` concurrent scanners each post `per-client` single movements,
+two ways:
+
+* direct -- POST /api/movements/bulk with one row: validated, inserted and
+  committed before the response, one database commit per movement;
+* intake -- POST /api/intake/movements: appended to the local WAL queue and
+  acknowledged; the committer thread commits them in groups.
+
+`commit-ms` delays every database COMMIT by that much, inside the
+transaction, to stand in for the fsync and replication latency of a
+production MySQL server (the local queue's own fsync is real). Reports
+acknowledged movements/s, acknowledgement latency percentiles, the time
+until every movement is committed, and how many database commits that
+took, and requests that failed (on SQLite, per-movement commits from many
+writers run into its busy timeout). Balances are checked against the
+movements afterwards.
+
+Usage: python bench_intake.py [clients] [per-client] [commit-ms]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import event
+
+
+def run(app, clients, per_client, url, prefix, product_ids, source, target):
+    samples = []
+    failed = [0]
+    lock = threading.Lock()
+
+    def client(index):
+        http = app.test_client()
+        mine, errors = [], 0
+        for i in range(per_client):
+            row = {'movement_id': f'{prefix}-{index}-{i}', 'product_id': product_ids[(index + i) % len(product_ids)],
+                   'from_location': source, 'to_location': target, 'qty': 1}
+            started = time.perf_counter()
+            response = http.post(url, json=[row])
+            mine.append(time.perf_counter() - started)
+            # SQLite answers writers queued past its busy timeout with "database is locked"
+            errors += response.status_code not in (201, 202)
+        with lock:
+            samples.extend(mine)
+            failed[0] += errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, failed[0], time.perf_counter() - started
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 5) / 1000
+
+    os.environ['INTAKE_ENABLED'] = '1'
+    os.environ['INTAKE_QUEUE_PATH'] = tempfile.mktemp(prefix='inventory-intake-', suffix='.db')
+    from bench_utils import create_bench_app, seed
+    app = create_bench_app()
+    from database import db
+    from models import ProductMovement, ProductBalance
+    from reconcile import drift_query
+    with app.app_context():
+        product_ids, location_ids = seed(products=50, locations=2, movements=0)
+        for product_id in product_ids:
+            db.session.add(ProductMovement(movement_id=f'STOCK-{product_id}', product_id=product_id,
+                                           to_location=location_ids[0], qty=1000000))
+            ProductBalance.update_balance(product_id, location_ids[0], 1000000)
+        db.session.commit()
+        engine = db.engine
+    intake = app.extensions['intake']
+
+    commits = {'count': 0}
+
+    @event.listens_for(engine, 'commit')
+    def slow_commit(connection):
+        commits['count'] += 1
+        if latency:
+            time.sleep(latency)
+
+    total = clients * per_client
+    print(f"{clients} clients x {per_client} movements, {latency * 1000:.0f}ms per database commit")
+    for name, url in (('direct', '/api/movements/bulk'), ('intake', '/api/intake/movements')):
+        commits['count'] = 0
+        samples, failed, elapsed = run(app, clients, per_client, url, name.upper(), product_ids, *location_ids)
+        draining = time.perf_counter()
+        while intake.queue.depth():
+            time.sleep(0.01)
+        settled = elapsed + time.perf_counter() - draining
+        samples.sort()
+        pick = lambda q: samples[min(int(len(samples) * q), len(samples) - 1)] * 1000
+        print(f"{name:<7} {total / elapsed:8.0f} acked/s  p50={pick(0.5):6.1f}ms  p95={pick(0.95):6.1f}ms  "
+              f"all committed after {settled:6.2f}s  db_commits={commits['count']}  failed={failed}")
+
+    with app.app_context():
+        drift = db.session.execute(drift_query()).all()
+        stored = db.session.query(ProductMovement).count() - len(product_ids)
+    print(f"stored={stored} drifted_balances={len(drift)} rejected={intake.queue.counts().get('rejected', 0)}")
+    intake.committer.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Compare the set-based balance rebuild with the original per-movement loop.
+
+Usage: python bench_rebuild.py [movements] [products] [locations]
+"""
+import sys
+from bench_utils import create_bench_app, seed, timed
+
+
+def legacy_recalculate_all_balances():
+    """The original implementation: two ORM round trips per movement."""
+    from database import db
+    from models import ProductMovement, ProductBalance
+
+    ProductBalance.query.delete()
+    for movement in ProductMovement.query.all():
+        if movement.from_location:
+            ProductBalance.update_balance(movement.product_id, movement.from_location, -movement.qty)
+        if movement.to_location:
+            ProductBalance.update_balance(movement.product_id, movement.to_location, movement.qty)
+    db.session.commit()
+
+
+def snapshot_balances():
+    from models import ProductBalance
+    return {(b.product_id, b.location_id): b.balance for b in ProductBalance.query.all()}
+
+
+def main():
+    movements = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    products = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    locations = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    app = create_bench_app()
+    with app.app_context():
+        from rebuild import rebuild_balances
+
+        print(f"Seeding {products} products, {locations} locations, {movements} movements...")
+        seed(products=products, locations=locations, movements=movements)
+
+        legacy_seconds, _ = timed(legacy_recalculate_all_balances)
+        legacy = snapshot_balances()
+        print(f"legacy loop:           {legacy_seconds:8.3f}s")
+
+        set_seconds, rows = timed(rebuild_balances)
+        single = snapshot_balances()
+        print(f"set-based (single tx): {set_seconds:8.3f}s  ({rows} rows)")
+
+        chunk_seconds, _ = timed(rebuild_balances, chunk_size=100)
+        chunked = snapshot_balances()
+        print(f"set-based (chunked):   {chunk_seconds:8.3f}s")
+
+        assert legacy == single == chunked, "rebuild engines disagree"
+        print(f"speedup: {legacy_seconds / set_seconds:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Measure worker cold start: import-time bootstrap versus the app factory.
+
+Each scenario starts N worker processes at once against the same seeded
+SQLite database whose balances have not been built yet, and reports the
+time until each worker had a ready app plus the SQL it issued on the way:
+
+* legacy   -- import plus the old import-time bootstrap (create_all, two
+              COUNTs, an unguarded rebuild in every worker that sees none);
+* factory  -- import only; the database is not touched;
+* init-db  -- `init_database()` in every worker, as a deploy step racing
+              itself: the lock lets exactly one of them rebuild.
+
+Usage: python bench_startup.py [workers] [movements]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = r'''
+import json, sys, time
+started = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(1))
+sys.path.insert(0, {here!r})
+from main import app
+rebuilt = False
+if {scenario!r} == 'legacy':
+    from database import db
+    from models import ProductBalance, ProductMovement
+    from rebuild import rebuild_balances
+    with app.app_context():
+        db.create_all()
+        if ProductBalance.query.count() == 0 and ProductMovement.query.count() > 0:
+            rebuild_balances()
+            rebuilt = True
+elif {scenario!r} == 'init-db':
+    from migrations import init_database
+    messages = []
+    with app.app_context():
+        init_database(echo=messages.append)
+    rebuilt = any(message.startswith('Rebuilt') for message in messages)
+print(json.dumps({{'seconds': time.perf_counter() - started, 'statements': len(statements), 'rebuilt': rebuilt}}))
+'''
+
+
+def prepare(database_url, movements):
+    """Seed the database once, then drop the balances so a bootstrap is due"""
+    from bench_utils import create_bench_app, seed
+    from database import db
+    from models import ProductBalance
+
+    app = create_bench_app(database_url)
+    with app.app_context():
+        seed(products=max(movements // 100, 10), locations=50, movements=movements)
+        ProductBalance.query.delete()
+        db.session.commit()
+
+
+def reset_balances(database_url):
+    import sqlite3
+    connection = sqlite3.connect(database_url.replace('sqlite:///', '', 1))
+    connection.execute("DELETE FROM product_balances")
+    connection.commit()
+    connection.close()
+
+
+def run_scenario(scenario, workers, database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    code = CHILD.format(here=HERE, scenario=scenario)
+    procs = [
+        subprocess.Popen([sys.executable, '-c', code], env=env, cwd=HERE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        for _ in range(workers)
+    ]
+    results = []
+    for proc in procs:
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise SystemExit(f"{scenario} worker failed:\n{err}")
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    movements = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+
+    handle, path = tempfile.mkstemp(prefix='inventory-startup-', suffix='.db')
+    os.close(handle)
+    database_url = f"sqlite:///{path}"
+    print(f"Seeding {movements} movements into {path}...")
+    prepare(database_url, movements)
+
+    print(f"{'scenario':<8} {'median':>9} {'max':>9} {'SQL/worker':>11} {'rebuilds':>9}")
+    for scenario in ('legacy', 'factory', 'init-db'):
+        reset_balances(database_url)
+        results = run_scenario(scenario, workers, database_url)
+        seconds = [r['seconds'] for r in results]
+        print(f"{scenario:<8} {statistics.median(seconds):8.3f}s {max(seconds):8.3f}s "
+              f"{statistics.median(r['statements'] for r in results):>11} "
+              f"{sum(r['rebuilt'] for r in results):>9}")
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""Reproducible load test and benchmark suite.
+
+Seeds a SQLite file database at a configurable scale, then measures every
+route registered by `routes.py` in-process through Flask's test client
+(sequentially and under concurrent clients), plus `recalculate_all_balances`.
+Results are written to a JSON file; pass `--compare` with an earlier result
+file to print the change per measurement.
+
+Examples:
+    python bench_suite.py --products 1000 --locations 100 --movements 100000
+    python bench_suite.py --products 10000 --locations 1000 --movements 5000000 \\
+        --database-url sqlite:////tmp/inventory-5m.db --output bench-5m.json
+    python bench_suite.py --database-url sqlite:////tmp/inventory-5m.db --reuse \\
+        --compare bench-5m.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from bench_utils import create_bench_app, seed
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_samples) - 1))), len(sorted_samples) - 1)
+    return sorted_samples[index]
+
+
+def summarise(samples, wall_seconds):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'throughput_rps': len(samples) / wall_seconds if wall_seconds else 0.0,
+        'mean_ms': statistics.mean(samples) * 1000 if samples else 0.0,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p90_ms': percentile(samples, 0.90) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': samples[-1] * 1000 if samples else 0.0,
+    }
+
+
+class Scenario:
+    """One route exercised with a request factory: `make(i)` -> (method, url, kwargs)"""
+
+    def __init__(self, name, make, expect=(200,)):
+        self.name = name
+        self.make = make
+        self.expect = expect
+
+
+def build_scenarios(product_ids, location_ids, movement_ids):
+    rng = random.Random(7)
+
+    def product():
+        return rng.choice(product_ids)
+
+    def location():
+        return rng.choice(location_ids)
+
+    def movement():
+        return rng.choice(movement_ids)
+
+    run = datetime.utcnow().strftime('%H%M%S%f')
+
+    def post(url, data):
+        return 'POST', url, {'data': data}
+
+    return [
+        Scenario('GET /', lambda i: ('GET', '/', {})),
+        Scenario('GET /products', lambda i: ('GET', '/products', {})),
+        Scenario('GET /products/add', lambda i: ('GET', '/products/add', {})),
+        Scenario('POST /products/add', lambda i: post('/products/add', {
+            'product_id': f'BENCH-P-{run}-{i}', 'name': f'Bench product {i}', 'description': ''}), (302,)),
+        Scenario('GET /products/edit/<id>', lambda i: ('GET', f'/products/edit/{product()}', {})),
+        Scenario('POST /products/edit/<id>', lambda i: post(f'/products/edit/{product_ids[0]}', {
+            'product_id': product_ids[0], 'name': f'Renamed {i}', 'description': ''}), (302,)),
+        Scenario('GET /products/view/<id>', lambda i: ('GET', f'/products/view/{product()}', {})),
+        Scenario('POST /products/delete/<id>', lambda i: post(f'/products/delete/BENCH-P-{run}-{i}', {}), (302,)),
+        Scenario('GET /locations', lambda i: ('GET', '/locations', {})),
+        Scenario('GET /locations/add', lambda i: ('GET', '/locations/add', {})),
+        Scenario('POST /locations/add', lambda i: post('/locations/add', {
+            'location_id': f'BENCH-L-{run}-{i}', 'name': f'Bench location {i}', 'description': ''}), (302,)),
+        Scenario('GET /locations/edit/<id>', lambda i: ('GET', f'/locations/edit/{location()}', {})),
+        Scenario('POST /locations/edit/<id>', lambda i: post(f'/locations/edit/{location_ids[0]}', {
+            'location_id': location_ids[0], 'name': f'Renamed {i}', 'description': ''}), (302,)),
+        Scenario('GET /locations/view/<id>', lambda i: ('GET', f'/locations/view/{location()}', {})),
+        Scenario('POST /locations/delete/<id>', lambda i: post(f'/locations/delete/BENCH-L-{run}-{i}', {}), (302,)),
+        Scenario('GET /movements', lambda i: ('GET', '/movements', {})),
+        Scenario('GET /movements/add', lambda i: ('GET', '/movements/add', {})),
+        Scenario('POST /movements/add', lambda i: post('/movements/add', {
+            'movement_id': f'BENCH-M-{run}-{i}', 'product_id': product(), 'from_location': '',
+            'to_location': location(), 'qty': 5}), (302,)),
+        Scenario('GET /movements/edit/<id>', lambda i: ('GET', f'/movements/edit/{movement()}', {})),
+        Scenario('POST /movements/edit/<id>', lambda i: post(f'/movements/edit/BENCH-M-{run}-{i}', {
+            'movement_id': f'BENCH-M-{run}-{i}', 'product_id': product_ids[0], 'from_location': '',
+            'to_location': location_ids[0], 'qty': 6}), (302,)),
+        Scenario('GET /movements/view/<id>', lambda i: ('GET', f'/movements/view/{movement()}', {})),
+        Scenario('POST /movements/delete/<id>', lambda i: post(f'/movements/delete/BENCH-M-{run}-{i}', {}), (302,)),
+        Scenario('GET /balance_report', lambda i: ('GET', '/balance_report', {})),
+        Scenario('GET /api/products', lambda i: ('GET', '/api/products', {})),
+        Scenario('GET /api/locations', lambda i: ('GET', '/api/locations', {})),
+        Scenario('GET /api/movements', lambda i: ('GET', '/api/movements', {})),
+        Scenario('GET /api/movements?product_id', lambda i: ('GET', f'/api/movements?product_id={product()}', {})),
+        Scenario('POST /api/movements/bulk', lambda i: ('POST', '/api/movements/bulk', {'json': [
+            {'movement_id': f'BENCH-B-{run}-{i}-{n}', 'product_id': product(), 'to_location': location(), 'qty': 1}
+            for n in range(100)
+        ]}), (201,)),
+        Scenario('GET /api/balance', lambda i: ('GET', '/api/balance', {})),
+        Scenario('GET /api/balance?as_of', lambda i: ('GET', f'/api/balance?as_of={datetime.utcnow().isoformat()}'
+                                                      f'&product_id={product()}', {})),
+        Scenario('GET /api/balance/<p>/<l>', lambda i: ('GET', f'/api/balance/{product()}/{location()}', {})),
+        Scenario('GET /api/cache/stats', lambda i: ('GET', '/api/cache/stats', {})),
+    ]
+
+
+def run_sequential(app, scenario, requests, max_seconds):
+    client = app.test_client()
+    samples = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(requests):
+        method, url, kwargs = scenario.make(i)
+        t0 = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        samples.append(time.perf_counter() - t0)
+        if response.status_code not in scenario.expect:
+            errors += 1
+        if time.perf_counter() - started > max_seconds:
+            break
+    result = summarise(samples, time.perf_counter() - started)
+    result['errors'] = errors
+    return result
+
+
+def run_concurrent(app, scenario, clients, requests_per_client, max_seconds):
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + max_seconds
+
+    def worker(worker_index):
+        client = app.test_client()
+        local = []
+        for n in range(requests_per_client):
+            method, url, kwargs = scenario.make(worker_index * requests_per_client + n)
+            t0 = time.perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            local.append(time.perf_counter() - t0)
+            if response.status_code not in scenario.expect:
+                with lock:
+                    errors[0] += 1
+            if time.perf_counter() > deadline:
+                break
+        with lock:
+            samples.extend(local)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(worker, range(clients)))
+    result = summarise(samples, time.perf_counter() - started)
+    result['errors'] = errors[0]
+    result['clients'] = clients
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous_path):
+    with open(previous_path) as handle:
+        previous = json.load(handle)
+    print(f"\nComparison with {previous_path} ({(previous.get('meta') or {}).get('git_revision')}):")
+    for section in ('sequential', 'concurrent'):
+        for name, result in current.get(section, {}).items():
+            before = previous.get(section, {}).get(name)
+            if not before or not before.get('p50_ms'):
+                continue
+            change = (result['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100
+            flag = '  <-- regression' if change > 20 else ''
+            print(f"  [{section[:4]}] {name:40s} p50 {before['p50_ms']:9.2f} -> {result['p50_ms']:9.2f} ms "
+                  f"({change:+6.1f}%){flag}")
+    for name, seconds in current.get('maintenance', {}).items():
+        before = previous.get('maintenance', {}).get(name)
+        if before:
+            print(f"  [main] {name:40s} {before:9.3f} -> {seconds:9.3f} s ({(seconds - before) / before * 100:+6.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--locations', type=int, default=100)
+    parser.add_argument('--movements', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=50, help='requests per route (sequential)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent test clients')
+    parser.add_argument('--concurrent-requests', type=int, default=25, help='requests per concurrent client')
+    parser.add_argument('--max-seconds', type=float, default=30.0, help='time budget per route and mode')
+    parser.add_argument('--database-url', help='database to use (default: a new temporary SQLite file)')
+    parser.add_argument('--reuse', action='store_true', help='skip seeding; use the data already in --database-url')
+    parser.add_argument('--only', help='comma-separated substrings; run only matching routes')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    args = parser.parse_args()
+
+    app = create_bench_app(args.database_url)
+    with app.app_context():
+        from database import db
+        from models import Product, Location, ProductMovement
+        from utils import recalculate_all_balances
+
+        if not args.reuse:
+            print(f"Seeding {args.products} products, {args.locations} locations, {args.movements} movements...")
+            t0 = time.perf_counter()
+            seed(products=args.products, locations=args.locations, movements=args.movements)
+            print(f"  seeded in {time.perf_counter() - t0:.1f}s")
+
+        t0 = time.perf_counter()
+        recalculate_all_balances()
+        recalculate_seconds = time.perf_counter() - t0
+        print(f"recalculate_all_balances: {recalculate_seconds:.3f}s")
+
+        product_ids = db.session.execute(db.select(Product.product_id).limit(1000)).scalars().all()
+        location_ids = db.session.execute(db.select(Location.location_id).limit(1000)).scalars().all()
+        movement_ids = db.session.execute(db.select(ProductMovement.movement_id).limit(1000)).scalars().all()
+        scale = {
+            'products': db.session.execute(db.select(db.func.count()).select_from(Product)).scalar(),
+            'locations': db.session.execute(db.select(db.func.count()).select_from(Location)).scalar(),
+            'movements': db.session.execute(db.select(db.func.count()).select_from(ProductMovement)).scalar(),
+        }
+
+    scenarios = build_scenarios(product_ids, location_ids, movement_ids)
+    if args.only:
+        wanted = [part.strip() for part in args.only.split(',')]
+        scenarios = [s for s in scenarios if any(part in s.name for part in wanted)]
+
+    results = {
+        'meta': {
+            'git_revision': git_revision(),
+            'started_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': app.config['SQLALCHEMY_DATABASE_URI'],
+            'scale': scale,
+            'settings': {k: v for k, v in vars(args).items() if k not in ('compare', 'output')},
+        },
+        'maintenance': {'recalculate_all_balances_s': recalculate_seconds},
+        'sequential': {},
+        'concurrent': {},
+    }
+
+    print(f"\n{'route':42s} {'mode':5s} {'n':>6s} {'rps':>9s} {'p50':>9s} {'p90':>9s} {'p99':>9s} {'err':>4s}")
+    for scenario in scenarios:
+        result = run_sequential(app, scenario, args.requests, args.max_seconds)
+        results['sequential'][scenario.name] = result
+        print(f"{scenario.name:42s} {'seq':5s} {result['count']:6d} {result['throughput_rps']:9.1f} "
+              f"{result['p50_ms']:9.2f} {result['p90_ms']:9.2f} {result['p99_ms']:9.2f} {result['errors']:4d}")
+
+    for scenario in scenarios:
+        if not scenario.name.startswith('GET'):
+            continue
+        result = run_concurrent(app, scenario, args.clients, args.concurrent_requests, args.max_seconds)
+        results['concurrent'][scenario.name] = result
+        print(f"{scenario.name:42s} {'c' + str(args.clients):5s} {result['count']:6d} {result['throughput_rps']:9.1f} "
+              f"{result['p50_ms']:9.2f} {result['p90_ms']:9.2f} {result['p99_ms']:9.2f} {result['errors']:4d}")
+
+    with open(args.output, 'w') as handle:
+        json.dump(results, handle, indent=2, sort_keys=True)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Transfer throughput: per-line movements vs one transfer order.
+
+Moves `lines` products from one location to another, repeated `rounds`
+times, two ways:
+
+* per-line  -- one POST /movements/add per line, as an operator keying a
+  transfer into the movement form does: a transaction per line, each with
+  its own stock check and balance updates;
+* transfer  -- one POST /api/transfers with every line: one grouped
+  balance read, one multi-row INSERT and one balance update per
+  (product, location), committed once.
+
+Reports lines/s and transfers/s for 1-, 10- and 100-line transfers (or
+the sizes given) and the SQL statements issued per transfer.
+
+Usage: python bench_transfers.py [rounds] [lines ...]
+"""
+import sys
+import time
+from sqlalchemy import event
+from bench_utils import create_bench_app, seed
+
+SOURCE = 'LOC-00000'
+TARGET = 'LOC-00001'
+
+
+def stock(product_ids, qty):
+    from database import db
+    from models import ProductBalance
+    for product_id in product_ids:
+        ProductBalance.update_balance(product_id, SOURCE, qty)
+    db.session.commit()
+
+
+def per_line(client, prefix, product_ids):
+    for number, product_id in enumerate(product_ids, 1):
+        response = client.post('/movements/add', data={
+            'movement_id': f'{prefix}-{number:03d}', 'product_id': product_id,
+            'from_location': SOURCE, 'to_location': TARGET, 'qty': 1,
+        })
+        assert response.status_code == 302, response.status_code
+
+
+def as_transfer(client, prefix, product_ids):
+    response = client.post('/api/transfers', json={
+        'transfer_id': prefix, 'from_location': SOURCE, 'to_location': TARGET,
+        'lines': [{'product_id': product_id, 'qty': 1} for product_id in product_ids],
+    })
+    assert response.status_code == 201, response.get_json()
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    sizes = [int(arg) for arg in sys.argv[2:]] or [1, 10, 100]
+
+    app = create_bench_app()
+    from database import db
+    with app.app_context():
+        product_ids, _ = seed(products=max(sizes), locations=2, movements=0)
+        stock(product_ids, rounds * 2 * len(sizes))
+        engine = db.engine
+    client = app.test_client()
+
+    statements = {'count': 0}
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements['count'] += 1
+
+    print(f"{rounds} transfers per size, SQLite")
+    for size in sizes:
+        lines = product_ids[:size]
+        for name, run in (('per-line', per_line), ('transfer', as_transfer)):
+            statements['count'] = 0
+            started = time.perf_counter()
+            for i in range(rounds):
+                run(client, f'{name[:3].upper()}-{size}-{i}', lines)
+            elapsed = time.perf_counter() - started
+            print(f"{size:>4} lines  {name:<9} {rounds * size / elapsed:9.0f} lines/s  "
+                  f"{rounds / elapsed:8.1f} transfers/s  {statements['count'] / rounds:7.1f} statements/transfer")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Shared helpers for the benchmark scripts: app setup, seeding and timing."""
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def create_bench_app(database_url=None):
+    """Import the application against a throwaway SQLite database.
+
+    `main.py` reads DATABASE_URL at import time, so this must run before
+    anything else imports `main`. The schema is initialised as `flask
+    init-db` would.
+    """
+    if database_url is None:
+        handle, path = tempfile.mkstemp(prefix='inventory-bench-', suffix='.db')
+        os.close(handle)
+        database_url = f"sqlite:///{path}"
+    os.environ['DATABASE_URL'] = database_url
+
+    from main import app
+    from migrations import init_database
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        init_database(echo=lambda message: None)
+    return app
+
+
+def seed(products=100, locations=20, movements=10000, batch_size=5000, rng_seed=42):
+    """Insert synthetic products, locations and movements with bulk statements.
+
+    Roughly a third of movements are receipts, a third transfers and a third
+    issues, spread over the past year. Balances are not maintained here;
+    call a rebuild afterwards if the benchmark needs them.
+    """
+    from sqlalchemy import insert
+    from database import db
+    from models import Product, Location, ProductMovement
+
+    rng = random.Random(rng_seed)
+    product_ids = [f"PRD-{i:06d}" for i in range(products)]
+    location_ids = [f"LOC-{i:05d}" for i in range(locations)]
+
+    db.session.execute(insert(Product), [
+        {'product_id': pid, 'name': f"Product {pid}", 'description': None} for pid in product_ids
+    ])
+    db.session.execute(insert(Location), [
+        {'location_id': lid, 'name': f"Location {lid}", 'description': None} for lid in location_ids
+    ])
+
+    start = datetime.utcnow() - timedelta(days=365)
+    step = timedelta(days=365) / max(movements, 1)
+    batch = []
+    for i in range(movements):
+        kind = rng.random()
+        from_location = rng.choice(location_ids) if kind > 1 / 3 else None
+        to_location = rng.choice(location_ids) if kind < 2 / 3 else None
+        batch.append({
+            'movement_id': f"MOV-{i:09d}",
+            'timestamp': start + step * i,
+            'product_id': rng.choice(product_ids),
+            'from_location': from_location,
+            'to_location': to_location,
+            'qty': rng.randint(1, 50),
+        })
+        if len(batch) >= batch_size:
+            db.session.execute(insert(ProductMovement), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(ProductMovement), batch)
+    db.session.commit()
+    return product_ids, location_ids
+
+
+def timed(fn, *args, **kwargs):
+    """Run `fn` once and return (seconds, result)."""
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - started, result
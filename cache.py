@@ -0,0 +1,333 @@
+"""Read-through cache for reference data and balances.
+
+Backends are selected with the ``CACHE_BACKEND`` config key:
+
+* ``lru`` -- in-process LRU with per-entry TTL (default). Invalidation only
+  reaches the current process; other workers see changes after the TTL.
+* ``shared`` -- a local stand-in for a shared cache such as Redis or
+  memcached: values are pickled into a process-wide store, so every app in
+  the process sees the same entries and pays the serialisation cost a
+  network cache would.
+* ``null`` -- caching disabled.
+
+Writes invalidate affected keys immediately and again after the transaction
+commits, so a reader cannot re-populate an entry with pre-commit data.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from signals import balances_changed
+
+_MISSING = object()
+_PENDING_KEY = 'cache_invalidations'
+
+
+class NullBackend:
+    def get(self, key):
+        return _MISSING
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def counter(self, key):
+        return 0
+
+    def incr(self, key):
+        return 0
+
+    def clear(self):
+        pass
+
+
+class LRUBackend:
+    """Thread-safe in-process LRU with per-entry expiry"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISSING
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LocalSharedBackend:
+    """Process-wide pickled key/value store standing in for Redis/memcached"""
+
+    _store = {}
+    _counters = {}
+    _lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._store.get(key)
+        if entry is None:
+            return _MISSING
+        expires, payload = entry
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return _MISSING
+        return pickle.loads(payload)
+
+    def set(self, key, value, ttl):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._store[key] = (expires, payload)
+
+    def delete(self, key):
+        with self._lock:
+            self._store.pop(key, None)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+
+
+BACKENDS = {
+    'null': NullBackend,
+    'lru': LRUBackend,
+    'shared': LocalSharedBackend,
+}
+
+
+class _AppCache:
+    """One application's backend, default TTL and hit/miss counters"""
+
+    def __init__(self, backend, default_ttl):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        self.stats_lock = threading.Lock()
+
+
+_DISABLED = _AppCache(NullBackend(), 0)
+
+
+class Cache:
+    """Namespaced read-through cache with hit/miss counters.
+
+    Keys are ``(namespace, generation, *parts)`` tuples. Each namespace has a
+    generation counter kept by the backend outside its evictable entries;
+    `invalidate_namespace` bumps it, which orphans every entry of that
+    namespace without enumerating keys.
+
+    Like `db`, one `Cache` serves every app it was initialised with: the
+    backend and counters are those of the current app, and outside an
+    application context nothing is cached.
+    """
+
+    def init_app(self, app):
+        backend = app.config.get('CACHE_BACKEND', 'lru')
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown CACHE_BACKEND: {backend}")
+        if backend == 'lru':
+            backend = LRUBackend(app.config.get('CACHE_MAX_ENTRIES', 10000))
+        else:
+            backend = BACKENDS[backend]()
+        app.extensions['cache'] = _AppCache(backend, app.config.get('CACHE_DEFAULT_TTL', 60))
+
+        balances_changed.connect(self._on_balances_changed, weak=False)
+        if not event.contains(Session, 'after_commit', self._after_commit):
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_soft_rollback', self._after_rollback)
+
+    def _state(self):
+        state = current_app.extensions.get('cache') if has_app_context() else None
+        return state if state is not None else _DISABLED
+
+    @property
+    def backend(self):
+        return self._state().backend
+
+    def _generation(self, namespace):
+        return self.backend.counter(('gen', namespace))
+
+    def _key(self, namespace, parts):
+        return (namespace, self._generation(namespace)) + tuple(parts)
+
+    def get_or_set(self, namespace, parts, loader, ttl=None):
+        """Return the cached value for the key or compute, store and return it"""
+        state = self._state()
+        key = self._key(namespace, parts)
+        value = state.backend.get(key)
+        with state.stats_lock:
+            state.stats[namespace]['hits' if value is not _MISSING else 'misses'] += 1
+        if value is _MISSING:
+            value = loader()
+            state.backend.set(key, value, state.default_ttl if ttl is None else ttl)
+        return value
+
+    def invalidate(self, namespace, *parts):
+        """Drop one entry now and again when the current transaction commits"""
+        self.backend.delete(self._key(namespace, parts))
+        self._defer(('key', namespace, parts))
+
+    def invalidate_namespace(self, namespace):
+        """Drop every entry of a namespace now and again after commit"""
+        self.backend.incr(('gen', namespace))
+        self._defer(('namespace', namespace, None))
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        state = self._state()
+        with state.stats_lock:
+            namespaces = {name: dict(counts) for name, counts in state.stats.items()}
+        hits = sum(counts['hits'] for counts in namespaces.values())
+        misses = sum(counts['misses'] for counts in namespaces.values())
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else 0.0,
+            'namespaces': namespaces,
+        }
+
+    def reset_stats(self):
+        state = self._state()
+        with state.stats_lock:
+            state.stats.clear()
+
+    def _defer(self, item):
+        from database import db
+        try:
+            db.session.info.setdefault(_PENDING_KEY, set()).add(item)
+        except RuntimeError:
+            # Outside an application context there is no transaction to wait for
+            pass
+
+    def _after_commit(self, session):
+        for kind, namespace, parts in session.info.pop(_PENDING_KEY, ()):
+            if kind == 'namespace':
+                self.backend.incr(('gen', namespace))
+            else:
+                self.backend.delete(self._key(namespace, parts))
+
+    def _after_rollback(self, session, previous_transaction):
+        if previous_transaction.parent is None:
+            session.info.pop(_PENDING_KEY, None)
+
+    def _on_balances_changed(self, sender, keys=None, changes=None):
+        if keys is None:
+            self.invalidate_namespace('balance')
+            return
+        for product_id, location_id in keys:
+            self.invalidate('balance', product_id, location_id)
+
+
+cache = Cache()
+
+
+def _product_dict(product):
+    return {'product_id': product.product_id, 'name': product.name, 'description': product.description,
+            'version': product.version}
+
+
+def _location_dict(location):
+    return {'location_id': location.location_id, 'name': location.name, 'description': location.description,
+            'version': location.version}
+
+
+def cached_products():
+    """All products as plain dicts, ordered by id"""
+    from models import Product
+    return cache.get_or_set('products', ('all',), lambda: [
+        _product_dict(p) for p in Product.query.order_by(Product.product_id).all()
+    ])
+
+
+def cached_locations():
+    """All locations as plain dicts, ordered by id"""
+    from models import Location
+    return cache.get_or_set('locations', ('all',), lambda: [
+        _location_dict(l) for l in Location.query.order_by(Location.location_id).all()
+    ])
+
+
+def cached_product(product_id):
+    """One product as a dict, or None if it does not exist"""
+    from database import db
+    from models import Product
+
+    def load():
+        product = db.session.get(Product, product_id)
+        return _product_dict(product) if product else None
+    return cache.get_or_set('product', (product_id,), load)
+
+
+def cached_location(location_id):
+    """One location as a dict, or None if it does not exist"""
+    from database import db
+    from models import Location
+
+    def load():
+        location = db.session.get(Location, location_id)
+        return _location_dict(location) if location else None
+    return cache.get_or_set('location', (location_id,), load)
+
+
+def cached_balance(product_id, location_id):
+    from models import ProductBalance
+    return cache.get_or_set('balance', (product_id, location_id),
+                            lambda: ProductBalance.get_balance(product_id, location_id))
+
+
+def invalidate_product(product_id):
+    cache.invalidate('products', 'all')
+    cache.invalidate('product', product_id)
+
+
+def invalidate_location(location_id):
+    cache.invalidate('locations', 'all')
+    cache.invalidate('location', location_id)
@@ -0,0 +1,331 @@
+import time
+from datetime import datetime, timedelta
+import click
+from flask.cli import AppGroup, with_appcontext
+
+snapshots_cli = AppGroup('snapshots', help='Build and prune dated balance snapshots.')
+schema_cli = AppGroup('schema', help='Apply schema migrations and inspect query plans.')
+jobs_cli = AppGroup('jobs', help='Run and inspect background jobs.')
+rollups_cli = AppGroup('rollups', help='Backfill hourly and daily movement rollups.')
+counters_cli = AppGroup('counters', help='Reconcile the dashboard counters.')
+ledger_cli = AppGroup('ledger', help='Archive old movements and inspect the movement ledger.')
+intake_cli = AppGroup('intake', help='Drain and inspect the write-ahead movement intake queue.')
+
+
+@click.command('init-db')
+@click.option('--timeout', type=int, default=600, show_default=True,
+              help='Seconds to wait for another process that is already initialising.')
+@with_appcontext
+def init_db_command(timeout):
+    """Create or upgrade the schema and build missing balances (run once per deploy)."""
+    from migrations import init_database
+    init_database(echo=click.echo, timeout=timeout)
+    click.echo("Database is ready")
+
+
+@click.command('rebuild-balances')
+@click.option('--chunk-size', type=int, help='Replace balances N products per transaction instead of all at once.')
+@click.option('--timeout', type=int, default=600, show_default=True,
+              help='Seconds to wait if another rebuild is running.')
+@with_appcontext
+def rebuild_balances_command(chunk_size, timeout):
+    """Rebuild every balance from the movement history."""
+    from locks import single_runner
+    from rebuild import rebuild_balances
+    with single_runner('rebuild-balances', timeout=timeout):
+        written = rebuild_balances(
+            chunk_size=chunk_size, progress=lambda percent, message: click.echo(f"{percent:>3}%  {message}"))
+    click.echo(f"Rebuilt {written} balance rows")
+
+
+@click.command('reconcile-balances')
+@click.option('--full', is_flag=True, help='Check every product instead of recent ones plus the next sweep chunks.')
+@click.option('--dry-run', is_flag=True, help='Report drift without repairing it.')
+@click.option('--chunk-size', type=int, default=1000, show_default=True, help='Products per verification query.')
+@click.option('--sweep-chunks', type=int, default=10, show_default=True,
+              help='Chunks of the rolling sweep to check in an incremental run.')
+@click.option('--timeout', type=int, default=600, show_default=True,
+              help='Seconds to wait if a rebuild or another reconcile is running.')
+@with_appcontext
+def reconcile_balances_command(full, dry_run, chunk_size, sweep_chunks, timeout):
+    """Verify balances against movements and repair only the rows that drifted."""
+    from locks import single_runner
+    from reconcile import reconcile
+    with single_runner('rebuild-balances', timeout=timeout):
+        report = reconcile(full=full, repair=not dry_run, chunk_size=chunk_size, sweep_chunks=sweep_chunks)
+    for row in report['drift']:
+        click.echo(f"{row['product_id']} @ {row['location_id']}: stored {row['stored']}, expected {row['expected']}")
+    verb = 'found' if dry_run else 'repaired'
+    click.echo(f"{report['chunks_checked']} chunk(s) checked, {report['drift_count']} drifted balance(s) {verb}")
+
+
+@click.command('export')
+@click.argument('dataset', type=click.Choice(['movements', 'balances', 'location_summary']))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'csv.gz', 'ndjson', 'ndjson.gz']),
+              default='csv', show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True), default='-',
+              help='File to write; "-" for stdout.')
+@click.option('--since', help='Only movements at or after this ISO timestamp.')
+@click.option('--until', help='Only movements before this ISO timestamp.')
+@click.option('--cursor', help='Only movements after this cursor (printed by the previous export).')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+@with_appcontext
+def export_command(dataset, fmt, output, since, until, cursor, batch_size):
+    """Stream DATASET as CSV or NDJSON (optionally gzipped) in constant memory."""
+    from exports import write_export
+    from utils import decode_cursor, parse_timestamp
+    try:
+        since = parse_timestamp(since)
+        until = parse_timestamp(until)
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+    with click.open_file(output, 'wb') as fh:
+        rows, next_cursor = write_export(fh, dataset, fmt, batch_size=batch_size, since=since, until=until,
+                                     after=after)
+    click.echo(f"Exported {rows} rows" + (f"; next cursor: {next_cursor}" if next_cursor else ''), err=True)
+
+
+@snapshots_cli.command('create')
+def create_snapshot_command():
+    """Copy current balances into a new dated snapshot."""
+    from snapshots import create_snapshot
+    taken_at, rows = create_snapshot()
+    click.echo(f"Snapshot {taken_at.isoformat()} written ({rows} balances)")
+
+
+@snapshots_cli.command('list')
+def list_snapshots_command():
+    """List existing snapshots."""
+    from snapshots import list_snapshots
+    for snapshot_at, rows in list_snapshots():
+        click.echo(f"{snapshot_at.isoformat()}  {rows} balances")
+
+
+@snapshots_cli.command('prune')
+@click.option('--older-than', 'days', type=int, default=90, show_default=True,
+              help='Remove snapshots older than this many days.')
+@click.option('--keep-monthly/--no-keep-monthly', default=True, show_default=True,
+              help='Keep the last snapshot of every month.')
+def prune_snapshots_command(days, keep_monthly):
+    """Remove old snapshots."""
+    from snapshots import prune_snapshots
+    removed = prune_snapshots(datetime.utcnow() - timedelta(days=days), keep_monthly=keep_monthly)
+    click.echo(f"Removed {removed} snapshot(s)")
+
+
+@snapshots_cli.command('run')
+@click.option('--interval', type=int, default=86400, show_default=True,
+              help='Seconds between snapshots.')
+@click.option('--retain-days', type=int, default=90, show_default=True,
+              help='Prune non-month-end snapshots older than this many days.')
+def run_snapshots_command(interval, retain_days):
+    """Take snapshots periodically until interrupted."""
+    from snapshots import create_snapshot, prune_snapshots
+    while True:
+        taken_at, rows = create_snapshot()
+        removed = prune_snapshots(datetime.utcnow() - timedelta(days=retain_days))
+        click.echo(f"Snapshot {taken_at.isoformat()} written ({rows} balances), pruned {removed}")
+        time.sleep(interval)
+
+
+@schema_cli.command('upgrade')
+def schema_upgrade_command():
+    """Apply pending schema migrations."""
+    from migrations import upgrade
+    if not upgrade(echo=click.echo):
+        click.echo("Schema is up to date")
+
+
+@schema_cli.command('status')
+def schema_status_command():
+    """List migrations that have not been applied yet."""
+    from migrations import pending_migrations
+    pending = pending_migrations()
+    for version in pending:
+        click.echo(f"pending  {version}")
+    if not pending:
+        click.echo("Schema is up to date")
+
+
+@schema_cli.command('advise')
+@click.option('--verbose', is_flag=True, help='Print the full plan of every query.')
+def schema_advise_command(verbose):
+    """EXPLAIN the app's known queries and report full scans and sorts."""
+    from query_advisor import advise
+    problems = 0
+    for entry in advise():
+        flagged = entry['full_scans'] or entry['extra_sorts']
+        problems += bool(flagged)
+        click.echo(f"[{'SCAN' if entry['full_scans'] else 'SORT' if entry['extra_sorts'] else ' OK '}] {entry['query']}")
+        for line in entry['plan'] if verbose or flagged else ():
+            click.echo(f"        {line}")
+    click.echo(f"{problems} {'query needs' if problems == 1 else 'queries need'} attention")
+
+
+@jobs_cli.command('list')
+@click.option('--kind', help='Only jobs of this kind.')
+@click.option('--status', help='Only jobs in this status.')
+@click.option('--limit', type=int, default=20, show_default=True)
+def list_jobs_command(kind, status, limit):
+    """List recent jobs, newest first."""
+    from jobs import recent_jobs
+    for job in recent_jobs(kind=kind, status=status, limit=limit):
+        click.echo(f"{job.job_id}  {job.kind:<18} {job.status:<9} {job.progress:>3}%  "
+                   f"{job.created_at.isoformat()}  {job.message or job.error or ''}")
+
+
+@jobs_cli.command('run')
+@click.argument('kind')
+@click.option('--param', 'params', multiple=True, metavar='KEY=VALUE', help='Job parameter (repeatable).')
+def run_job_command(kind, params):
+    """Run a job of KIND in the foreground and record it in the job table."""
+    from flask import current_app
+    from jobs import jobs
+    values = dict(param.split('=', 1) for param in params)
+    if 'chunk_size' in values:
+        if not values['chunk_size'].isdigit() or int(values['chunk_size']) < 1:
+            raise click.BadParameter('chunk_size must be a positive integer', param_hint='--param')
+        values['chunk_size'] = int(values['chunk_size'])
+    current_app.config['JOBS_EXECUTOR'] = 'inline'
+    try:
+        job = jobs.submit(kind, values)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint='KIND')
+    click.echo(f"{job.job_id} {job.status}: {job.result or job.error}")
+
+
+@jobs_cli.command('prune')
+@click.option('--older-than', 'days', type=int, default=30, show_default=True,
+              help='Remove finished jobs older than this many days.')
+def prune_jobs_command(days):
+    """Remove finished jobs and their export files."""
+    from jobs import prune_jobs
+    removed = prune_jobs(datetime.utcnow() - timedelta(days=days))
+    click.echo(f"Removed {removed} job(s)")
+
+
+@rollups_cli.command('backfill')
+@click.option('--since', type=click.DateTime(), help='First day to recompute (default: oldest movement).')
+@click.option('--until', type=click.DateTime(), help='Recompute days before this (default: newest movement).')
+@click.option('--window-days', type=int, default=31, show_default=True, help='Days per transaction.')
+@click.option('--timeout', type=int, default=600, show_default=True,
+              help='Seconds to wait if another backfill is running.')
+def backfill_rollups_command(since, until, window_days, timeout):
+    """Recompute rollups from the movement history."""
+    from locks import single_runner
+    from rollups import backfill
+    with single_runner('rollups-backfill', timeout=timeout):
+        written = backfill(since=since, until=until, window_days=window_days,
+                           progress=lambda percent, message: click.echo(f"{percent:>3}%  {message}"))
+    click.echo(f"Wrote {written} rollup rows")
+
+
+@counters_cli.command('reconcile')
+def reconcile_counters_command():
+    """Recount products, locations, movements and non-zero balances once."""
+    from counters import reconcile_counters
+    for name, drift in reconcile_counters().items():
+        click.echo(f"{name}: {drift:+d}")
+
+
+@counters_cli.command('run')
+@click.option('--interval', type=int, default=3600, show_default=True,
+              help='Seconds between reconciles.')
+def run_counters_command(interval):
+    """Reconcile the counters periodically until interrupted."""
+    from counters import reconcile_counters
+    while True:
+        drift = reconcile_counters()
+        click.echo(f"{datetime.utcnow().isoformat()} reconciled, drift "
+                   f"{', '.join(f'{name} {value:+d}' for name, value in drift.items())}")
+        time.sleep(interval)
+
+
+@ledger_cli.command('archive')
+@click.option('--older-than', type=int, default=90, show_default=True,
+              help='Archive movements from before midnight this many days ago.')
+@click.option('--before', type=click.DateTime(), help='Archive movements before this time instead.')
+@click.option('--batch-size', type=int, default=5000, show_default=True, help='Movements per transaction.')
+@click.option('--timeout', type=int, default=600, show_default=True,
+              help='Seconds to wait if a rebuild, reconcile or another archive is running.')
+def archive_ledger_command(older_than, before, batch_size, timeout):
+    """Move old movements to the archive table and checkpoint their balances."""
+    from locks import single_runner
+    from ledger import archive_movements
+    if before is None:
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        before = today - timedelta(days=older_than)
+    with single_runner('rebuild-balances', timeout=timeout):
+        try:
+            report = archive_movements(before, batch_size=batch_size,
+                                       progress=lambda percent, message: click.echo(f"{percent:>3}%  {message}"))
+        except ValueError as exc:
+            raise click.ClickException(str(exc))
+    click.echo(f"Archived {report['archived']} movements before {report['boundary']}, "
+               f"{report['checkpoint_rows']} checkpoint rows")
+
+
+@ledger_cli.command('status')
+def ledger_status_command():
+    """Show the archive boundary and the size of the hot and archive tables."""
+    from ledger import ledger_status
+    for name, value in ledger_status().items():
+        click.echo(f"{name}: {value if value is not None else '-'}")
+
+
+def _intake():
+    from intake import get_intake
+    intake = get_intake()
+    if intake is None:
+        raise click.ClickException("Intake mode is off; set INTAKE_ENABLED=1")
+    return intake
+
+
+@intake_cli.command('status')
+def intake_status_command():
+    """Show queue depth, rejected rows and how far the queue has been applied."""
+    from intake import intake_stats
+    _intake()
+    stats = intake_stats()
+    stats.pop('committer')
+    for name, value in stats.items():
+        click.echo(f"{name}: {value}")
+
+
+@intake_cli.command('drain')
+@click.option('--follow', is_flag=True, help='Keep committing new rows until interrupted.')
+@click.option('--timeout', type=int, default=600, show_default=True,
+              help='Seconds to wait if another process is committing this queue.')
+def drain_intake_command(follow, timeout):
+    """Replay and commit queued movements (the committer for INTAKE_COMMITTER=external)."""
+    import threading
+    from locks import single_runner
+    intake = _intake()
+    with single_runner(f"intake-{intake.queue.queue_id}", timeout=timeout):
+        if follow:
+            intake.committer.follow(threading.Event())
+        settled = intake.committer.drain()
+    click.echo(f"Settled {settled} queued movements; {intake.queue.depth()} still queued")
+
+
+@intake_cli.command('rejected')
+@click.option('--limit', type=int, default=50, show_default=True)
+def rejected_intake_command(limit):
+    """List queued movements that were rejected when committed, newest first."""
+    for row in _intake().queue.rejected(limit=limit):
+        click.echo(f"{row['seq']:>10}  {row['movement_id']}  {row['product_id']}  {row['qty']}  {row['errors']}")
+
+
+def register_commands(app):
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(rebuild_balances_command)
+    app.cli.add_command(reconcile_balances_command)
+    app.cli.add_command(export_command)
+    app.cli.add_command(snapshots_cli)
+    app.cli.add_command(schema_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(rollups_cli)
+    app.cli.add_command(counters_cli)
+    app.cli.add_command(ledger_cli)
+    app.cli.add_command(intake_cli)
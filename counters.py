@@ -0,0 +1,152 @@
+"""Maintained row counts for the dashboard.
+
+Each counter in `COUNTERS` is spread over `SLOTS` rows of
+`dashboard_counters`; a write adds its delta to one random slot inside its
+own transaction, so concurrent writers rarely wait on the same row, and a
+read sums all slots with one grouped query.
+
+* ``products`` / ``locations`` -- bumped by the create and delete routes;
+* ``movements`` -- from `movements_changed` (adds, deletes, bulk ingest);
+* ``nonzero_balances`` -- from `balances_changed`: the touched balances are
+  read back and a key counts when it crosses zero in either direction.
+
+Bumps only update existing slots; `reconcile_counters` creates them. It
+reads the stored slots and the real row counts in one statement, so both
+come from the same snapshot even under READ COMMITTED, and adds the
+difference to slot 0; increments committed while it runs are neither lost
+nor counted twice. Run it once at
+`init-db` and periodically (`flask counters run`) to absorb writes made by
+tools that bypass the app.
+"""
+import random
+from flask import current_app
+from sqlalchemy import select, func, insert, update, tuple_
+from database import db
+from models import Product, Location, ProductBalance, DashboardCounter
+from signals import balances_changed, balances_rebuilt, movements_changed
+from ledger import partitions
+
+COUNTERS = ('products', 'locations', 'movements', 'nonzero_balances')
+SLOTS = 16
+KEY_CHUNK = 500
+
+
+def bump(deltas):
+    """Add {name: delta} to the counters; caller commits"""
+    slot = random.randrange(SLOTS)
+    # a fixed order keeps concurrent multi-counter bumps from deadlocking
+    for name in sorted(deltas):
+        if deltas[name]:
+            db.session.execute(
+                update(DashboardCounter)
+                .where(DashboardCounter.name == name, DashboardCounter.slot == slot)
+                .values(value=DashboardCounter.value + deltas[name])
+            )
+
+
+def counter_values():
+    """{name: value} for every initialised counter, in one query"""
+    rows = db.session.execute(
+        select(DashboardCounter.name, func.sum(DashboardCounter.value)).group_by(DashboardCounter.name)
+    ).all()
+    return {name: int(value) for name, value in rows}
+
+
+def _live_count(name):
+    """Scalar subquery counting the real rows behind counter `name`"""
+    if name == 'movements':
+        # hot plus archived movements
+        counts = [select(func.count()).select_from(source).where(*bounds).scalar_subquery()
+                  for source, bounds in partitions()]
+        return sum(counts[1:], counts[0])
+    queries = {
+        'products': select(func.count()).select_from(Product),
+        'locations': select(func.count()).select_from(Location),
+        'nonzero_balances': select(func.count()).select_from(ProductBalance).where(ProductBalance.balance != 0),
+    }
+    return queries[name].scalar_subquery()
+
+
+def live_counts(names):
+    """Count the real rows behind the given counters"""
+    names = list(names)
+    row = db.session.execute(select(*[_live_count(name) for name in names])).one()
+    return dict(zip(names, row))
+
+
+def reconcile_counters(names=COUNTERS):
+    """Correct the given counters from real row counts; returns {name: drift}"""
+    names = list(names)
+    present = set(db.session.execute(
+        select(DashboardCounter.name).where(DashboardCounter.name.in_(names)).distinct()
+    ).scalars())
+    missing = [name for name in names if name not in present]
+    if missing:
+        db.session.execute(insert(DashboardCounter), [
+            {'name': name, 'slot': slot, 'value': 0} for name in missing for slot in range(SLOTS)
+        ])
+    # stored and real counts in one statement, i.e. one snapshot
+    stored = [
+        select(func.coalesce(func.sum(DashboardCounter.value), 0)).where(DashboardCounter.name == name)
+        .scalar_subquery() for name in names
+    ]
+    row = db.session.execute(select(*stored, *[_live_count(name) for name in names])).one()
+    drift = {name: int(row[len(names) + i]) - int(row[i]) for i, name in enumerate(names)}
+    for name in sorted(drift):
+        if drift[name]:
+            db.session.execute(
+                update(DashboardCounter)
+                .where(DashboardCounter.name == name, DashboardCounter.slot == 0)
+                .values(value=DashboardCounter.value + drift[name])
+            )
+    db.session.commit()
+    return drift
+
+
+def counters_missing():
+    return any(name not in counter_values() for name in COUNTERS)
+
+
+def _nonzero_crossings(changes):
+    keys = list(changes)
+    crossed = 0
+    with db.session.no_autoflush:
+        for start in range(0, len(keys), KEY_CHUNK):
+            chunk = keys[start:start + KEY_CHUNK]
+            current = dict(
+                ((product_id, location_id), balance) for product_id, location_id, balance in db.session.execute(
+                    select(ProductBalance.product_id, ProductBalance.location_id, ProductBalance.balance)
+                    .where(tuple_(ProductBalance.product_id, ProductBalance.location_id).in_(chunk))
+                )
+            )
+            for key in chunk:
+                balance = current.get(key, 0)
+                crossed += (balance != 0) - (balance - changes[key] != 0)
+    return crossed
+
+
+def _enabled():
+    return current_app.config.get('COUNTERS_ENABLED', False)
+
+
+def _on_balances_changed(sender, keys=None, changes=None):
+    if changes and _enabled():
+        bump({'nonzero_balances': _nonzero_crossings(changes)})
+
+
+def _on_balances_rebuilt(sender):
+    if _enabled():
+        reconcile_counters(('nonzero_balances',))
+
+
+def _on_movements_changed(sender, added=(), removed=()):
+    if _enabled():
+        bump({'movements': len(added) - len(removed)})
+
+
+def init_counters(app):
+    app.config.setdefault('COUNTERS_ENABLED', True)
+    # receivers are process-wide and check the current app's flag; connecting again is a no-op
+    balances_changed.connect(_on_balances_changed, weak=False)
+    balances_rebuilt.connect(_on_balances_rebuilt, weak=False)
+    movements_changed.connect(_on_movements_changed, weak=False)
@@ -0,0 +1,134 @@
+"""Optimistically locked edits of movements, products and locations.
+
+Products, locations and movements carry a `version` column mapped as the
+ORM's `version_id_col`, so every UPDATE and DELETE the session flushes is
+``... WHERE <key> = ? AND version = ?`` and bumps the version. A client
+sends back the version it was shown; if that is no longer current, or
+another writer gets in between our read and our write, `VersionConflict`
+is raised and nothing is changed.
+
+Movement edits and deletes write the movement row first, before any
+balance is touched: a conflicting writer fails on its first statement
+instead of after having locked balance rows, and the only locks held are
+the movement row and the balances it really changes. No table or
+SELECT ... FOR UPDATE locks are taken.
+
+Movements older than the archive boundary are read-only
+(`ledger.MovementArchived`). A line of a transfer order keeps the header's
+locations; only its product and quantity can change (`TransferLineMoved`).
+Deleting a line takes it off its transfer's line count in the same
+transaction.
+
+All functions leave the transaction open; callers commit, or roll back on
+`VersionConflict` / `InsufficientStock` / `MovementArchived` /
+`TransferLineMoved`.
+"""
+from sqlalchemy import update
+from sqlalchemy.orm.exc import StaleDataError
+from database import db
+from models import ProductBalance, TransferOrder
+from signals import movements_changed
+from ledger import check_writable
+
+
+class VersionConflict(Exception):
+    """The row was changed or deleted by someone else"""
+
+    def __init__(self, current_version=None):
+        super().__init__('The record was changed by someone else; reload and try again')
+        self.current_version = current_version
+
+
+class InsufficientStock(Exception):
+    def __init__(self, location_id, balance, requested):
+        super().__init__(f"Insufficient stock! Current balance: {balance}, Requested: {requested}")
+        self.location_id = location_id
+        self.balance = balance
+        self.requested = requested
+
+
+class TransferLineMoved(Exception):
+    """An edit would move a transfer line away from its transfer's locations"""
+
+    def __init__(self, transfer_id):
+        super().__init__(f"Movement is a line of transfer {transfer_id}; its locations cannot be changed")
+        self.transfer_id = transfer_id
+
+
+def _check_version(record, version):
+    if version is not None and version != record.version:
+        raise VersionConflict(record.version)
+
+
+def _flush():
+    try:
+        db.session.flush()
+    except StaleDataError as exc:
+        raise VersionConflict() from exc
+
+
+def _apply_balances(change, sign):
+    """Add (sign=1) or take back (sign=-1) a movement's effect on balances"""
+    if change['from_location']:
+        ProductBalance.update_balance(change['product_id'], change['from_location'], -sign * change['qty'])
+    if change['to_location']:
+        ProductBalance.update_balance(change['product_id'], change['to_location'], sign * change['qty'])
+
+
+def update_movement(movement, version, product_id, from_location, to_location, qty):
+    """Change a movement and move its balance effect; returns the movement"""
+    _check_version(movement, version)
+    check_writable(movement.timestamp)
+    if movement.transfer_id and ((from_location or None, to_location or None)
+                                 != (movement.from_location, movement.to_location)):
+        raise TransferLineMoved(movement.transfer_id)
+    before = movement.as_change()
+    movement.product_id = product_id
+    movement.from_location = from_location or None
+    movement.to_location = to_location or None
+    movement.qty = qty
+    after = movement.as_change()
+    if after == before:
+        return movement
+    _flush()
+
+    _apply_balances(before, -1)
+    if after['from_location'] and not ProductBalance.withdraw(product_id, after['from_location'], qty):
+        raise InsufficientStock(after['from_location'],
+                                ProductBalance.get_balance(product_id, after['from_location']), qty)
+    if after['to_location']:
+        ProductBalance.update_balance(product_id, after['to_location'], qty)
+    movements_changed.send(type(movement), added=[after], removed=[before])
+    return movement
+
+
+def remove_movement(movement, version=None):
+    """Delete a movement and take back its balance effect"""
+    _check_version(movement, version)
+    check_writable(movement.timestamp)
+    change = movement.as_change()
+    db.session.delete(movement)
+    _flush()
+    if movement.transfer_id:
+        db.session.execute(
+            update(TransferOrder).where(TransferOrder.transfer_id == movement.transfer_id)
+            .values(lines=TransferOrder.lines - 1)
+        )
+    _apply_balances(change, -1)
+    movements_changed.send(type(movement), removed=[change])
+
+
+def remove_record(record, version=None):
+    """Delete a product or location under its version"""
+    _check_version(record, version)
+    db.session.delete(record)
+    _flush()
+
+
+def update_record(record, version, **values):
+    """Set plain attributes on a product or location under its version"""
+    _check_version(record, version)
+    for name, value in values.items():
+        setattr(record, name, value)
+    _flush()
+    return record
@@ -0,0 +1,233 @@
+"""Streaming exports of movements, balances and per-location summaries.
+
+Rows are read as core tuples from a server-side cursor
+(``stream_results``), `EXPORT_BATCH` at a time, and each batch is encoded
+and handed on as one chunk, so memory stays constant however large the
+table is. Formats are CSV and NDJSON, either of them optionally gzipped.
+
+Movement exports run in the order movements were recorded, on
+(recorded_at, movement_id), and can be limited to timestamps in
+[`since`, `until`) or continue after a movement `cursor`. `recorded_at` is stamped
+when the row is inserted, so a movement whose `timestamp` is earlier -- a
+bulk import with explicit timestamps, an intake row stamped when it was
+queued, a row timestamped before a slow commit -- still sorts after
+everything exported before it. Each export stops at the newest movement
+recorded at least ``EXPORT_SETTLE_SECONDS`` (default 30) before it starts, giving transactions
+that were still open that long to commit; the cursor for that row is
+returned so the next export picks up exactly where this one ended. When
+part of the history is archived, the archive is read first and the hot
+table after it.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, func, case, or_, and_, false
+from database import db
+from models import Location, ProductMovement, ProductBalance
+from utils import encode_cursor
+from ledger import partitions
+
+EXPORT_BATCH = 5000
+EXPORT_SETTLE_SECONDS = 30
+DATASETS = ('movements', 'balances', 'location_summary')
+
+FORMATS = {
+    'csv': ('text/csv', '.csv'),
+    'csv.gz': ('application/gzip', '.csv.gz'),
+    'ndjson': ('application/x-ndjson', '.ndjson'),
+    'ndjson.gz': ('application/gzip', '.ndjson.gz'),
+}
+
+
+def _after(after, source=ProductMovement):
+    recorded_at, movement_id = after
+    return or_(
+        source.recorded_at > recorded_at,
+        and_(source.recorded_at == recorded_at, source.movement_id > movement_id),
+    )
+
+
+def _upto(upto, source=ProductMovement):
+    recorded_at, movement_id = upto
+    return or_(
+        source.recorded_at < recorded_at,
+        and_(source.recorded_at == recorded_at, source.movement_id <= movement_id),
+    )
+
+
+def movements_query(since=None, until=None, after=None, upto=None, product_id=None, location_id=None,
+                    source=ProductMovement):
+    query = (
+        select(
+            source.movement_id,
+            source.product_id,
+            source.from_location,
+            source.to_location,
+            source.qty,
+            source.timestamp,
+        )
+        .order_by(source.recorded_at, source.movement_id)
+    )
+    if since is not None:
+        query = query.where(source.timestamp >= since)
+    if until is not None:
+        query = query.where(source.timestamp < until)
+    if after is not None:
+        query = query.where(_after(after, source))
+    if upto is not None:
+        query = query.where(_upto(upto, source))
+    if product_id:
+        query = query.where(source.product_id == product_id)
+    if location_id:
+        query = query.where(or_(
+            source.from_location == location_id,
+            source.to_location == location_id,
+        ))
+    return query
+
+
+def balances_query():
+    return (
+        select(ProductBalance.product_id, ProductBalance.location_id, ProductBalance.balance,
+               ProductBalance.last_updated)
+        .where(ProductBalance.balance != 0)
+        .order_by(ProductBalance.product_id, ProductBalance.location_id)
+    )
+
+
+def location_summary_query():
+    nonzero = ProductBalance.balance != 0
+    return (
+        select(
+            Location.location_id,
+            Location.name,
+            func.count(case((nonzero, 1))).label('products_in_stock'),
+            func.coalesce(func.sum(case((nonzero, ProductBalance.balance), else_=0)), 0).label('total_units'),
+        )
+        .outerjoin(ProductBalance, ProductBalance.location_id == Location.location_id)
+        .group_by(Location.location_id, Location.name)
+        .order_by(Location.location_id)
+    )
+
+
+def newest_movement(settle=None):
+    """(recorded_at, movement_id) of the newest movement recorded at least
+    `settle` seconds ago, or None"""
+    if settle is None:
+        settle = current_app.config.get('EXPORT_SETTLE_SECONDS', EXPORT_SETTLE_SECONDS)
+    cutoff = datetime.utcnow() - timedelta(seconds=settle)
+    newest = None
+    for source, bounds in partitions():
+        row = db.session.execute(
+            select(source.recorded_at, source.movement_id)
+            .where(source.recorded_at <= cutoff, *bounds)
+            .order_by(source.recorded_at.desc(), source.movement_id.desc())
+            .limit(1)
+        ).first()
+        if row and (newest is None or tuple(row) > newest):
+            newest = tuple(row)
+    return newest
+
+
+def prepare(dataset, since=None, until=None, after=None, product_id=None, location_id=None):
+    """Return (query, next_cursor) for `dataset`.
+
+    Only movement exports are incremental and filterable; `next_cursor` is
+    None otherwise. A movement export's query is a list with one query per
+    table it has to read, oldest first.
+    """
+    if dataset == 'movements':
+        upto = newest_movement()
+        if upto is None or (after is not None and upto <= after):
+            # nothing new has settled: export nothing and hand the caller's cursor back
+            return [movements_query(source=ProductMovement).where(false())], encode_cursor(*after) if after else None
+        queries = [
+            movements_query(since=since, until=until, after=after, upto=upto, product_id=product_id,
+                            location_id=location_id, source=source).where(*bounds)
+            for source, bounds in partitions(since, until)
+        ]
+        return queries, encode_cursor(*upto)
+    if dataset == 'balances':
+        return balances_query(), None
+    if dataset == 'location_summary':
+        return location_summary_query(), None
+    raise ValueError(f"Unknown dataset: {dataset}")
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _encode_batches(columns, batches, fmt, on_batch):
+    if fmt.startswith('csv'):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        for batch in batches:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([['' if value is None else _value(value) for value in row] for row in batch])
+            on_batch(len(batch))
+            yield buffer.getvalue()
+    else:
+        for batch in batches:
+            on_batch(len(batch))
+            yield ''.join(json.dumps(dict(zip(columns, map(_value, row)))) + '\n' for row in batch)
+
+
+def _batches(queries, batch_size):
+    for query in queries:
+        result = db.session.execute(query.execution_options(stream_results=True, yield_per=batch_size))
+        try:
+            yield from result.partitions()
+        finally:
+            result.close()
+
+
+def stream(query, fmt='csv', batch_size=EXPORT_BATCH, on_batch=None):
+    """Yield the encoded export of `query` as bytes, one chunk per batch.
+
+    `query` may be a list of queries with the same columns, read one after
+    the other. `on_batch(rows)` is called with the size of every batch read.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    queries = query if isinstance(query, list) else [query]
+    columns = list(queries[0].selected_columns.keys())
+    batches = _batches(queries, batch_size)
+    compressor = zlib.compressobj(wbits=31) if fmt.endswith('.gz') else None
+    try:
+        for text in _encode_batches(columns, batches, fmt, on_batch or (lambda rows: None)):
+            data = text.encode('utf-8')
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor is not None:
+            yield compressor.flush()
+    finally:
+        batches.close()
+
+
+def write_export(fh, dataset, fmt='csv', batch_size=EXPORT_BATCH, on_batch=None, **criteria):
+    """Write an export to the binary file `fh`; returns (rows, next_cursor).
+
+    `criteria` are passed to `prepare`; `on_batch(rows_written)` is called
+    after every batch.
+    """
+    query, next_cursor = prepare(dataset, **criteria)
+    rows = 0
+
+    def count(batch_rows):
+        nonlocal rows
+        rows += batch_rows
+        if on_batch:
+            on_batch(rows)
+
+    for chunk in stream(query, fmt, batch_size, on_batch=count):
+        fh.write(chunk)
+    return rows, next_cursor
@@ -1,19 +1,22 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, IntegerField, SelectField
-from wtforms.validators import DataRequired, Length, NumberRange
-from models import Product, Location
+from wtforms import Form, StringField, TextAreaField, IntegerField, SelectField, FieldList, FormField
+from wtforms.validators import DataRequired, Length, NumberRange, Optional
+from wtforms.widgets import HiddenInput
+from cache import cached_products, cached_locations
 
 
 class ProductForm(FlaskForm):
     product_id = StringField('Product ID', validators=[DataRequired(), Length(min=1, max=50)])
     name = StringField('Product Name', validators=[DataRequired(), Length(min=1, max=100)])
     description = TextAreaField('Description')
+    version = IntegerField(widget=HiddenInput(), validators=[Optional()])
 
 
 class LocationForm(FlaskForm):
     location_id = StringField('Location ID', validators=[DataRequired(), Length(min=1, max=50)])
     name = StringField('Location Name', validators=[DataRequired(), Length(min=1, max=100)])
     description = TextAreaField('Description')
+    version = IntegerField(widget=HiddenInput(), validators=[Optional()])
 
 
 class ProductMovementForm(FlaskForm):
@@ -22,13 +25,45 @@ class ProductMovementForm(FlaskForm):
     from_location = SelectField('From Location', choices=[], coerce=str)
     to_location = SelectField('To Location', choices=[], coerce=str)
     qty = IntegerField('Quantity', validators=[DataRequired(), NumberRange(min=1)])
+    version = IntegerField(widget=HiddenInput(), validators=[Optional()])
     
     def __init__(self, *args, **kwargs):
         super(ProductMovementForm, self).__init__(*args, **kwargs)
-        products = Product.query.all()
-        self.product_id.choices = [(p.product_id, f"{p.product_id} - {p.name}") for p in products]
+        products = cached_products()
+        self.product_id.choices = [(p['product_id'], f"{p['product_id']} - {p['name']}") for p in products]
         
-        locations = Location.query.all()
-        location_choices = [('', 'Select Location')] + [(l.location_id, f"{l.location_id} - {l.name}") for l in locations]
+        locations = cached_locations()
+        location_choices = [('', 'Select Location')] + [(l['location_id'], f"{l['location_id']} - {l['name']}") for l in locations]
         self.from_location.choices = location_choices
         self.to_location.choices = location_choices
+
+
+class TransferLineForm(Form):
+    product_id = SelectField('Product', choices=[], validate_choice=False)
+    qty = IntegerField('Quantity', validators=[Optional(), NumberRange(min=1)])
+
+
+class TransferOrderForm(FlaskForm):
+    transfer_id = StringField('Transfer ID', validators=[DataRequired(), Length(min=1, max=45)])
+    from_location = SelectField('From Location', choices=[], validators=[DataRequired()])
+    to_location = SelectField('To Location', choices=[], validators=[DataRequired()])
+    note = TextAreaField('Note')
+    lines = FieldList(FormField(TransferLineForm), min_entries=5, max_entries=1000)
+
+    def __init__(self, *args, **kwargs):
+        super(TransferOrderForm, self).__init__(*args, **kwargs)
+        product_choices = [('', 'Select Product')] + [
+            (p['product_id'], f"{p['product_id']} - {p['name']}") for p in cached_products()
+        ]
+        for line in self.lines:
+            line.product_id.choices = product_choices
+        location_choices = [('', 'Select Location')] + [
+            (l['location_id'], f"{l['location_id']} - {l['name']}") for l in cached_locations()
+        ]
+        self.from_location.choices = location_choices
+        self.to_location.choices = location_choices
+
+    def filled_lines(self):
+        """Lines with a product chosen, as dicts for `transfers.create_transfer`"""
+        return [{'product_id': line.product_id.data, 'qty': line.qty.data}
+                for line in self.lines if line.product_id.data]
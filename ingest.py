@@ -0,0 +1,247 @@
+import csv
+import io
+from datetime import datetime
+from sqlalchemy import select, insert, tuple_
+from database import db
+from models import Product, Location, ProductMovement, ProductBalance, ArchivedMovement
+from signals import movements_changed
+from ledger import frozen_before
+from utils import parse_timestamp
+
+CSV_FIELDS = ('movement_id', 'product_id', 'from_location', 'to_location', 'qty', 'timestamp')
+IN_CHUNK = 500
+
+
+class BatchError(ValueError):
+    """The request body could not be read as a batch of movements"""
+
+
+def parse_batch(body, content_type):
+    """Turn a JSON or CSV request body into a list of raw row dicts.
+
+    JSON may be a list of objects or an object with a `movements` list. CSV
+    must have a header row naming the columns in `CSV_FIELDS` (`timestamp`
+    is optional).
+    """
+    import json
+
+    if content_type and 'csv' in content_type:
+        try:
+            text = body.decode('utf-8-sig')
+        except UnicodeDecodeError as exc:
+            raise BatchError("CSV body must be UTF-8") from exc
+        reader = csv.DictReader(io.StringIO(text))
+        missing = {'movement_id', 'product_id', 'qty'} - set(reader.fieldnames or ())
+        if missing:
+            raise BatchError(f"CSV header is missing: {', '.join(sorted(missing))}")
+        return [dict(row) for row in reader]
+
+    try:
+        payload = json.loads(body or b'null')
+    except ValueError as exc:
+        raise BatchError(f"Invalid JSON: {exc}") from exc
+    if isinstance(payload, dict):
+        payload = payload.get('movements')
+    if not isinstance(payload, list) or not all(isinstance(row, dict) for row in payload):
+        raise BatchError("Expected a list of movement objects or {\"movements\": [...]}")
+    return payload
+
+
+def _whole_number(value):
+    """`value` as an int if it is one or is written as one (digits, optionally signed), else None.
+
+    Floats and booleans are refused rather than truncated: JSON `2.7` or
+    `true` is a client error, not 2 or 1.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        digits = value.strip()
+        if digits[:1] in ('+', '-'):
+            digits = digits[1:]
+        if digits.isdigit() and digits.isascii():
+            return int(value)
+    return None
+
+
+def clean_row(raw):
+    """Normalise one raw row; returns (row, errors)"""
+    errors = []
+
+    def text(field):
+        value = raw.get(field)
+        if value is None:
+            return None
+        value = str(value).strip()
+        return value or None
+
+    row = {
+        'movement_id': text('movement_id'),
+        'product_id': text('product_id'),
+        'from_location': text('from_location'),
+        'to_location': text('to_location'),
+    }
+
+    for field in ('movement_id', 'product_id'):
+        if not row[field]:
+            errors.append(f"{field} is required")
+        elif len(row[field]) > 50:
+            errors.append(f"{field} must be at most 50 characters")
+
+    if not row['from_location'] and not row['to_location']:
+        errors.append("At least one location (From or To) must be specified")
+
+    row['qty'] = _whole_number(raw.get('qty'))
+    if row['qty'] is None:
+        errors.append("qty must be an integer")
+    elif row['qty'] <= 0:
+        errors.append("Quantity must be positive")
+
+    try:
+        row['timestamp'] = parse_timestamp(text('timestamp'))
+    except ValueError as exc:
+        errors.append(str(exc))
+
+    return row, errors
+
+
+def _in_chunks(column, values):
+    values = list(values)
+    for start in range(0, len(values), IN_CHUNK):
+        yield column.in_(values[start:start + IN_CHUNK])
+
+
+def _existing(column, values):
+    found = set()
+    for criterion in _in_chunks(column, values):
+        found.update(db.session.execute(select(column).where(criterion)).scalars())
+    return found
+
+
+def _current_balances(keys):
+    balances = {}
+    keys = list(keys)
+    for start in range(0, len(keys), IN_CHUNK):
+        chunk = keys[start:start + IN_CHUNK]
+        balances.update(
+            ((product_id, location_id), balance)
+            for product_id, location_id, balance in db.session.execute(
+                select(ProductBalance.product_id, ProductBalance.location_id, ProductBalance.balance)
+                .where(tuple_(ProductBalance.product_id, ProductBalance.location_id).in_(chunk))
+            )
+        )
+    return balances
+
+
+def validate_batch(raw_rows):
+    """Validate a batch in memory against the current balances.
+
+    Rows are checked in order: an outbound row may consume stock received by
+    an earlier row of the same batch, and a rejected row has no effect on the
+    rows after it. Returns (accepted rows, per-row errors, net balance deltas).
+    """
+    cleaned = [clean_row(raw) for raw in raw_rows]
+
+    movement_ids = {row['movement_id'] for row, _ in cleaned if row['movement_id']}
+    product_ids = {row['product_id'] for row, _ in cleaned if row['product_id']}
+    location_ids = {loc for row, _ in cleaned for loc in (row['from_location'], row['to_location']) if loc}
+    keys = {
+        (row['product_id'], loc)
+        for row, _ in cleaned
+        for loc in (row['from_location'], row['to_location'])
+        if row['product_id'] and loc
+    }
+
+    taken_ids = _existing(ProductMovement.movement_id, movement_ids)
+    taken_ids |= _existing(ArchivedMovement.movement_id, movement_ids)
+    frozen = frozen_before()
+    known_products = _existing(Product.product_id, product_ids)
+    known_locations = _existing(Location.location_id, location_ids)
+    running = _current_balances(keys)
+
+    accepted, errors, deltas = [], [], {}
+    for index, (row, row_errors) in enumerate(cleaned):
+        if not row_errors:
+            if row['movement_id'] in taken_ids:
+                row_errors.append("Movement ID already exists")
+            if frozen is not None and row['timestamp'] is not None and row['timestamp'] < frozen:
+                row_errors.append(f"Timestamp is before the archive boundary ({frozen.isoformat()})")
+            if row['product_id'] not in known_products:
+                row_errors.append(f"Unknown product: {row['product_id']}")
+            for loc in (row['from_location'], row['to_location']):
+                if loc and loc not in known_locations:
+                    row_errors.append(f"Unknown location: {loc}")
+
+        if not row_errors and row['from_location']:
+            key = (row['product_id'], row['from_location'])
+            available = running.get(key, 0)
+            if available < row['qty']:
+                row_errors.append(
+                    f"Insufficient stock at {row['from_location']}. Available: {available}, Requested: {row['qty']}"
+                )
+
+        if row_errors:
+            errors.append({'row': index, 'movement_id': row['movement_id'], 'errors': row_errors})
+            continue
+
+        taken_ids.add(row['movement_id'])
+        if row['from_location']:
+            key = (row['product_id'], row['from_location'])
+            running[key] = running.get(key, 0) - row['qty']
+            deltas[key] = deltas.get(key, 0) - row['qty']
+        if row['to_location']:
+            key = (row['product_id'], row['to_location'])
+            running[key] = running.get(key, 0) + row['qty']
+            deltas[key] = deltas.get(key, 0) + row['qty']
+        accepted.append(row)
+
+    return accepted, errors, deltas
+
+
+def ingest_movements(raw_rows, allow_partial=False):
+    """Validate and store a batch of movements in a single transaction.
+
+    Unless `allow_partial` is set, any rejected row rejects the whole batch.
+    Returns a result dict with `accepted`, `rejected` and per-row `errors`.
+    """
+    accepted, errors, deltas = validate_batch(raw_rows)
+
+    if errors and not allow_partial:
+        db.session.rollback()
+        return {'accepted': 0, 'rejected': len(raw_rows), 'errors': errors}
+
+    if accepted:
+        conflicts = store_batch(accepted, deltas)
+        if conflicts:
+            db.session.rollback()
+            return {'accepted': 0, 'rejected': len(raw_rows), 'errors': [], 'conflicts': conflicts}
+    db.session.commit()
+
+    return {'accepted': len(accepted), 'rejected': len(errors), 'errors': errors}
+
+
+def store_batch(accepted, deltas):
+    """Insert validated rows and apply their net balance deltas; caller commits.
+
+    Returns a list of oversold balances if a concurrent writer took the same
+    stock after validation, in which case the caller must roll back.
+    """
+    now = datetime.utcnow()
+    for row in accepted:
+        if row['timestamp'] is None:
+            row['timestamp'] = now
+    db.session.execute(insert(ProductMovement), accepted)
+    ProductBalance.apply_deltas(deltas)
+    movements_changed.send(ProductMovement, added=accepted)
+
+    # Validation ran against a snapshot; a concurrent writer may have
+    # taken the same stock since. Any drawn-down balance that ended up
+    # negative means the batch lost that race.
+    drawn = [key for key, change in deltas.items() if change < 0]
+    oversold = {key: balance for key, balance in _current_balances(drawn).items() if balance < 0}
+    return [
+        {'product_id': product_id, 'location_id': location_id, 'balance': balance}
+        for (product_id, location_id), balance in sorted(oversold.items())
+    ]
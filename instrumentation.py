@@ -0,0 +1,213 @@
+"""Opt-in per-request SQL, template and latency instrumentation.
+
+Enabled with ``INSTRUMENTATION_ENABLED``. For every request it records the
+number of SQL statements, their total time, the slowest statements, template
+render time and total latency, and then:
+
+* adds ``X-Request-Time``, ``X-SQL-Count``, ``X-SQL-Time``,
+  ``X-SQL-Slowest`` and ``X-Template-Time`` response headers (milliseconds);
+* aggregates per-endpoint counters and a latency histogram served at
+  ``/metrics`` in Prometheus text format;
+* logs a warning when one statement is executed at least
+  ``INSTRUMENTATION_N_PLUS_ONE_THRESHOLD`` times in a request (a lazy
+  relationship fired in a loop), and logs the slowest statements of requests
+  slower than ``INSTRUMENTATION_SLOW_REQUEST_MS``.
+"""
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import g, has_request_context, request, Response, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements = Counter()
+        self.slowest = []
+        self.template_time = 0.0
+        self._template_started = None
+
+    def record_statement(self, statement, elapsed, keep):
+        self.sql_count += 1
+        self.sql_time += elapsed
+        self.statements[statement] += 1
+        self.slowest.append((elapsed, statement))
+        self.slowest.sort(key=lambda item: item[0], reverse=True)
+        del self.slowest[keep:]
+
+
+class Metrics:
+    """Thread-safe in-process counters rendered in Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.request_seconds = defaultdict(float)
+        self.sql_statements = Counter()
+        self.sql_seconds = defaultdict(float)
+        self.template_seconds = defaultdict(float)
+        self.n_plus_one = Counter()
+        self.latency_buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.gauges = {}
+
+    def observe(self, endpoint, method, status, stats, elapsed, repeated):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.request_seconds[endpoint] += elapsed
+            self.sql_statements[endpoint] += stats.sql_count
+            self.sql_seconds[endpoint] += stats.sql_time
+            self.template_seconds[endpoint] += stats.template_time
+            if repeated:
+                self.n_plus_one[endpoint] += 1
+            buckets = self.latency_buckets[endpoint]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    buckets[index] += 1
+
+    def register_gauge(self, name, help_text, callback):
+        """Expose `callback()` as a gauge on every scrape"""
+        self.gauges[name] = (help_text, callback)
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            family('inventory_http_requests_total', 'counter', 'HTTP requests handled.')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'inventory_http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}'
+                )
+
+            family('inventory_http_request_duration_seconds', 'histogram', 'Request latency.')
+            for endpoint, buckets in sorted(self.latency_buckets.items()):
+                total = sum(count for (name, _, _), count in self.requests.items() if name == endpoint)
+                for bound, count in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(
+                        f'inventory_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}'
+                    )
+                lines.append(f'inventory_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {total}')
+                lines.append(f'inventory_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} '
+                             f'{self.request_seconds[endpoint]:.6f}')
+                lines.append(f'inventory_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {total}')
+
+            for name, kind, help_text, values, fmt in (
+                ('inventory_sql_statements_total', 'counter', 'SQL statements executed.', self.sql_statements, '{}'),
+                ('inventory_sql_duration_seconds_total', 'counter', 'Time spent in SQL.', self.sql_seconds, '{:.6f}'),
+                ('inventory_template_render_seconds_total', 'counter', 'Time spent rendering templates.',
+                 self.template_seconds, '{:.6f}'),
+                ('inventory_n_plus_one_requests_total', 'counter', 'Requests with repeated identical statements.',
+                 self.n_plus_one, '{}'),
+            ):
+                family(name, kind, help_text)
+                for endpoint, value in sorted(values.items()):
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {fmt.format(value)}')
+
+        for name, (help_text, callback) in sorted(self.gauges.items()):
+            family(name, 'gauge', help_text)
+            lines.append(f"{name} {callback()}")
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def _current_stats():
+    if has_request_context():
+        return g.get('_instrumentation')
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's own execution context: a statement that raises
+    # never reaches after_cursor_execute, and its start time goes with it
+    if context is not None and _current_stats() is not None:
+        context._instrumentation_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats()
+    started = getattr(context, '_instrumentation_started', None)
+    if stats is None or started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats.record_statement(statement, elapsed, g.get('_instrumentation_keep', 3))
+
+
+def init_instrumentation(app):
+    if not app.config.get('INSTRUMENTATION_ENABLED'):
+        return
+
+    app.config.setdefault('INSTRUMENTATION_SLOWEST_STATEMENTS', 3)
+    app.config.setdefault('INSTRUMENTATION_N_PLUS_ONE_THRESHOLD', 10)
+    app.config.setdefault('INSTRUMENTATION_SLOW_REQUEST_MS', 500)
+    app.extensions['instrumentation'] = metrics
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def _start_request():
+        g._instrumentation = RequestStats()
+        g._instrumentation_keep = app.config['INSTRUMENTATION_SLOWEST_STATEMENTS']
+
+    def _template_started(sender, template, context, **extra):
+        stats = _current_stats()
+        if stats is not None:
+            stats._template_started = time.perf_counter()
+
+    def _template_finished(sender, template, context, **extra):
+        stats = _current_stats()
+        if stats is not None and stats._template_started is not None:
+            stats.template_time += time.perf_counter() - stats._template_started
+            stats._template_started = None
+
+    before_render_template.connect(_template_started, app, weak=False)
+    template_rendered.connect(_template_finished, app, weak=False)
+
+    @app.after_request
+    def _finish_request(response):
+        stats = _current_stats()
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+
+        threshold = app.config['INSTRUMENTATION_N_PLUS_ONE_THRESHOLD']
+        repeated = [(statement, count) for statement, count in stats.statements.items() if count >= threshold]
+        for statement, count in repeated:
+            logger.warning("Possible N+1 in %s: statement executed %d times: %s",
+                           endpoint, count, ' '.join(statement.split())[:300])
+
+        if elapsed * 1000 >= app.config['INSTRUMENTATION_SLOW_REQUEST_MS']:
+            for seconds, statement in stats.slowest:
+                logger.warning("Slow request %s (%.1fms): %.1fms in %s",
+                               endpoint, elapsed * 1000, seconds * 1000, ' '.join(statement.split())[:300])
+
+        response.headers['X-Request-Time'] = f"{elapsed * 1000:.2f}"
+        response.headers['X-SQL-Count'] = str(stats.sql_count)
+        response.headers['X-SQL-Time'] = f"{stats.sql_time * 1000:.2f}"
+        response.headers['X-SQL-Slowest'] = f"{stats.slowest[0][0] * 1000:.2f}" if stats.slowest else "0"
+        response.headers['X-Template-Time'] = f"{stats.template_time * 1000:.2f}"
+
+        if endpoint != 'metrics':
+            metrics.observe(endpoint, request.method, response.status_code, stats, elapsed, bool(repeated))
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
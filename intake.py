@@ -0,0 +1,464 @@
+"""Write-ahead intake queue: acknowledge movement bursts first, commit them in groups.
+
+With ``INTAKE_ENABLED`` a movement posted to ``/api/intake/movements`` (or
+the movement form) is checked for shape only, appended to a local SQLite
+file in WAL mode (``INTAKE_QUEUE_PATH``, fsynced per append with
+``INTAKE_SYNCHRONOUS=FULL``) and acknowledged. A committer thread drains
+the queue in order, up to ``INTAKE_BATCH_SIZE`` rows at a time: each group
+is validated like a bulk import (`ingest.validate_batch`), inserted with
+the net balance delta per (product, location) applied once, and committed
+as one transaction -- one database commit for the whole group instead of
+one per movement. Rows that fail validation (unknown ids, insufficient
+stock, ...) are kept in the queue as ``rejected`` with their errors.
+
+Replay: every queue file has a `queue_id`, and the main database keeps the
+last applied sequence number per queue (`IntakeState`), advanced in the
+same transaction as the group. After a crash, rows up to it are known to
+be applied and are dropped; everything after it is committed again.
+
+Exactly one committer runs per queue file, elected with `single_runner`;
+other processes sharing the file only append. ``INTAKE_COMMITTER`` is
+``thread`` (start one in the first request of each process) or
+``external`` (only ``flask intake drain --follow`` commits).
+
+Read-your-writes: `balance_with_pending` ends the session's transaction,
+takes the pending rows for a balance from the queue, then reads the
+committed balance and the applied high-water mark in one new snapshot,
+and adds the rows above that mark, so a group committed in between is
+counted exactly once. Rows can still be rejected when committed, so the
+overlay is a forecast.
+
+Queued rows keep the `timestamp` they were given when enqueued, so they
+reach the database back-dated by the queueing delay. Snapshots are taken
+a settle time in the past and recomputed after commit for rows older than
+that (`snapshots.correct_snapshots`), and incremental exports follow
+`recorded_at`, which is stamped when the committer inserts them, so
+neither misses a queued row.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select
+from database import db
+from models import ProductMovement, ArchivedMovement, ProductBalance, IntakeState
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+IDLE_POLL = 1.0
+LOCK_RETRY = 5.0
+ERROR_BACKOFF = 1.0
+IN_CHUNK = 500
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+RESTART_ERROR = 'Rejected when committed; the reason was lost in a restart'
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS intake ("
+    " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " movement_id TEXT NOT NULL UNIQUE,"
+    " product_id TEXT NOT NULL,"
+    " from_location TEXT,"
+    " to_location TEXT,"
+    " qty INTEGER NOT NULL,"
+    " timestamp TEXT NOT NULL,"
+    " enqueued_at REAL NOT NULL,"
+    " status TEXT NOT NULL DEFAULT 'pending',"
+    " errors TEXT)",
+    "CREATE INDEX IF NOT EXISTS ix_intake_status_seq ON intake (status, seq)",
+    "CREATE INDEX IF NOT EXISTS ix_intake_product_status ON intake (product_id, status)",
+)
+
+
+class IntakeRejected(ValueError):
+    """Rows refused before queueing; `errors` are per-row, as from a bulk import"""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} rows rejected")
+        self.errors = errors
+
+
+class IntakeQueue:
+    """Durable, ordered queue of movement rows in a local SQLite file"""
+
+    def __init__(self, path, synchronous='FULL'):
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f"INTAKE_SYNCHRONOUS must be one of {', '.join(SYNCHRONOUS_MODES)}")
+        self.path = path
+        self.synchronous = synchronous.upper()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._write() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('queue_id', ?)",
+                               (str(uuid.uuid4()),))
+        self.queue_id = self._connection().execute("SELECT value FROM meta WHERE key = 'queue_id'").fetchone()[0]
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _write(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def append(self, rows):
+        """Queue cleaned rows in one local transaction; returns (first seq, last seq).
+
+        Raises `IntakeRejected` if a movement id is already queued; a
+        rejected row with the same id is replaced.
+        """
+        now = time.time()
+        ids = [row['movement_id'] for row in rows]
+        with self._write() as connection:
+            taken = set()
+            for start in range(0, len(ids), IN_CHUNK):
+                chunk = ids[start:start + IN_CHUNK]
+                marks = ','.join('?' * len(chunk))
+                # a rejected row may be sent again, e.g. once stock has arrived
+                connection.execute(f"DELETE FROM intake WHERE status = 'rejected' AND movement_id IN ({marks})", chunk)
+                taken.update(value for (value,) in connection.execute(
+                    f"SELECT movement_id FROM intake WHERE movement_id IN ({marks})", chunk))
+            seen = set()
+            errors = []
+            for index, movement_id in enumerate(ids):
+                if movement_id in taken or movement_id in seen:
+                    errors.append({'row': index, 'movement_id': movement_id, 'errors': ["Movement ID already queued"]})
+                seen.add(movement_id)
+            if errors:
+                raise IntakeRejected(errors)
+            connection.executemany(
+                "INSERT INTO intake (movement_id, product_id, from_location, to_location, qty, timestamp, enqueued_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(row['movement_id'], row['product_id'], row['from_location'], row['to_location'], row['qty'],
+                  row['timestamp'].isoformat(), now) for row in rows],
+            )
+            last = connection.execute("SELECT last_insert_rowid()").fetchone()[0]
+        return last - len(rows) + 1, last
+
+    def pending(self, limit, through=None):
+        """Oldest pending rows, optionally only those with seq <= `through`"""
+        query = "SELECT * FROM intake WHERE status = 'pending'"
+        params = []
+        if through is not None:
+            query += " AND seq <= ?"
+            params.append(through)
+        return self._connection().execute(query + " ORDER BY seq LIMIT ?", params + [limit]).fetchall()
+
+    def finish(self, through, rejected):
+        """Drop pending rows up to `through` and keep `rejected` ({seq: errors}) with their errors"""
+        with self._write() as connection:
+            connection.executemany("UPDATE intake SET status = 'rejected', errors = ? WHERE seq = ?",
+                                   [(json.dumps(errors), seq) for seq, errors in rejected.items()])
+            connection.execute("DELETE FROM intake WHERE status = 'pending' AND seq <= ?", (through,))
+
+    def depth(self):
+        return self._connection().execute("SELECT COUNT(*) FROM intake WHERE status = 'pending'").fetchone()[0]
+
+    def oldest_age(self):
+        """Seconds the oldest pending row has waited, 0 when the queue is empty"""
+        oldest = self._connection().execute(
+            "SELECT MIN(enqueued_at) FROM intake WHERE status = 'pending'").fetchone()[0]
+        return max(time.time() - oldest, 0.0) if oldest is not None else 0.0
+
+    def pending_deltas(self, product_id, location_id):
+        """(seq, net qty in or out of one balance) for every pending row that touches it"""
+        return self._connection().execute(
+            "SELECT seq, (CASE WHEN to_location = :loc THEN qty ELSE 0 END)"
+            " - (CASE WHEN from_location = :loc THEN qty ELSE 0 END)"
+            " FROM intake WHERE product_id = :product AND status = 'pending'"
+            " AND (from_location = :loc OR to_location = :loc)",
+            {'product': product_id, 'loc': location_id},
+        ).fetchall()
+
+    def lookup(self, movement_id):
+        return self._connection().execute("SELECT * FROM intake WHERE movement_id = ?", (movement_id,)).fetchone()
+
+    def rejected(self, limit=100):
+        return self._connection().execute(
+            "SELECT * FROM intake WHERE status = 'rejected' ORDER BY seq DESC LIMIT ?", (limit,)).fetchall()
+
+    def counts(self):
+        return dict(self._connection().execute("SELECT status, COUNT(*) FROM intake GROUP BY status").fetchall())
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def _raw(row):
+    return {
+        'movement_id': row['movement_id'],
+        'product_id': row['product_id'],
+        'from_location': row['from_location'],
+        'to_location': row['to_location'],
+        'qty': row['qty'],
+        'timestamp': row['timestamp'],
+    }
+
+
+def _state(queue_id):
+    state = db.session.get(IntakeState, queue_id)
+    if state is None:
+        state = IntakeState(queue_id=queue_id, applied_seq=0, batches=0)
+        db.session.add(state)
+    return state
+
+
+def applied_seq(queue_id):
+    return db.session.execute(
+        select(IntakeState.applied_seq).where(IntakeState.queue_id == queue_id)).scalar() or 0
+
+
+class IntakeCommitter:
+    """Drains an `IntakeQueue` into the ledger in group commits"""
+
+    def __init__(self, app, queue):
+        self.app = app
+        self.queue = queue
+        self.wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {'leader': False, 'batches': 0, 'applied': 0, 'rejected': 0, 'last_batch': 0,
+                      'last_commit_ms': 0.0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='intake-committer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self.wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        from locks import single_runner, LockTimeout
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    with single_runner(f"intake-{self.queue.queue_id}", timeout=0):
+                        self.stats['leader'] = True
+                        self.follow(self._stop)
+                except LockTimeout:
+                    self._stop.wait(LOCK_RETRY)
+                except Exception:
+                    db.session.rollback()
+                    logger.exception("Intake committer failed; retrying")
+                    self._stop.wait(ERROR_BACKOFF)
+                finally:
+                    self.stats['leader'] = False
+            db.session.remove()
+            self.queue.close()
+
+    def follow(self, stop):
+        """Replay, then commit groups as rows arrive until `stop` is set; caller holds the queue's lock"""
+        self.recover()
+        batch_size = self.app.config['INTAKE_BATCH_SIZE']
+        linger = self.app.config['INTAKE_LINGER']
+        while not stop.is_set():
+            if self.drain_once() < batch_size:
+                self.wake.wait(IDLE_POLL)
+                self.wake.clear()
+                if linger:
+                    time.sleep(linger)  # let a burst gather into one group
+
+    def recover(self):
+        """Settle rows left pending by a crash between the ledger commit and the queue update"""
+        through = applied_seq(self.queue.queue_id)
+        db.session.rollback()
+        settled = 0
+        while True:
+            rows = self.queue.pending(limit=self.app.config['INTAKE_BATCH_SIZE'], through=through)
+            if not rows:
+                break
+            ids = [row['movement_id'] for row in rows]
+            stored = set()
+            for source in (ProductMovement, ArchivedMovement):
+                for start in range(0, len(ids), IN_CHUNK):
+                    stored.update(db.session.execute(
+                        select(source.movement_id).where(source.movement_id.in_(ids[start:start + IN_CHUNK]))
+                    ).scalars())
+            db.session.rollback()
+            self.queue.finish(rows[-1]['seq'],
+                              {row['seq']: [RESTART_ERROR] for row in rows if row['movement_id'] not in stored})
+            settled += len(rows)
+        if settled:
+            logger.info("Intake replay: %d rows up to seq %d had already been committed", settled, through)
+        return settled
+
+    def drain_once(self):
+        """Commit the next group of queued rows; returns how many rows it settled"""
+        from ingest import validate_batch, store_batch
+        rows = self.queue.pending(limit=self.app.config['INTAKE_BATCH_SIZE'])
+        if not rows:
+            return 0
+        started = time.perf_counter()
+        accepted, errors, deltas = validate_batch([_raw(row) for row in rows])
+        if accepted and store_batch(accepted, deltas):
+            # a writer outside the queue took the stock after validation; retry with fresh balances
+            db.session.rollback()
+            return len(rows)
+        state = _state(self.queue.queue_id)
+        state.applied_seq = rows[-1]['seq']
+        state.batches += 1
+        state.updated_at = datetime.utcnow()
+        db.session.commit()
+
+        rejected = {rows[error['row']]['seq']: error['errors'] for error in errors}
+        self.queue.finish(rows[-1]['seq'], rejected)
+        self.stats.update(batches=self.stats['batches'] + 1, applied=self.stats['applied'] + len(accepted),
+                          rejected=self.stats['rejected'] + len(rejected), last_batch=len(rows),
+                          last_commit_ms=round((time.perf_counter() - started) * 1000, 2))
+        return len(rows)
+
+    def drain(self):
+        """Replay and commit until the queue is empty; returns rows settled"""
+        total = self.recover()
+        while True:
+            settled = self.drain_once()
+            if not settled:
+                return total
+            total += settled
+
+
+class Intake:
+    def __init__(self, app):
+        self.queue = IntakeQueue(app.config['INTAKE_QUEUE_PATH'], app.config['INTAKE_SYNCHRONOUS'])
+        self.committer = IntakeCommitter(app, self.queue)
+
+
+def init_intake(app):
+    app.config.setdefault('INTAKE_ENABLED', os.environ.get('INTAKE_ENABLED', '').lower() in ('1', 'true', 'yes'))
+    app.config.setdefault('INTAKE_QUEUE_PATH', os.environ.get('INTAKE_QUEUE_PATH')
+                          or os.path.join(app.instance_path, 'intake-queue.db'))
+    app.config.setdefault('INTAKE_SYNCHRONOUS', os.environ.get('INTAKE_SYNCHRONOUS') or 'FULL')
+    app.config.setdefault('INTAKE_COMMITTER', os.environ.get('INTAKE_COMMITTER') or 'thread')
+    app.config.setdefault('INTAKE_BATCH_SIZE', BATCH_SIZE)
+    app.config.setdefault('INTAKE_LINGER', 0.002)
+    app.config.setdefault('INTAKE_READ_YOUR_WRITES', False)
+    if not app.config['INTAKE_ENABLED']:
+        return
+
+    intake = Intake(app)
+    app.extensions['intake'] = intake
+
+    from instrumentation import metrics
+    metrics.register_gauge('inventory_intake_queue_depth', 'Movements queued and not yet committed.',
+                           intake.queue.depth)
+    metrics.register_gauge('inventory_intake_oldest_pending_seconds', 'Age of the oldest queued movement.',
+                           lambda: f"{intake.queue.oldest_age():.3f}")
+
+    if app.config['INTAKE_COMMITTER'] == 'thread':
+        @app.before_request
+        def _start_committer():
+            if not intake.committer.running:
+                intake.committer.start()
+
+
+def get_intake():
+    """The app's `Intake`, or None when intake mode is off"""
+    return current_app.extensions.get('intake')
+
+
+def enqueue(raw_rows):
+    """Shape-check raw movement rows and queue them durably; returns the acknowledgement.
+
+    Stock and reference checks happen when the rows are committed. Raises
+    `IntakeRejected` if any row is malformed or already queued; nothing is
+    queued then. Rows without a timestamp are stamped now, when the
+    movement happened, not when the committer stores it.
+    """
+    from ingest import clean_row
+    intake = get_intake()
+    now = datetime.utcnow()
+    rows, errors = [], []
+    for index, raw in enumerate(raw_rows):
+        row, row_errors = clean_row(raw)
+        if row_errors:
+            errors.append({'row': index, 'movement_id': row['movement_id'], 'errors': row_errors})
+        row['timestamp'] = row.get('timestamp') or now
+        rows.append(row)
+    if errors:
+        raise IntakeRejected(errors)
+    first, last = intake.queue.append(rows)
+    intake.committer.wake.set()
+    return {'queued': len(rows), 'first_seq': first, 'last_seq': last}
+
+
+def balance_with_pending(product_id, location_id):
+    """(committed balance, net qty of rows still queued) for one product at one location.
+
+    Ends the session's transaction: the balance read has to see everything
+    committed before the queue read, which an older snapshot (REPEATABLE
+    READ, e.g. after the route looked up the product) would not.
+    """
+    intake = get_intake()
+    db.session.rollback()
+    # pending rows first: a group committed (and removed from the queue)
+    # after this read is then already covered by the balance read below
+    pending = intake.queue.pending_deltas(product_id, location_id)
+    committed, through = db.session.execute(select(
+        select(ProductBalance.balance).where(ProductBalance.product_id == product_id,
+                                             ProductBalance.location_id == location_id).scalar_subquery(),
+        select(IntakeState.applied_seq).where(IntakeState.queue_id == intake.queue.queue_id).scalar_subquery(),
+    )).one()
+    return committed or 0, sum(delta for seq, delta in pending if seq > (through or 0))
+
+
+def intake_status(movement_id):
+    """Where a queued movement stands: pending, rejected (with errors), applied, or None if unknown"""
+    row = get_intake().queue.lookup(movement_id)
+    if row is not None and row['status'] == 'rejected':
+        return {'movement_id': movement_id, 'status': 'rejected', 'errors': json.loads(row['errors'] or '[]')}
+    if row is not None and row['seq'] > applied_seq(get_intake().queue.queue_id):
+        return {'movement_id': movement_id, 'status': 'pending', 'seq': row['seq']}
+    stored = db.session.get(ProductMovement, movement_id) or db.session.get(ArchivedMovement, movement_id)
+    if stored is not None:
+        return {'movement_id': movement_id, 'status': 'applied'}
+    return None
+
+
+def intake_stats():
+    intake = get_intake()
+    counts = intake.queue.counts()
+    return {
+        'queue_id': intake.queue.queue_id,
+        'depth': counts.get('pending', 0),
+        'rejected': counts.get('rejected', 0),
+        'oldest_pending_seconds': round(intake.queue.oldest_age(), 3),
+        'applied_seq': applied_seq(intake.queue.queue_id),
+        'committer': dict(intake.committer.stats, running=intake.committer.running),
+    }
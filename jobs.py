@@ -0,0 +1,325 @@
+"""In-process background jobs with a persistent status table.
+
+Every job is a row in `jobs`. The runner executes it on a thread pool inside
+its own application context and records status, progress and a JSON result
+that clients poll at `/api/jobs/<id>`, so long maintenance work never ties
+up a request worker or blocks startup. Handlers are registered per kind with
+`@job_handler(kind)` and are called as `handler(params, progress)`, where
+`progress(percent, message=None)` is written on its own connection.
+
+``JOBS_EXECUTOR`` selects ``thread`` (default) or ``inline`` (run in the
+submitting thread, e.g. from the CLI); ``JOBS_MAX_WORKERS`` sizes the pool
+and ``JOBS_DIR`` holds import uploads and export files.
+
+While a process holds a queued or running job it refreshes the job's
+`heartbeat_at` every ``JOBS_HEARTBEAT_INTERVAL`` seconds. A job whose
+heartbeat is older than ``JOBS_ORPHAN_TIMEOUT`` belonged to a worker that
+crashed or was killed; `expire_orphans` marks it failed, which happens
+before every submit so a lost rebuild never blocks the next one.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import SQLAlchemyError
+from database import db
+from models import Job, ProductMovement
+from pagination import estimated_count
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+ACTIVE_STATUSES = ('queued', 'running')
+MAX_RESULT_ERRORS = 1000
+PROGRESS_INTERVAL = 1.0
+ORPHAN_ERROR = 'The worker running this job stopped before it finished'
+
+
+def job_handler(kind):
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def _update(job_id, **values):
+    """Write job state outside the handler's own session and transaction"""
+    with db.engine.begin() as connection:
+        connection.execute(update(Job).where(Job.job_id == job_id).values(**values))
+
+
+class JobRunner:
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._held = set()
+        self._heartbeat = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_EXECUTOR', 'thread')
+        app.config.setdefault('JOBS_MAX_WORKERS', 2)
+        app.config.setdefault('JOBS_DIR', os.path.join(app.instance_path, 'jobs'))
+        app.config.setdefault('JOBS_HEARTBEAT_INTERVAL', 30)
+        app.config.setdefault('JOBS_ORPHAN_TIMEOUT', 300)
+        app.extensions['jobs'] = self
+        self.app = app
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.app.config['JOBS_MAX_WORKERS'], thread_name_prefix='job')
+            return self._executor
+
+    def _hold(self, job_id):
+        """Keep `job_id`'s heartbeat fresh until `_release`"""
+        with self._lock:
+            self._held.add(job_id)
+            if self._heartbeat is None or not self._heartbeat.is_alive():
+                self._heartbeat = threading.Thread(target=self._beat, name='job-heartbeat', daemon=True)
+                self._heartbeat.start()
+
+    def _release(self, job_id):
+        with self._lock:
+            self._held.discard(job_id)
+
+    def _beat(self):
+        interval = self.app.config['JOBS_HEARTBEAT_INTERVAL']
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as connection:
+                        connection.execute(update(Job).where(Job.job_id.in_(held))
+                                           .values(heartbeat_at=datetime.utcnow()))
+            except SQLAlchemyError:
+                # a missed beat is harmless; the timeout allows for several
+                logger.info("Could not record the heartbeat of %d job(s)", len(held))
+
+    def expire_orphans(self):
+        """Fail queued or running jobs whose worker stopped sending heartbeats"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['JOBS_ORPHAN_TIMEOUT'])
+        expired = db.session.execute(
+            update(Job)
+            .where(Job.status.in_(ACTIVE_STATUSES), func.coalesce(Job.heartbeat_at, Job.created_at) < cutoff)
+            .values(status='failed', error=ORPHAN_ERROR, finished_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if expired:
+            logger.warning("Marked %d orphaned job(s) failed", expired)
+        return expired
+
+    def submit(self, kind, params=None, unique=False):
+        """Queue a job of `kind` and return its row.
+
+        With `unique=True` an already queued or running job of the same kind
+        is returned instead of starting a second one.
+        """
+        if kind not in HANDLERS:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        self.expire_orphans()
+        if unique:
+            existing = db.session.execute(
+                select(Job).where(Job.kind == kind, Job.status.in_(ACTIVE_STATUSES))
+                .order_by(Job.created_at).limit(1)
+            ).scalar()
+            if existing is not None:
+                return existing
+
+        job = Job(job_id=str(uuid.uuid4()), kind=kind, status='queued', params=json.dumps(params or {}),
+                  heartbeat_at=datetime.utcnow())
+        db.session.add(job)
+        db.session.commit()
+        self._hold(job.job_id)
+
+        if self.app.config['JOBS_EXECUTOR'] == 'inline':
+            self._run(job.job_id)
+            db.session.refresh(job)
+        else:
+            self._pool().submit(self._run, job.job_id)
+        return job
+
+    def _run(self, job_id):
+        try:
+            self._execute(job_id)
+        finally:
+            self._release(job_id)
+
+    def _execute(self, job_id):
+        with self.app.app_context():
+            job = db.session.get(Job, job_id)
+            if job is None or job.status != 'queued':
+                return
+            kind, params = job.kind, json.loads(job.params or '{}')
+            db.session.close()
+
+            _update(job_id, status='running', started_at=datetime.utcnow(), heartbeat_at=datetime.utcnow(),
+                    worker=f"{socket.gethostname()}:{os.getpid()}")
+
+            last_progress = [0.0]
+
+            def progress(percent, message=None):
+                # advisory and throttled; SQLite, for one, refuses the write
+                # while a streaming read is open on another connection, so the
+                # first failure turns progress off for this job
+                now = time.monotonic()
+                if last_progress[0] is None or now - last_progress[0] < PROGRESS_INTERVAL:
+                    return
+                last_progress[0] = now
+                try:
+                    _update(job_id, progress=max(0, min(int(percent), 100)), message=message)
+                except SQLAlchemyError:
+                    last_progress[0] = None
+                    logger.info("Progress of job %s will not be recorded", job_id)
+
+            try:
+                result = HANDLERS[kind](params, progress)
+            except Exception as exc:
+                db.session.rollback()
+                logger.exception("Job %s (%s) failed", job_id, kind)
+                _update(job_id, status='failed', error=f"{type(exc).__name__}: {exc}",
+                        finished_at=datetime.utcnow())
+            else:
+                _update(job_id, status='succeeded', progress=100, result=json.dumps(result),
+                        finished_at=datetime.utcnow())
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+jobs = JobRunner()
+
+
+def get_job(job_id):
+    return db.session.get(Job, job_id)
+
+
+def recent_jobs(kind=None, status=None, limit=50):
+    query = select(Job).order_by(Job.created_at.desc()).limit(limit)
+    if kind:
+        query = query.where(Job.kind == kind)
+    if status:
+        query = query.where(Job.status == status)
+    return db.session.execute(query).scalars().all()
+
+
+def prune_jobs(older_than):
+    """Delete finished jobs created before `older_than` and their files"""
+    finished = select(Job).where(Job.created_at < older_than, Job.status.notin_(ACTIVE_STATUSES))
+    removed = 0
+    for job in db.session.execute(finished).scalars():
+        path = (json.loads(job.result) if job.result else {}).get('path')
+        if path and os.path.exists(path):
+            os.remove(path)
+        removed += 1
+    db.session.execute(delete(Job).where(Job.created_at < older_than, Job.status.notin_(ACTIVE_STATUSES)))
+    db.session.commit()
+    return removed
+
+
+def job_file(prefix, suffix):
+    directory = current_app.config['JOBS_DIR']
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{prefix}-{uuid.uuid4().hex}{suffix}")
+
+
+@job_handler('rebuild_balances')
+def run_rebuild(params, progress):
+    from locks import single_runner
+    from rebuild import rebuild_balances
+    with single_runner('rebuild-balances'):
+        written = rebuild_balances(chunk_size=params.get('chunk_size'), progress=progress)
+    return {'rows_written': written}
+
+
+@job_handler('reconcile_balances')
+def run_reconcile(params, progress):
+    from locks import single_runner
+    from reconcile import reconcile
+    with single_runner('rebuild-balances'):
+        return reconcile(full=bool(params.get('full')), repair=params.get('repair', True), progress=progress)
+
+
+@job_handler('backfill_rollups')
+def run_backfill_rollups(params, progress):
+    from locks import single_runner
+    from rollups import backfill
+    from utils import parse_timestamp
+    with single_runner('rollups-backfill'):
+        written = backfill(since=parse_timestamp(params.get('since')), until=parse_timestamp(params.get('until')),
+                           progress=progress)
+    return {'rows_written': written}
+
+
+@job_handler('reconcile_counters')
+def run_reconcile_counters(params, progress):
+    from counters import reconcile_counters
+    return {'drift': reconcile_counters()}
+
+
+@job_handler('export_movements')
+def run_export(params, progress):
+    """Write an export (movements by default) to a file in JOBS_DIR"""
+    from exports import FORMATS, write_export
+    from utils import decode_cursor, parse_timestamp
+
+    dataset = params.get('dataset', 'movements')
+    fmt = params.get('format', 'csv')
+    cursor = params.get('cursor')
+    expected = estimated_count(ProductMovement)[0] or 1
+    path = job_file(dataset, FORMATS[fmt][1])
+
+    def report(rows):
+        if dataset == 'movements':
+            progress(min(rows * 100 // expected, 99), f"{rows} rows written")
+
+    with open(path, 'wb') as fh:
+        rows, next_cursor = write_export(
+            fh, dataset, fmt,
+            since=parse_timestamp(params.get('since')),
+            until=parse_timestamp(params.get('until')),
+            after=decode_cursor(cursor) if cursor else None,
+            product_id=params.get('product_id'),
+            location_id=params.get('location_id'),
+            on_batch=report,
+        )
+    return {'path': path, 'rows': rows, 'next_cursor': next_cursor}
+
+
+@job_handler('import_movements')
+def run_import(params, progress):
+    """Ingest an uploaded batch file through the same path as /api/movements/bulk"""
+    from ingest import parse_batch, ingest_movements
+
+    path = params['path']
+    try:
+        with open(path, 'rb') as fh:
+            rows = parse_batch(fh.read(), params.get('content_type'))
+        progress(10, f"Parsed {len(rows)} rows")
+        result = ingest_movements(rows, allow_partial=params.get('allow_partial', False))
+    finally:
+        os.remove(path)
+
+    if len(result['errors']) > MAX_RESULT_ERRORS:
+        result['errors_truncated'] = len(result['errors'])
+        result['errors'] = result['errors'][:MAX_RESULT_ERRORS]
+    return result
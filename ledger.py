@@ -0,0 +1,287 @@
+"""Hot and archived movement history split at a time boundary.
+
+Movements older than the archive boundary live in
+`product_movements_archive`, a copy of `product_movements` without foreign
+keys (compressed on MySQL); everything at or after the boundary stays in
+`product_movements`. Because the split is by timestamp, a newest-first
+listing reads the hot table first and only reaches into the archive when
+a page runs past the boundary, and the recent history most reads want is
+served from a table that no longer grows with the years.
+
+At every boundary a checkpoint is kept: the net balance of all movements
+before it per (product, location). Current balances are the checkpoint
+plus the hot legs (`rebuild.ledger_legs`), so rebuilds and reconciles
+never read the archive and stay exact.
+
+`archive_movements` moves history in three steps:
+
+1. the run is recorded as ``copying``; from then on movements before its
+   boundary are frozen -- edits, deletes and back-dated imports are refused;
+2. rows are copied into the archive in keyset batches, each batch its own
+   transaction, then one transaction re-syncs rows changed meanwhile,
+   writes the new checkpoint and marks the run ``done``;
+3. the copied rows are deleted from the hot table in batches.
+
+Readers always bound the hot table below and the archive above by the
+boundary of the last finished run, so rows never show up twice or go
+missing while a run is in progress or after it was interrupted; running
+the command again resumes an unfinished run.
+"""
+from datetime import datetime
+from sqlalchemy import select, insert, delete, func, literal, union_all, or_, and_, exists
+from database import db
+from models import ProductMovement, ArchivedMovement, LedgerArchive, LedgerCheckpoint
+
+ARCHIVE_BATCH = 5000
+COLUMNS = ('movement_id', 'timestamp', 'from_location', 'to_location', 'product_id', 'qty', 'version',
+           'transfer_id', 'line_no', 'recorded_at')
+
+
+class MovementArchived(Exception):
+    """The movement is older than the archive boundary and can no longer change"""
+
+    def __init__(self, boundary):
+        super().__init__(f"Movements before {boundary.isoformat()} are archived and read-only")
+        self.boundary = boundary
+
+
+def boundary_query():
+    return select(func.max(LedgerArchive.boundary)).where(LedgerArchive.status == 'done')
+
+
+def archive_boundary():
+    """Start of the hot history, or None when nothing has been archived"""
+    return db.session.execute(boundary_query()).scalar()
+
+
+def frozen_before():
+    """Movements before this time may not change: the boundary of the newest run, finished or not"""
+    return db.session.execute(select(func.max(LedgerArchive.boundary))).scalar()
+
+
+def check_writable(timestamp):
+    """Raise `MovementArchived` if a movement at `timestamp` is archived or being archived"""
+    boundary = frozen_before()
+    if boundary is not None and timestamp is not None and timestamp < boundary:
+        raise MovementArchived(boundary)
+
+
+def partitions(start=None, end=None):
+    """(source, criteria) for each table that may hold movements in [start, end], oldest first.
+
+    `criteria` bound the source by the archive boundary and must be applied
+    to every query against it.
+    """
+    return split_at(archive_boundary(), start, end)
+
+
+def split_at(boundary, start=None, end=None):
+    """`partitions` for a boundary that has already been read"""
+    if boundary is None:
+        return [(ProductMovement, [])]
+    parts = []
+    if start is None or start < boundary:
+        parts.append((ArchivedMovement, [ArchivedMovement.timestamp < boundary]))
+    if end is None or end >= boundary:
+        parts.append((ProductMovement, [ProductMovement.timestamp >= boundary]))
+    return parts
+
+
+def newest_first(boundary, criteria):
+    """Partitions, newest first, for a listing with `movement_list_query` criteria"""
+    ends = [value for value in (criteria.get('until'), criteria['after'][0] if criteria.get('after') else None)
+            if value is not None]
+    return reversed(split_at(boundary, criteria.get('since'), min(ends) if ends else None))
+
+
+def movement_page(limit, **criteria):
+    """First `limit` movements across hot and archive, newest first, and the next cursor.
+
+    `criteria` are those of `utils.movement_list_query`.
+    """
+    from utils import movement_list_query, encode_cursor
+    rows = []
+    for source, bounds in newest_first(archive_boundary(), criteria):
+        query = movement_list_query(source=source, **criteria).where(*bounds)
+        rows += db.session.execute(query.limit(limit + 1 - len(rows))).all()
+        if len(rows) > limit:
+            break
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].timestamp, rows[-1].movement_id)
+
+
+def iter_movements(batch_size, **criteria):
+    """Every matching movement across hot and archive, newest first, streamed"""
+    from utils import movement_list_query
+    for source, bounds in newest_first(archive_boundary(), criteria):
+        query = movement_list_query(source=source, **criteria).where(*bounds)
+        yield from db.session.execute(query.execution_options(stream_results=True, yield_per=batch_size))
+
+
+def movement_total(search=None):
+    """`pagination.list_total` for the movement listing, hot and archive together"""
+    from utils import movement_list_query
+    from pagination import list_total, capped_count, estimated_count, COUNT_CAP
+    total = list_total(ProductMovement, movement_list_query(search=search), filtered=bool(search))
+    if archive_boundary() is None or total['capped']:
+        return total
+    if search:
+        count, capped = capped_count(movement_list_query(search=search, source=ArchivedMovement),
+                                     cap=COUNT_CAP - total['count'])
+        return {'count': total['count'] + count, 'approximate': capped, 'capped': capped}
+    count, approximate = estimated_count(ArchivedMovement)
+    return {'count': total['count'] + count, 'approximate': total['approximate'] or approximate,
+            'capped': False}
+
+
+def movement_count(**columns):
+    """Hot plus archived movements whose columns equal the given values"""
+    total = 0
+    for source in (ProductMovement, ArchivedMovement):
+        criteria = [getattr(source, name) == value for name, value in columns.items()]
+        total += db.session.execute(select(func.count()).select_from(source).where(*criteria)).scalar()
+    return total
+
+
+def _window(source, previous, before):
+    criteria = [source.timestamp < before]
+    if previous is not None:
+        criteria.append(source.timestamp >= previous)
+    return criteria
+
+
+def _copy(window, batch_size, progress):
+    """Copy hot rows in `window` to the archive, one committed batch at a time"""
+    total = db.session.execute(select(func.count()).select_from(ProductMovement).where(*window)).scalar()
+    copied, last = 0, None
+    while True:
+        query = (
+            select(ProductMovement.timestamp, ProductMovement.movement_id)
+            .where(*window)
+            .order_by(ProductMovement.timestamp, ProductMovement.movement_id)
+            .limit(batch_size)
+        )
+        if last is not None:
+            query = query.where(or_(
+                ProductMovement.timestamp > last[0],
+                and_(ProductMovement.timestamp == last[0], ProductMovement.movement_id > last[1]),
+            ))
+        keys = db.session.execute(query).all()
+        if not keys:
+            return copied
+        ids = [key.movement_id for key in keys]
+        db.session.execute(insert(ArchivedMovement).from_select(
+            COLUMNS, select(*[getattr(ProductMovement, name) for name in COLUMNS])
+            .where(ProductMovement.movement_id.in_(ids))))
+        db.session.commit()
+        copied += len(ids)
+        last = tuple(keys[-1])
+        progress(min(copied * 90 // max(total, 1), 90), f"{copied}/{total} movements copied")
+
+
+def _resync(window, archived_window):
+    """Bring archive copies in line with hot rows changed or removed while copying"""
+    db.session.execute(delete(ArchivedMovement).where(*archived_window, ~exists().where(
+        ProductMovement.movement_id == ArchivedMovement.movement_id,
+        ProductMovement.version == ArchivedMovement.version,
+    )))
+    db.session.execute(insert(ArchivedMovement).from_select(
+        COLUMNS, select(*[getattr(ProductMovement, name) for name in COLUMNS]).where(*window, ~exists().where(
+            ArchivedMovement.movement_id == ProductMovement.movement_id))))
+
+
+def _write_checkpoint(previous, before):
+    """Checkpoint at `before`: the checkpoint at `previous` plus the hot legs in between"""
+    from rebuild import movement_deltas
+    legs = movement_deltas(*_window(ProductMovement, previous, before))
+    parts = [select(legs.c.product_id, legs.c.location_id, legs.c.qty)]
+    if previous is not None:
+        parts.append(select(LedgerCheckpoint.product_id, LedgerCheckpoint.location_id, LedgerCheckpoint.balance)
+                     .where(LedgerCheckpoint.boundary == previous))
+    combined = union_all(*parts).subquery('combined')
+    balance = func.sum(combined.c.qty)
+    totals = (
+        select(literal(before, LedgerCheckpoint.boundary.type), combined.c.product_id,
+               combined.c.location_id, balance)
+        .group_by(combined.c.product_id, combined.c.location_id)
+        .having(balance != 0)
+    )
+    db.session.execute(delete(LedgerCheckpoint).where(LedgerCheckpoint.boundary == before))
+    return db.session.execute(insert(LedgerCheckpoint).from_select(
+        ['boundary', 'product_id', 'location_id', 'balance'], totals)).rowcount
+
+
+def archive_movements(before, batch_size=ARCHIVE_BATCH, progress=None):
+    """Move every movement older than `before` into the archive; returns a report dict.
+
+    An unfinished run is resumed with its own boundary, whatever `before`
+    is. Callers should hold the `rebuild-balances` single-runner lock so
+    that no rebuild or reconcile reads the ledger while it is switched over.
+    `progress`, if given, is called as `progress(percent, message)`.
+    """
+    progress = progress or (lambda percent, message: None)
+    previous = archive_boundary()
+    run = db.session.execute(
+        select(LedgerArchive).where(LedgerArchive.status == 'copying').order_by(LedgerArchive.id)
+    ).scalars().first()
+    if run is None:
+        if previous is not None and before <= previous:
+            raise ValueError(f"Movements before {previous.isoformat()} are already archived")
+        if before > datetime.utcnow():
+            raise ValueError("The archive boundary cannot be in the future")
+        run = LedgerArchive(boundary=before, status='copying', started_at=datetime.utcnow())
+        db.session.add(run)
+        db.session.commit()
+    before = run.boundary
+
+    window = _window(ProductMovement, previous, before)
+    archived_window = _window(ArchivedMovement, previous, before)
+    # rows left by an interrupted copy are past the boundary readers use; start clean
+    leftovers = [ArchivedMovement.timestamp >= previous] if previous is not None else []
+    db.session.execute(delete(ArchivedMovement).where(*leftovers))
+    db.session.commit()
+
+    _copy(window, batch_size, progress)
+    _resync(window, archived_window)
+    checkpoint_rows = _write_checkpoint(previous, before)
+    run.movements = db.session.execute(
+        select(func.count()).select_from(ArchivedMovement).where(*archived_window)).scalar()
+    run.status = 'done'
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    progress(95, f"boundary moved to {before.isoformat()}, {checkpoint_rows} checkpoint rows")
+
+    deleted = 0
+    while True:
+        ids = db.session.execute(
+            select(ProductMovement.movement_id).where(ProductMovement.timestamp < before).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        db.session.execute(delete(ProductMovement).where(ProductMovement.movement_id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+    progress(100, f"{deleted} movements removed from the hot table")
+    return {'boundary': before.isoformat(), 'archived': run.movements, 'checkpoint_rows': checkpoint_rows,
+            'removed': deleted}
+
+
+def ledger_status():
+    """Boundary, pending run and row counts of the hot and archive tables"""
+    from pagination import estimated_count
+    boundary = archive_boundary()
+    pending = db.session.execute(
+        select(LedgerArchive.boundary).where(LedgerArchive.status == 'copying')
+    ).scalars().first()
+    checkpoint_rows = db.session.execute(
+        select(func.count()).select_from(LedgerCheckpoint).where(LedgerCheckpoint.boundary == boundary)
+    ).scalar() if boundary is not None else 0
+    return {
+        'boundary': boundary.isoformat() if boundary else None,
+        'pending': pending.isoformat() if pending else None,
+        'hot_movements': estimated_count(ProductMovement)[0],
+        'archived_movements': estimated_count(ArchivedMovement)[0],
+        'checkpoint_rows': checkpoint_rows,
+    }
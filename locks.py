@@ -0,0 +1,94 @@
+"""Cross-process single-runner locks for maintenance work.
+
+`single_runner(name)` makes sure only one process at a time runs the
+guarded block, across every worker and host sharing the database:
+
+* MySQL/MariaDB -- ``GET_LOCK`` / ``RELEASE_LOCK`` on a dedicated connection;
+* PostgreSQL -- ``pg_try_advisory_lock`` on a key derived from `name`;
+* anything else (SQLite) -- an exclusive ``flock`` on ``<instance>/<name>.lock``,
+  which only covers processes on the same host, as SQLite does.
+"""
+import os
+import time
+import zlib
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import text
+from database import db
+
+POLL_INTERVAL = 0.2
+
+
+class LockTimeout(RuntimeError):
+    """The lock was held by another process for longer than the timeout"""
+
+
+def _advisory_key(name):
+    return zlib.crc32(name.encode('utf-8')) & 0x7fffffff
+
+
+@contextmanager
+def _mysql_lock(connection, name, timeout):
+    acquired = connection.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                                  {'name': name, 'timeout': timeout}).scalar()
+    if acquired != 1:
+        raise LockTimeout(f"Lock {name!r} is held by another process")
+    try:
+        yield
+    finally:
+        connection.execute(text("SELECT RELEASE_LOCK(:name)"), {'name': name})
+
+
+@contextmanager
+def _postgresql_lock(connection, name, timeout):
+    key = _advisory_key(name)
+    deadline = time.monotonic() + timeout
+    while not connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {'key': key}).scalar():
+        if time.monotonic() >= deadline:
+            raise LockTimeout(f"Lock {name!r} is held by another process")
+        time.sleep(POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': key})
+
+
+@contextmanager
+def _file_lock(name, timeout):
+    import fcntl
+
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    path = os.path.join(current_app.instance_path, f"{name}.lock")
+    deadline = time.monotonic() + timeout
+    with open(path, 'w') as fh:
+        while True:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise LockTimeout(f"Lock {name!r} is held by another process") from None
+                time.sleep(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+@contextmanager
+def single_runner(name, timeout=600):
+    """Hold the named cross-process lock for the duration of the block.
+
+    Waits up to `timeout` seconds for another holder, then raises
+    `LockTimeout`.
+    """
+    dialect = db.engine.dialect.name
+    if dialect in ('mysql', 'mariadb', 'postgresql'):
+        with db.engine.connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT')
+            lock = _mysql_lock if dialect != 'postgresql' else _postgresql_lock
+            with lock(connection, name, timeout):
+                yield
+    else:
+        with _file_lock(name, timeout):
+            yield
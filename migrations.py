@@ -0,0 +1,181 @@
+"""Minimal, ordered schema migrations for databases created before a change.
+
+`db.create_all()` only creates missing tables; it never adds indexes or
+columns to tables that already exist. Each migration here is an idempotent
+function that brings an existing table up to the current models. Applied
+migrations are recorded in `schema_migrations`.
+"""
+from datetime import datetime
+from sqlalchemy import inspect, text, Table, Column, String, DateTime, MetaData, select, insert
+from database import db
+
+_meta = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _meta,
+    Column('version', String(50), primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version):
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        return fn
+    return register
+
+
+def create_missing_indexes(connection, model):
+    """Create any index declared on `model` that the table does not have yet"""
+    existing = {index['name'] for index in inspect(connection).get_indexes(model.__tablename__)}
+    created = []
+    for index in model.__table__.indexes:
+        if index.name not in existing:
+            index.create(connection)
+            created.append(index.name)
+    return created
+
+
+@migration('0001_movement_access_path_indexes')
+def add_movement_indexes(connection):
+    """Composite indexes for per-product/per-location movement history and
+    time-ordered listings, plus balances by location."""
+    from models import ProductMovement, ProductBalance
+    return create_missing_indexes(connection, ProductMovement) + create_missing_indexes(connection, ProductBalance)
+
+
+@migration('0002_row_versions')
+def add_row_versions(connection):
+    """Optimistic-locking `version` columns on products, locations and movements"""
+    added = []
+    for table in ('products', 'locations', 'product_movements'):
+        columns = {column['name'] for column in inspect(connection).get_columns(table)}
+        if 'version' not in columns:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+            added.append(f"{table}.version")
+    return added
+
+
+@migration('0003_movement_transfer_ids')
+def add_movement_transfer_ids(connection):
+    """`transfer_id` on hot and archived movements, grouping the lines of a transfer order"""
+    from models import ProductMovement, ArchivedMovement
+    added = []
+    for model in (ProductMovement, ArchivedMovement):
+        table = model.__tablename__
+        columns = {column['name'] for column in inspect(connection).get_columns(table)}
+        if 'transfer_id' not in columns:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN transfer_id VARCHAR(50)"))
+            added.append(f"{table}.transfer_id")
+        added += create_missing_indexes(connection, model)
+    return added
+
+
+@migration('0004_balance_last_updated_index')
+def add_balance_last_updated_index(connection):
+    """Index on `product_balances.last_updated`, for the balance index's catch-up reads"""
+    from models import ProductBalance
+    return create_missing_indexes(connection, ProductBalance)
+
+
+@migration('0005_movement_recorded_at')
+def add_movement_recorded_at(connection):
+    """`recorded_at` on hot and archived movements, backfilled from `timestamp`, for incremental exports"""
+    from models import ProductMovement, ArchivedMovement
+    added = []
+    for model in (ProductMovement, ArchivedMovement):
+        table = model.__tablename__
+        columns = {column['name'] for column in inspect(connection).get_columns(table)}
+        if 'recorded_at' not in columns:
+            column_type = model.__table__.c.recorded_at.type.compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN recorded_at {column_type}"))
+            added.append(f"{table}.recorded_at")
+        connection.execute(text(f"UPDATE {table} SET recorded_at = timestamp WHERE recorded_at IS NULL"))
+        added += create_missing_indexes(connection, model)
+    return added
+
+
+@migration('0006_job_heartbeats')
+def add_job_heartbeats(connection):
+    """`heartbeat_at` on jobs, so jobs of a crashed worker can be expired"""
+    from models import Job
+    columns = {column['name'] for column in inspect(connection).get_columns('jobs')}
+    if 'heartbeat_at' in columns:
+        return []
+    column_type = Job.__table__.c.heartbeat_at.type.compile(dialect=connection.dialect)
+    connection.execute(text(f"ALTER TABLE jobs ADD COLUMN heartbeat_at {column_type}"))
+    return ['jobs.heartbeat_at']
+
+
+@migration('0007_movement_line_numbers')
+def add_movement_line_numbers(connection):
+    """`line_no` on hot and archived movements, the position of a line within its transfer order"""
+    from models import ProductMovement, ArchivedMovement
+    added = []
+    for model in (ProductMovement, ArchivedMovement):
+        table = model.__tablename__
+        columns = {column['name'] for column in inspect(connection).get_columns(table)}
+        if 'line_no' not in columns:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN line_no INTEGER"))
+            added.append(f"{table}.line_no")
+    return added
+
+
+def applied_versions(connection):
+    _meta.create_all(connection, checkfirst=True)
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+def pending_migrations():
+    with db.engine.begin() as connection:
+        done = applied_versions(connection)
+    return [version for version, _ in MIGRATIONS if version not in done]
+
+
+def upgrade(echo=print):
+    """Apply every pending migration in order, each in its own transaction"""
+    db.create_all()
+    applied = []
+    for version, fn in MIGRATIONS:
+        with db.engine.begin() as connection:
+            if version in applied_versions(connection):
+                continue
+            changes = fn(connection)
+            connection.execute(insert(schema_migrations).values(version=version, applied_at=datetime.utcnow()))
+        echo(f"Applied {version}" + (f": {', '.join(changes)}" if changes else ''))
+        applied.append(version)
+    return applied
+
+
+def balances_missing():
+    """True when movements or ledger checkpoints exist but no balance rows have been built yet"""
+    from models import ProductMovement, ProductBalance, LedgerCheckpoint
+    no_balances = db.session.execute(select(ProductBalance.id).limit(1)).first() is None
+    return no_balances and (
+        db.session.execute(select(ProductMovement.movement_id).limit(1)).first() is not None
+        or db.session.execute(select(LedgerCheckpoint.id).limit(1)).first() is not None
+    )
+
+
+def init_database(echo=print, timeout=600):
+    """Create/upgrade the schema and build balances if they are missing.
+
+    Runs under a cross-process lock so that when several processes are
+    started together exactly one of them does the work; the others wait and
+    then find nothing left to do.
+    """
+    from locks import single_runner
+    from rebuild import rebuild_balances
+    from counters import counters_missing, reconcile_counters
+
+    with single_runner('init-db', timeout=timeout):
+        upgrade(echo=echo)
+        if balances_missing():
+            with single_runner('rebuild-balances', timeout=timeout):
+                written = rebuild_balances()
+            echo(f"Rebuilt {written} balance rows")
+        if counters_missing():
+            reconcile_counters()
+            echo("Initialised dashboard counters")
+
@@ -1,4 +1,6 @@
+import json
 from database import db
+from signals import balances_changed
 from datetime import datetime
 
 
@@ -8,9 +10,12 @@ class Product(db.Model):
     product_id = db.Column(db.String(50), primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     
     movements = db.relationship('ProductMovement', backref='product', lazy=True)
     
+    __mapper_args__ = {'version_id_col': version}
+    
     def __repr__(self):
         return f'<Product {self.product_id}: {self.name}>'
 
@@ -21,10 +26,13 @@ class Location(db.Model):
     location_id = db.Column(db.String(50), primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     
     movements_from = db.relationship('ProductMovement', foreign_keys='ProductMovement.from_location', backref='from_loc', lazy=True)
     movements_to = db.relationship('ProductMovement', foreign_keys='ProductMovement.to_location', backref='to_loc', lazy=True)
     
+    __mapper_args__ = {'version_id_col': version}
+    
     def __repr__(self):
         return f'<Location {self.location_id}: {self.name}>'
 
@@ -38,9 +46,35 @@ class ProductMovement(db.Model):
     to_location = db.Column(db.String(50), db.ForeignKey('locations.location_id'), nullable=True)
     product_id = db.Column(db.String(50), db.ForeignKey('products.product_id'), nullable=False)
     qty = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    transfer_id = db.Column(db.String(50), db.ForeignKey('transfer_orders.transfer_id'), nullable=True, index=True)
+    # 1-based position within its transfer order, which `transfers.transfer_lines` sorts by
+    line_no = db.Column(db.Integer, nullable=True)
+    # when the row was inserted, whatever its (possibly back-dated) timestamp; incremental exports follow it
+    recorded_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_movements_product_timestamp', 'product_id', 'timestamp'),
+        db.Index('ix_movements_from_timestamp', 'from_location', 'timestamp'),
+        db.Index('ix_movements_to_timestamp', 'to_location', 'timestamp'),
+        db.Index('ix_movements_timestamp_id', 'timestamp', 'movement_id'),
+        db.Index('ix_movements_recorded_id', 'recorded_at', 'movement_id'),
+    )
+    # every ORM UPDATE/DELETE is conditional on the version it loaded
+    __mapper_args__ = {'version_id_col': version}
     
     def __repr__(self):
         return f'<ProductMovement {self.movement_id}: {self.qty} units of {self.product_id}>'
+
+    def as_change(self):
+        """The fields `movements_changed` receivers need, as a plain dict"""
+        return {
+            'product_id': self.product_id,
+            'from_location': self.from_location,
+            'to_location': self.to_location,
+            'qty': self.qty,
+            'timestamp': self.timestamp,
+        }
 class ProductBalance(db.Model):
     __tablename__ = 'product_balances'
     
@@ -53,43 +87,406 @@ class ProductBalance(db.Model):
     product = db.relationship('Product', backref='balances')
     location = db.relationship('Location', backref='balances')
     
-    __table_args__ = (db.UniqueConstraint('product_id', 'location_id', name='unique_product_location'),)
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'location_id', name='unique_product_location'),
+        db.Index('ix_balances_location', 'location_id'),
+        db.Index('ix_balances_last_updated', 'last_updated'),
+    )
     
     def __repr__(self):
         return f'<ProductBalance {self.product_id} at {self.location_id}: {self.balance}>'
     
+    @staticmethod
+    def _upsert_statement():
+        """Dialect-specific INSERT that increments `balance` on key conflict"""
+        table = ProductBalance.__table__
+        dialect = db.session.get_bind(mapper=ProductBalance).dialect.name
+
+        if dialect in ('sqlite', 'postgresql'):
+            if dialect == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(table)
+            return stmt.on_conflict_do_update(
+                index_elements=[table.c.product_id, table.c.location_id],
+                set_={
+                    'balance': table.c.balance + stmt.excluded.balance,
+                    'last_updated': stmt.excluded.last_updated,
+                },
+            )
+
+        if dialect in ('mysql', 'mariadb'):
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(table)
+            return stmt.on_duplicate_key_update(
+                balance=table.c.balance + stmt.inserted.balance,
+                last_updated=stmt.inserted.last_updated,
+            )
+
+        return None
+
+    @staticmethod
+    def _increment_or_insert(row):
+        """Portable fallback: UPDATE, then INSERT under a savepoint, retrying
+        the UPDATE if a concurrent writer created the row first."""
+        from sqlalchemy.exc import IntegrityError
+
+        table = ProductBalance.__table__
+        increment = (
+            table.update()
+            .where(table.c.product_id == row['product_id'], table.c.location_id == row['location_id'])
+            .values(balance=table.c.balance + row['balance'], last_updated=row['last_updated'])
+        )
+        if db.session.execute(increment).rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(**row))
+        except IntegrityError:
+            db.session.execute(increment)
+
     @staticmethod
     def update_balance(product_id, location_id, quantity_change):
-        """Update or create balance for a product at a location"""
-        balance = ProductBalance.query.filter_by(
-            product_id=product_id, 
-            location_id=location_id
-        ).first()
-        
-        if balance:
-            balance.balance += quantity_change
-            balance.last_updated = datetime.utcnow()
+        """Atomically add `quantity_change` to a balance, creating it if needed.
+
+        Runs as a single upsert statement, so concurrent writers can neither
+        lose each other's increments nor collide on `unique_product_location`.
+        """
+        ProductBalance.apply_deltas({(product_id, location_id): quantity_change})
+
+    @staticmethod
+    def apply_deltas(deltas):
+        """Apply many {(product_id, location_id): quantity_change} at once.
+
+        All rows go through one executemany upsert, so a batch costs a single
+        round trip per driver page regardless of how many rows exist already.
+        """
+        now = datetime.utcnow()
+        rows = [
+            {'product_id': product_id, 'location_id': location_id, 'balance': change, 'last_updated': now}
+            for (product_id, location_id), change in deltas.items()
+            if change
+        ]
+        if not rows:
+            return
+
+        stmt = ProductBalance._upsert_statement()
+        if stmt is None:
+            for row in rows:
+                ProductBalance._increment_or_insert(row)
         else:
-            balance = ProductBalance(
-                product_id=product_id,
-                location_id=location_id,
-                balance=quantity_change,
-                last_updated=datetime.utcnow()
+            db.session.execute(stmt, rows)
+        balances_changed.send(ProductBalance, keys=[(row['product_id'], row['location_id']) for row in rows],
+                              changes={(row['product_id'], row['location_id']): row['balance'] for row in rows})
+
+    @staticmethod
+    def withdraw(product_id, location_id, quantity):
+        """Take `quantity` out of a balance only if enough stock is there.
+
+        A guarded `UPDATE ... WHERE balance >= quantity`, so the check and the
+        decrement cannot be interleaved with another writer. Returns True if
+        the stock was taken.
+        """
+        table = ProductBalance.__table__
+        result = db.session.execute(
+            table.update()
+            .where(
+                table.c.product_id == product_id,
+                table.c.location_id == location_id,
+                table.c.balance >= quantity,
             )
-            db.session.add(balance)
-        
-        return balance
-    
+            .values(balance=table.c.balance - quantity, last_updated=datetime.utcnow())
+        )
+        if result.rowcount != 1:
+            return False
+        balances_changed.send(ProductBalance, keys=[(product_id, location_id)],
+                              changes={(product_id, location_id): -quantity})
+        return True
+
     @staticmethod
     def get_balance(product_id, location_id):
         """Get current balance for a product at a location"""
-        balance = ProductBalance.query.filter_by(
-            product_id=product_id, 
-            location_id=location_id
-        ).first()
-        return balance.balance if balance else 0
+        balance = db.session.execute(
+            db.select(ProductBalance.balance).filter_by(
+                product_id=product_id,
+                location_id=location_id
+            )
+        ).scalar()
+        return balance if balance is not None else 0
     
     @staticmethod
     def get_all_balances():
         """Get all non-zero balances"""
         return ProductBalance.query.filter(ProductBalance.balance != 0).all()
+
+
+class BalanceSnapshot(db.Model):
+    __tablename__ = 'balance_snapshots'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_at = db.Column(db.DateTime, nullable=False)
+    product_id = db.Column(db.String(50), db.ForeignKey('products.product_id'), nullable=False)
+    location_id = db.Column(db.String(50), db.ForeignKey('locations.location_id'), nullable=False)
+    balance = db.Column(db.Integer, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('snapshot_at', 'product_id', 'location_id', name='unique_snapshot_product_location'),
+    )
+    
+    def __repr__(self):
+        return f'<BalanceSnapshot {self.snapshot_at} {self.product_id} at {self.location_id}: {self.balance}>'
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    
+    job_id = db.Column(db.String(36), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    message = db.Column(db.String(255))
+    params = db.Column(db.Text)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_jobs_kind_status', 'kind', 'status'),
+        db.Index('ix_jobs_created_at', 'created_at'),
+    )
+    
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'params': json.loads(self.params) if self.params else {},
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+    
+    def __repr__(self):
+        return f'<Job {self.job_id} {self.kind}: {self.status}>'
+
+
+class ReconcileState(db.Model):
+    __tablename__ = 'reconcile_state'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    high_water_timestamp = db.Column(db.DateTime)
+    high_water_movement_id = db.Column(db.String(50))
+    sweep_product = db.Column(db.String(50))
+    last_run_at = db.Column(db.DateTime)
+    last_report = db.Column(db.Text)
+    
+    def __repr__(self):
+        return f'<ReconcileState {self.name}: {self.high_water_timestamp} {self.high_water_movement_id}>'
+
+
+class IntakeState(db.Model):
+    """How far one local intake queue has been applied to the ledger.
+
+    `applied_seq` is advanced in the same transaction as the movements it
+    covers, so after a crash the queue is replayed from exactly there.
+    """
+    __tablename__ = 'intake_state'
+
+    queue_id = db.Column(db.String(36), primary_key=True)
+    applied_seq = db.Column(db.Integer, nullable=False, default=0)
+    batches = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<IntakeState {self.queue_id}: {self.applied_seq}>'
+
+
+class ReorderThreshold(db.Model):
+    __tablename__ = 'reorder_thresholds'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.String(50), db.ForeignKey('products.product_id'), nullable=False)
+    location_id = db.Column(db.String(50), db.ForeignKey('locations.location_id'), nullable=False)
+    threshold = db.Column(db.Integer, nullable=False)
+    is_low = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'location_id', name='unique_threshold_product_location'),
+        db.Index('ix_thresholds_low', 'is_low', 'product_id', 'location_id'),
+    )
+    
+    def __repr__(self):
+        return f'<ReorderThreshold {self.product_id} at {self.location_id}: {self.threshold}>'
+
+
+class StockAlert(db.Model):
+    __tablename__ = 'stock_alerts'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    product_id = db.Column(db.String(50), nullable=False)
+    location_id = db.Column(db.String(50), nullable=False)
+    balance = db.Column(db.Integer, nullable=False)
+    threshold = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'product_id': self.product_id,
+            'location_id': self.location_id,
+            'balance': self.balance,
+            'threshold': self.threshold,
+            'created_at': self.created_at.isoformat()
+        }
+    
+    def __repr__(self):
+        return f'<StockAlert {self.id} {self.kind} {self.product_id} at {self.location_id}>'
+
+
+class MovementRollup(db.Model):
+    """Movement totals of one product or location over one hour or day.
+
+    `dimension` is ``product`` or ``location`` and `entity_id` the matching
+    id; `bucket` is the start of the hour or day.
+    """
+    __tablename__ = 'movement_rollups'
+
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(8), nullable=False)
+    dimension = db.Column(db.String(10), nullable=False)
+    entity_id = db.Column(db.String(50), nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False)
+    qty_in = db.Column(db.Integer, nullable=False, default=0)
+    qty_out = db.Column(db.Integer, nullable=False, default=0)
+    movement_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'dimension', 'entity_id', 'bucket', name='unique_rollup_bucket'),
+        db.Index('ix_rollups_bucket', 'granularity', 'dimension', 'bucket'),
+    )
+
+    def __repr__(self):
+        return f'<MovementRollup {self.granularity} {self.dimension} {self.entity_id} @ {self.bucket}>'
+
+
+class DashboardCounter(db.Model):
+    """One slot of a maintained row count; a counter is the sum of its slots"""
+    __tablename__ = 'dashboard_counters'
+
+    name = db.Column(db.String(40), primary_key=True)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DashboardCounter {self.name}[{self.slot}]: {self.value}>'
+
+
+class ArchivedMovement(db.Model):
+    """A movement older than the archive boundary, moved out of `product_movements`.
+
+    Same columns and access paths as `ProductMovement`, but read-only and
+    without foreign keys (no per-row constraint checks or FK indexes); on
+    MySQL the table is stored compressed.
+    """
+    __tablename__ = 'product_movements_archive'
+
+    movement_id = db.Column(db.String(50), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    from_location = db.Column(db.String(50), nullable=True)
+    to_location = db.Column(db.String(50), nullable=True)
+    product_id = db.Column(db.String(50), nullable=False)
+    qty = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    transfer_id = db.Column(db.String(50), nullable=True, index=True)
+    line_no = db.Column(db.Integer, nullable=True)
+    recorded_at = db.Column(db.DateTime, nullable=True)
+
+    product = db.relationship('Product', primaryjoin='foreign(ArchivedMovement.product_id) == Product.product_id',
+                              viewonly=True)
+    from_loc = db.relationship('Location', primaryjoin='foreign(ArchivedMovement.from_location) == Location.location_id',
+                               viewonly=True)
+    to_loc = db.relationship('Location', primaryjoin='foreign(ArchivedMovement.to_location) == Location.location_id',
+                             viewonly=True)
+
+    __table_args__ = (
+        db.Index('ix_archive_product_timestamp', 'product_id', 'timestamp'),
+        db.Index('ix_archive_from_timestamp', 'from_location', 'timestamp'),
+        db.Index('ix_archive_to_timestamp', 'to_location', 'timestamp'),
+        db.Index('ix_archive_timestamp_id', 'timestamp', 'movement_id'),
+        db.Index('ix_archive_recorded_id', 'recorded_at', 'movement_id'),
+        {'mysql_row_format': 'COMPRESSED'},
+    )
+
+    def __repr__(self):
+        return f'<ArchivedMovement {self.movement_id}: {self.qty} units of {self.product_id}>'
+
+
+class LedgerArchive(db.Model):
+    """One archival run: movements before `boundary` live in the archive table.
+
+    While `status` is ``copying`` the run's boundary only freezes older
+    movements; readers switch to it once it is ``done``.
+    """
+    __tablename__ = 'ledger_archives'
+
+    id = db.Column(db.Integer, primary_key=True)
+    boundary = db.Column(db.DateTime, nullable=False, index=True)
+    status = db.Column(db.String(10), nullable=False, default='copying')
+    movements = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<LedgerArchive {self.boundary} {self.status}>'
+
+
+class LedgerCheckpoint(db.Model):
+    """Net balance of every movement before `boundary` for one (product, location)"""
+    __tablename__ = 'ledger_checkpoints'
+
+    id = db.Column(db.Integer, primary_key=True)
+    boundary = db.Column(db.DateTime, nullable=False)
+    product_id = db.Column(db.String(50), nullable=False)
+    location_id = db.Column(db.String(50), nullable=False)
+    balance = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('boundary', 'product_id', 'location_id', name='unique_checkpoint_product_location'),
+    )
+
+    def __repr__(self):
+        return f'<LedgerCheckpoint {self.boundary} {self.product_id} at {self.location_id}: {self.balance}>'
+
+
+class TransferOrder(db.Model):
+    """Header of a multi-line transfer; its lines are movements sharing `transfer_id`.
+
+    All lines of a transfer are stored, and their balance effect applied,
+    in one transaction (`transfers.create_transfer`).
+    """
+    __tablename__ = 'transfer_orders'
+
+    transfer_id = db.Column(db.String(50), primary_key=True)
+    from_location = db.Column(db.String(50), db.ForeignKey('locations.location_id'), nullable=False)
+    to_location = db.Column(db.String(50), db.ForeignKey('locations.location_id'), nullable=False)
+    note = db.Column(db.Text)
+    lines = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    from_loc = db.relationship('Location', foreign_keys=[from_location])
+    to_loc = db.relationship('Location', foreign_keys=[to_location])
+
+    def __repr__(self):
+        return f'<TransferOrder {self.transfer_id}: {self.lines} lines {self.from_location} -> {self.to_location}>'
@@ -0,0 +1,108 @@
+"""SQL-level paging, search and cheap counts for the list pages."""
+from sqlalchemy import select, func, text, or_
+from database import db
+from models import Product, Location
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+COUNT_CAP = 10000
+
+PRODUCT_SORTS = {
+    'product_id': (Product.product_id,),
+    'name': (Product.name, Product.product_id),
+}
+LOCATION_SORTS = {
+    'location_id': (Location.location_id,),
+    'name': (Location.name, Location.location_id),
+}
+
+
+def page_args(args, default_sort):
+    """(page, per_page, sort, q) from request args, clamped to sane values"""
+    page = max(args.get('page', 1, type=int), 1)
+    per_page = max(1, min(args.get('per_page', PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    sort = args.get('sort') or default_sort
+    q = (args.get('q') or '').strip()
+    return page, per_page, sort, q
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def estimated_count(model):
+    """Row count of a whole table from planner statistics where available.
+
+    MySQL reads ``information_schema.TABLES.TABLE_ROWS`` and PostgreSQL
+    ``pg_class.reltuples``; both are maintained by the engine and cost no
+    scan. SQLite has no such statistic, so it falls back to an exact count.
+    Returns (count, is_estimate).
+    """
+    table = model.__tablename__
+    dialect = db.session.get_bind(mapper=model).dialect.name
+
+    if dialect in ('mysql', 'mariadb'):
+        estimate = db.session.execute(text(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+        ), {'table': table}).scalar()
+    elif dialect == 'postgresql':
+        estimate = db.session.execute(text(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"
+        ), {'table': table}).scalar()
+    else:
+        estimate = None
+
+    if estimate is None or estimate < 0:
+        return db.session.execute(select(func.count()).select_from(model)).scalar(), False
+    return int(estimate), True
+
+
+def capped_count(query, cap=COUNT_CAP):
+    """Count the rows of a filtered query, stopping at `cap`.
+
+    Returns (count, is_capped); a capped result means "at least `cap`".
+    """
+    limited = query.order_by(None).limit(cap + 1).subquery()
+    count = db.session.execute(select(func.count()).select_from(limited)).scalar()
+    return min(count, cap), count > cap
+
+
+def product_search_query(q='', sort='product_id'):
+    query = select(Product).order_by(*PRODUCT_SORTS.get(sort, PRODUCT_SORTS['product_id']))
+    if q:
+        pattern = escape_like(q)
+        query = query.where(or_(
+            Product.product_id.like(f"{pattern}%", escape='\\'),
+            Product.name.ilike(f"%{pattern}%", escape='\\'),
+        ))
+    return query
+
+
+def location_search_query(q='', sort='location_id'):
+    query = select(Location).order_by(*LOCATION_SORTS.get(sort, LOCATION_SORTS['location_id']))
+    if q:
+        pattern = escape_like(q)
+        query = query.where(or_(
+            Location.location_id.like(f"{pattern}%", escape='\\'),
+            Location.name.ilike(f"%{pattern}%", escape='\\'),
+        ))
+    return query
+
+
+def fetch_page(query, page, per_page):
+    """One page of ORM rows plus whether another page follows"""
+    rows = db.session.execute(query.limit(per_page + 1).offset((page - 1) * per_page)).scalars().all()
+    return rows[:per_page], len(rows) > per_page
+
+
+def list_total(model, query, filtered):
+    """Total for a listing: a table estimate when unfiltered, a capped count otherwise.
+
+    Returns a dict with `count`, `approximate` and `capped` for the templates.
+    """
+    if filtered:
+        count, capped = capped_count(query)
+        return {'count': count, 'approximate': capped, 'capped': capped}
+    count, approximate = estimated_count(model)
+    return {'count': count, 'approximate': approximate, 'capped': False}
@@ -0,0 +1,113 @@
+"""Run EXPLAIN on the application's known hot queries and flag full scans.
+
+Each entry in `known_queries()` mirrors a query issued by a route. Plans are
+read with the dialect's own EXPLAIN and classified:
+
+* SQLite -- ``EXPLAIN QUERY PLAN``; a ``SCAN <table>`` step without an index
+  is a full scan, ``USE TEMP B-TREE`` is an extra sort.
+* MySQL/MariaDB -- ``EXPLAIN``; ``type = ALL`` is a full scan,
+  ``Using filesort`` an extra sort.
+* PostgreSQL -- ``EXPLAIN``; ``Seq Scan`` is a full scan, ``Sort`` an extra
+  sort.
+"""
+from datetime import datetime
+from sqlalchemy import select, func, text, or_
+from database import db
+from models import (
+    Product, Location, ProductMovement, ProductBalance, ReorderThreshold, MovementRollup, ArchivedMovement,
+)
+
+
+def known_queries(product_id='PRD-SAMPLE', location_id='LOC-SAMPLE'):
+    """(name, statement) pairs for the access paths the routes depend on"""
+    newest_first = (ProductMovement.timestamp.desc(),)
+    return [
+        ('view_product: movement history',
+         select(ProductMovement).where(ProductMovement.product_id == product_id).order_by(*newest_first).limit(51)),
+        ('view_location: outbound history',
+         select(ProductMovement).where(ProductMovement.from_location == location_id).order_by(*newest_first).limit(51)),
+        ('view_location: inbound history',
+         select(ProductMovement).where(ProductMovement.to_location == location_id).order_by(*newest_first).limit(51)),
+        ('view_product: archived history',
+         select(ArchivedMovement).where(ArchivedMovement.product_id == product_id,
+                                        ArchivedMovement.timestamp < datetime(2000, 1, 1))
+         .order_by(ArchivedMovement.timestamp.desc()).limit(51)),
+        ('products: id prefix search',
+         select(Product).where(Product.product_id.like(f"{product_id}%")).order_by(Product.product_id).limit(51)),
+        ('delete_product: movement count',
+         select(func.count()).select_from(ProductMovement).where(ProductMovement.product_id == product_id)),
+        ('delete_location: movement count',
+         select(func.count()).select_from(ProductMovement).where(ProductMovement.from_location == location_id)),
+        ('movements: newest page',
+         select(ProductMovement).order_by(ProductMovement.timestamp.desc(), ProductMovement.movement_id.desc()).limit(100)),
+        ('api_movements: location filter',
+         select(ProductMovement.movement_id).where(or_(
+             ProductMovement.from_location == location_id,
+             ProductMovement.to_location == location_id,
+         )).order_by(ProductMovement.timestamp.desc(), ProductMovement.movement_id.desc()).limit(100)),
+        ('balance lookup',
+         select(ProductBalance.balance).where(
+             ProductBalance.product_id == product_id, ProductBalance.location_id == location_id)),
+        ('balances by location',
+         select(ProductBalance).where(ProductBalance.location_id == location_id)),
+        ('alerts: below-threshold list',
+         select(ReorderThreshold.product_id, ReorderThreshold.location_id)
+         .where(ReorderThreshold.is_low.is_(True))
+         .order_by(ReorderThreshold.is_low, ReorderThreshold.product_id, ReorderThreshold.location_id).limit(50)),
+        ('alerts: threshold lookup on balance change',
+         select(ReorderThreshold.id).where(
+             ReorderThreshold.product_id == product_id, ReorderThreshold.location_id == location_id)),
+        ('analytics: location series',
+         select(MovementRollup.bucket, MovementRollup.qty_in, MovementRollup.qty_out).where(
+             MovementRollup.granularity == 'day', MovementRollup.dimension == 'location',
+             MovementRollup.entity_id == location_id, MovementRollup.bucket >= datetime(2000, 1, 1),
+         ).order_by(MovementRollup.bucket)),
+        ('product lookup',
+         select(Product).where(Product.product_id == product_id)),
+        ('location lookup',
+         select(Location).where(Location.location_id == location_id)),
+    ]
+
+
+def _compile(statement, dialect):
+    return str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+
+def explain(statement):
+    """Return (plan lines, full_scans, extra_sorts) for one statement"""
+    bind = db.session.get_bind()
+    dialect = bind.dialect
+    sql = _compile(statement, dialect)
+
+    if dialect.name == 'sqlite':
+        rows = db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+        lines = [row[-1] for row in rows]
+        scans = [line for line in lines
+                 if line.startswith('SCAN') and 'USING' not in line and 'CONSTANT ROW' not in line]
+        sorts = [line for line in lines if 'TEMP B-TREE' in line]
+    elif dialect.name in ('mysql', 'mariadb'):
+        rows = db.session.execute(text(f"EXPLAIN {sql}")).mappings().all()
+        lines = [
+            f"{row.get('table')}: type={row.get('type')} key={row.get('key')} rows={row.get('rows')} "
+            f"extra={row.get('Extra')}"
+            for row in rows
+        ]
+        scans = [line for line, row in zip(lines, rows) if row.get('type') == 'ALL']
+        sorts = [line for line, row in zip(lines, rows) if 'filesort' in (row.get('Extra') or '')]
+    else:
+        lines = [row[0] for row in db.session.execute(text(f"EXPLAIN {sql}"))]
+        scans = [line for line in lines if 'Seq Scan' in line]
+        sorts = [line for line in lines if line.strip().startswith('Sort')]
+    return lines, scans, sorts
+
+
+def advise():
+    """Explain every known query; returns a list of report dicts"""
+    sample_product = db.session.execute(select(Product.product_id).limit(1)).scalar() or 'PRD-SAMPLE'
+    sample_location = db.session.execute(select(Location.location_id).limit(1)).scalar() or 'LOC-SAMPLE'
+
+    report = []
+    for name, statement in known_queries(sample_product, sample_location):
+        lines, scans, sorts = explain(statement)
+        report.append({'query': name, 'plan': lines, 'full_scans': scans, 'extra_sorts': sorts})
+    return report
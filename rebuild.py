@@ -0,0 +1,156 @@
+from datetime import datetime
+from sqlalchemy import select, insert, delete, func, literal, union_all
+from database import db
+from models import ProductMovement, ProductBalance, LedgerCheckpoint
+from signals import balances_changed, balances_rebuilt
+from ledger import archive_boundary
+
+
+def movement_deltas(*criteria, source=ProductMovement):
+    """Signed (product_id, location_id, qty) rows for every movement leg.
+
+    Inbound legs (`to_location`) contribute `+qty`, outbound legs
+    (`from_location`) contribute `-qty`. Extra criteria are applied to both
+    legs, e.g. a product range or a timestamp window; `source` is
+    `ProductMovement` or `ArchivedMovement`, and criteria must refer to it.
+    """
+    inbound = select(
+        source.product_id.label('product_id'),
+        source.to_location.label('location_id'),
+        source.qty.label('qty'),
+    ).where(source.to_location.isnot(None), *criteria)
+
+    outbound = select(
+        source.product_id.label('product_id'),
+        source.from_location.label('location_id'),
+        (-source.qty).label('qty'),
+    ).where(source.from_location.isnot(None), *criteria)
+
+    return union_all(inbound, outbound).subquery('legs')
+
+
+def ledger_legs(products=None):
+    """Signed legs whose sums are the current balances.
+
+    Without an archive these are the legs of every movement; otherwise the
+    legs of movements at or after the archive boundary plus the checkpoint
+    rows kept at that boundary. `products`, if given, maps a product id
+    column to a criterion, e.g. ``lambda column: column.in_(ids)``.
+    """
+    boundary = archive_boundary()
+    criteria = [products(ProductMovement.product_id)] if products else []
+    if boundary is None:
+        return movement_deltas(*criteria)
+
+    legs = movement_deltas(ProductMovement.timestamp >= boundary, *criteria)
+    checkpoint = [LedgerCheckpoint.boundary == boundary]
+    if products:
+        checkpoint.append(products(LedgerCheckpoint.product_id))
+    return union_all(
+        select(legs.c.product_id, legs.c.location_id, legs.c.qty),
+        select(LedgerCheckpoint.product_id, LedgerCheckpoint.location_id,
+               LedgerCheckpoint.balance.label('qty')).where(*checkpoint),
+    ).subquery('ledger_legs')
+
+
+def balance_totals(products=None):
+    """Grouped net balance per (product_id, location_id) implied by the ledger"""
+    legs = ledger_legs(products)
+    return (
+        select(
+            legs.c.product_id,
+            legs.c.location_id,
+            func.sum(legs.c.qty).label('balance'),
+        )
+        .group_by(legs.c.product_id, legs.c.location_id)
+    )
+
+
+def _write_balances(products=None):
+    totals = balance_totals(products).subquery('totals')
+    stmt = insert(ProductBalance).from_select(
+        ['product_id', 'location_id', 'balance', 'last_updated'],
+        select(
+            totals.c.product_id,
+            totals.c.location_id,
+            totals.c.balance,
+            literal(datetime.utcnow(), ProductBalance.last_updated.type),
+        ),
+    )
+    return db.session.execute(stmt).rowcount
+
+
+def _known_products():
+    """Every product id that has movements or checkpoint rows"""
+    return union_all(
+        select(ProductMovement.product_id.label('product_id')),
+        select(LedgerCheckpoint.product_id.label('product_id')),
+    ).subquery('known')
+
+
+def _product_chunks(chunk_size):
+    """Yield (first, last) product_id bounds covering `chunk_size` products each"""
+    known = _known_products()
+    last = None
+    while True:
+        query = select(known.c.product_id).distinct().order_by(known.c.product_id)
+        if last is not None:
+            query = query.where(known.c.product_id > last)
+        ids = db.session.execute(query.limit(chunk_size)).scalars().all()
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        last = ids[-1]
+
+
+def rebuild_balances(chunk_size=None, progress=None):
+    """Rebuild `product_balances` from the movement ledger with set-based SQL.
+
+    Without `chunk_size` the whole table is replaced by a single
+    INSERT ... SELECT ... GROUP BY inside one transaction. With `chunk_size`
+    the rebuild walks product ids in keyset order and, for every chunk of
+    that many products, deletes and rewrites that product range's balances
+    in one transaction, keeping each transaction (and the database's
+    sort/group work area) bounded for very large histories while readers
+    and writers only ever see complete balances. `progress`, if given, is
+    called as `progress(percent, message)` after each commit.
+
+    Returns the number of balance rows written.
+    """
+    if not chunk_size:
+        db.session.execute(delete(ProductBalance))
+        balances_changed.send(ProductBalance, keys=None)
+        written = _write_balances()
+        db.session.commit()
+        balances_rebuilt.send(ProductBalance)
+        if progress:
+            progress(100, f"{written} balances written")
+        return written
+
+    known = _known_products()
+    total = db.session.execute(select(func.count(known.c.product_id.distinct()))).scalar() or 0
+    chunks = -(-total // chunk_size)
+    written = 0
+    previous = None
+    for done, (first, last) in enumerate(_product_chunks(chunk_size), 1):
+        # the range starts after the previous chunk so stale rows between known ids go too
+        scope = [ProductBalance.product_id <= last]
+        if previous is not None:
+            scope.append(ProductBalance.product_id > previous)
+        db.session.execute(delete(ProductBalance).where(*scope))
+        written += _write_balances(lambda column: column.between(first, last))
+        balances_changed.send(ProductBalance, keys=None)
+        db.session.commit()
+        previous = last
+        if progress:
+            progress(min(done * 100 // max(chunks, 1), 100),
+                     f"{done}/{chunks} product chunks, {written} balances written")
+    # balances of products with no ledger rows left
+    stale = delete(ProductBalance)
+    if previous is not None:
+        stale = stale.where(ProductBalance.product_id > previous)
+    db.session.execute(stale)
+    balances_changed.send(ProductBalance, keys=None)
+    db.session.commit()
+    balances_rebuilt.send(ProductBalance)
+    return written
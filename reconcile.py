@@ -0,0 +1,211 @@
+"""Incremental verification and repair of `product_balances`.
+
+Each pass compares stored balances with the totals implied by the
+movement ledger (see `rebuild.ledger_legs`) for a chunk of products in a single grouped query:
+stored rows enter the aggregate negated, so only (product, location) pairs
+that disagree come back. The query is a plain SELECT, so it takes no locks
+on `product_balances`. Each mismatch is repaired with a relative upsert of
+`expected - stored`, which is still correct if a movement lands between
+the check and the repair, and each chunk commits on its own.
+
+An incremental run checks:
+
+* every product with movements past the high-water mark -- the newest
+  (timestamp, movement_id) seen by the previous run -- and
+* the next `sweep_chunks` chunks of a rolling sweep over all products, so
+  edits, deletions and back-dated movements are caught within one full
+  rotation.
+
+A full run walks every product once.
+"""
+import json
+from datetime import datetime
+from sqlalchemy import select, func, literal, union_all, or_, and_
+from database import db
+from models import ProductMovement, ProductBalance, ReconcileState, LedgerCheckpoint
+from rebuild import ledger_legs
+
+STATE_NAME = 'balances'
+CHUNK_SIZE = 1000
+SWEEP_CHUNKS = 10
+MAX_REPORTED = 1000
+
+
+def drift_query(products=None):
+    """(product_id, location_id, expected, stored) for every mismatched pair.
+
+    `products` optionally restricts the check, as for `ledger_legs`.
+    """
+    legs = ledger_legs(products)
+    combined = union_all(
+        select(
+            legs.c.product_id,
+            legs.c.location_id,
+            legs.c.qty.label('expected'),
+            literal(0).label('stored'),
+        ),
+        select(
+            ProductBalance.product_id,
+            ProductBalance.location_id,
+            literal(0).label('expected'),
+            ProductBalance.balance.label('stored'),
+        ).where(*([products(ProductBalance.product_id)] if products else [])),
+    ).subquery('combined')
+
+    expected = func.sum(combined.c.expected)
+    stored = func.sum(combined.c.stored)
+    return (
+        select(combined.c.product_id, combined.c.location_id,
+               expected.label('expected'), stored.label('stored'))
+        .group_by(combined.c.product_id, combined.c.location_id)
+        .having(expected != stored)
+        .order_by(combined.c.product_id, combined.c.location_id)
+    )
+
+
+def _check(products, repair):
+    rows = db.session.execute(drift_query(products)).all()
+    drift = [
+        {'product_id': row.product_id, 'location_id': row.location_id,
+         'expected': int(row.expected), 'stored': int(row.stored)}
+        for row in rows
+    ]
+    if repair and drift:
+        ProductBalance.apply_deltas({
+            (row['product_id'], row['location_id']): row['expected'] - row['stored'] for row in drift
+        })
+    db.session.commit()
+    return drift
+
+
+def check_product_range(first, last, repair=True):
+    """Verify products in [first, last]; returns the mismatched rows as dicts"""
+    return _check(lambda column: column.between(first, last), repair)
+
+
+def check_products(product_ids, repair=True):
+    """Verify the given products; returns the mismatched rows as dicts"""
+    return _check(lambda column: column.in_(product_ids), repair)
+
+
+def _product_ranges(chunk_size, after=None, limit=None):
+    """(first, last) bounds of consecutive runs of `chunk_size` product ids.
+
+    Covers every product with movements, checkpoints or balances, starting
+    after `after`.
+    """
+    ids = union_all(
+        select(ProductMovement.product_id.label('product_id')),
+        select(LedgerCheckpoint.product_id.label('product_id')),
+        select(ProductBalance.product_id.label('product_id')),
+    ).subquery('ids')
+    ranges = []
+    while limit is None or len(ranges) < limit:
+        query = select(ids.c.product_id).distinct().order_by(ids.c.product_id).limit(chunk_size)
+        if after is not None:
+            query = query.where(ids.c.product_id > after)
+        chunk = db.session.execute(query).scalars().all()
+        if not chunk:
+            break
+        ranges.append((chunk[0], chunk[-1]))
+        after = chunk[-1]
+    return ranges
+
+
+def _newest_movement():
+    return db.session.execute(
+        select(ProductMovement.timestamp, ProductMovement.movement_id)
+        .order_by(ProductMovement.timestamp.desc(), ProductMovement.movement_id.desc())
+        .limit(1)
+    ).first()
+
+
+def _recent_products(state):
+    """Products with movements past the high-water mark"""
+    query = select(ProductMovement.product_id).distinct().order_by(ProductMovement.product_id)
+    if state.high_water_timestamp is not None:
+        query = query.where(or_(
+            ProductMovement.timestamp > state.high_water_timestamp,
+            and_(ProductMovement.timestamp == state.high_water_timestamp,
+                 ProductMovement.movement_id > state.high_water_movement_id),
+        ))
+    return db.session.execute(query).scalars().all()
+
+
+def get_state():
+    state = db.session.get(ReconcileState, STATE_NAME)
+    if state is None:
+        state = ReconcileState(name=STATE_NAME)
+        db.session.add(state)
+    return state
+
+
+def reconcile(full=False, repair=True, chunk_size=CHUNK_SIZE, sweep_chunks=SWEEP_CHUNKS, progress=None):
+    """Verify balances and optionally repair drift; returns a report dict.
+
+    Callers should hold the `rebuild-balances` single-runner lock so that a
+    concurrent full rebuild cannot be mistaken for drift.
+    """
+    state = get_state()
+    started = datetime.utcnow()
+    mark = _newest_movement()
+
+    if full:
+        recent = []
+        sweep = _product_ranges(chunk_size)
+        sweep_product = None
+    else:
+        recent = _recent_products(state)
+        sweep = _product_ranges(chunk_size, after=state.sweep_product, limit=sweep_chunks)
+        if not sweep_chunks:
+            sweep_product = state.sweep_product
+        elif len(sweep) == sweep_chunks:
+            sweep_product = sweep[-1][1]
+        else:
+            # the sweep has passed the last product; start over next time
+            sweep_product = None
+
+    tasks = [
+        (check_products, recent[start:start + chunk_size]) for start in range(0, len(recent), chunk_size)
+    ] + [(check_product_range, *bounds) for bounds in sweep]
+
+    drift = []
+    for done, (check, *args) in enumerate(tasks, 1):
+        drift.extend(check(*args, repair=repair))
+        if progress:
+            progress(done * 100 // len(tasks), f"{done}/{len(tasks)} chunks checked, {len(drift)} drifted balances")
+    checked = len(tasks)
+
+    report = {
+        'mode': 'full' if full else 'incremental',
+        'repaired': repair,
+        'started_at': started.isoformat(),
+        'finished_at': datetime.utcnow().isoformat(),
+        'chunks_checked': checked,
+        'drift_count': len(drift),
+        'drift': drift[:MAX_REPORTED],
+    }
+
+    state = get_state()
+    # a dry run leaves the drift in place, so it must be looked at again
+    if repair:
+        if mark is not None:
+            state.high_water_timestamp, state.high_water_movement_id = mark.timestamp, mark.movement_id
+        state.sweep_product = sweep_product
+    state.last_run_at = started
+    state.last_report = json.dumps(report)
+    db.session.commit()
+    return report
+
+
+def last_report():
+    state = db.session.get(ReconcileState, STATE_NAME)
+    if state is None or not state.last_report:
+        return None
+    report = json.loads(state.last_report)
+    report['high_water'] = {
+        'timestamp': state.high_water_timestamp.isoformat() if state.high_water_timestamp else None,
+        'movement_id': state.high_water_movement_id,
+    }
+    report['sweep_position'] = state.sweep_product
+    return report
@@ -0,0 +1,71 @@
+from sqlalchemy import select, func, case
+from database import db
+from models import Product, Location, ProductBalance
+
+REPORT_SORTS = {
+    'product': (ProductBalance.product_id, ProductBalance.location_id),
+    'location': (ProductBalance.location_id, ProductBalance.product_id),
+    'balance_desc': (ProductBalance.balance.desc(), ProductBalance.product_id, ProductBalance.location_id),
+    'balance_asc': (ProductBalance.balance.asc(), ProductBalance.product_id, ProductBalance.location_id),
+}
+
+
+def balance_totals():
+    """Positive, negative and non-zero counts plus total units in one scan"""
+    row = db.session.execute(
+        select(
+            func.coalesce(func.sum(case((ProductBalance.balance > 0, 1), else_=0)), 0).label('positive'),
+            func.coalesce(func.sum(case((ProductBalance.balance < 0, 1), else_=0)), 0).label('negative'),
+            func.coalesce(func.sum(case((ProductBalance.balance != 0, 1), else_=0)), 0).label('nonzero'),
+            func.coalesce(func.sum(ProductBalance.balance), 0).label('total_units'),
+        )
+    ).one()
+    return row._asdict()
+
+
+def balance_rows_query(sort='product'):
+    """Non-zero balances with product and location names joined in"""
+    order_by = REPORT_SORTS.get(sort, REPORT_SORTS['product'])
+    return (
+        select(
+            ProductBalance.product_id,
+            Product.name.label('product_name'),
+            ProductBalance.location_id,
+            Location.name.label('location_name'),
+            ProductBalance.balance,
+            ProductBalance.last_updated,
+        )
+        .join(Product, Product.product_id == ProductBalance.product_id)
+        .join(Location, Location.location_id == ProductBalance.location_id)
+        .where(ProductBalance.balance != 0)
+        .order_by(*order_by)
+    )
+
+
+def balance_subtotals(group, ids):
+    """{id: summed non-zero balance} for the given product or location ids (`group`)"""
+    column = ProductBalance.product_id if group == 'product' else ProductBalance.location_id
+    if not ids:
+        return {}
+    return dict(db.session.execute(
+        select(column, func.sum(ProductBalance.balance))
+        .where(column.in_(sorted(ids)), ProductBalance.balance != 0)
+        .group_by(column)
+    ).all())
+
+
+def balance_report_page(page=1, per_page=100, sort='product', group=None):
+    """One page of the balance report, ordered and sliced in SQL.
+
+    With `group` ('product' or 'location') each row also carries
+    `<group>_subtotal`, read with one grouped query over the ids on the page.
+    """
+    page = max(page, 1)
+    query = balance_rows_query(sort).limit(per_page).offset((page - 1) * per_page)
+    rows = [row._asdict() for row in db.session.execute(query)]
+    if group in ('product', 'location'):
+        key = f'{group}_id'
+        subtotals = balance_subtotals(group, {row[key] for row in rows})
+        for row in rows:
+            row[f'{group}_subtotal'] = subtotals.get(row[key], 0)
+    return rows
@@ -0,0 +1,397 @@
+"""Hourly and daily movement rollups per product and per location.
+
+`movement_rollups` holds qty in, qty out and a movement count for every
+(granularity, dimension, entity, bucket). It is kept current from
+`movements_changed`: each add, edit or delete turns into signed deltas that
+are upserted inside the writer's transaction, so a rolled-back write leaves
+no trace in the rollups.
+
+For a product, qty in counts movements with a destination and qty out
+movements with a source, so a transfer counts on both sides. For a
+location, qty in and qty out are what arrived there and what left, and the
+count is the number of movement legs that touched it.
+
+Rows written before the rollups existed, or by tools that bypass the
+signal, are filled in by `backfill`, which recomputes whole days from
+the hot and archived movements with grouped queries.
+
+Range queries (`series`, `top`) read only the rollups: hourly buckets for
+``hour``, daily buckets for ``day``, ``week`` and ``month``.
+"""
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, delete, func, case, literal, union_all
+from database import db
+from models import MovementRollup
+from signals import movements_changed
+from ledger import partitions
+
+GRANULARITIES = ('hour', 'day')
+PERIODS = ('hour', 'day', 'week', 'month')
+DIMENSIONS = ('product', 'location')
+BACKFILL_DAYS = 31
+TOP_LIMIT = 20
+
+DEFAULT_SPAN = {
+    'hour': timedelta(days=2),
+    'day': timedelta(days=30),
+    'week': timedelta(weeks=12),
+    'month': timedelta(days=365),
+}
+MAX_SPAN = {
+    'hour': timedelta(days=31),
+    'day': timedelta(days=3 * 366),
+    'week': timedelta(days=3 * 366),
+    'month': timedelta(days=10 * 366),
+}
+
+
+def bucket_start(timestamp, granularity):
+    if granularity == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def period_start(bucket, period):
+    """Start of the hour, day, week (Monday) or month that holds `bucket`"""
+    if period == 'week':
+        return bucket_start(bucket, 'day') - timedelta(days=bucket.weekday())
+    if period == 'month':
+        return bucket_start(bucket, 'day').replace(day=1)
+    return bucket_start(bucket, period)
+
+
+def rollup_deltas(added=(), removed=()):
+    """{(granularity, dimension, entity_id, bucket): [qty_in, qty_out, count]}"""
+    deltas = {}
+
+    def add(key, qty_in, qty_out, count):
+        totals = deltas.setdefault(key, [0, 0, 0])
+        totals[0] += qty_in
+        totals[1] += qty_out
+        totals[2] += count
+
+    for sign, changes in ((1, added), (-1, removed)):
+        for change in changes:
+            qty = sign * change['qty']
+            for granularity in GRANULARITIES:
+                bucket = bucket_start(change['timestamp'], granularity)
+                add((granularity, 'product', change['product_id'], bucket),
+                    qty if change['to_location'] else 0, qty if change['from_location'] else 0, sign)
+                if change['from_location']:
+                    add((granularity, 'location', change['from_location'], bucket), 0, qty, sign)
+                if change['to_location']:
+                    add((granularity, 'location', change['to_location'], bucket), qty, 0, sign)
+    return deltas
+
+
+def _upsert_statement():
+    """Dialect-specific INSERT that adds to the counters on key conflict"""
+    table = MovementRollup.__table__
+    dialect = db.session.get_bind(mapper=MovementRollup).dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(
+            index_elements=[table.c.granularity, table.c.dimension, table.c.entity_id, table.c.bucket],
+            set_={
+                'qty_in': table.c.qty_in + stmt.excluded.qty_in,
+                'qty_out': table.c.qty_out + stmt.excluded.qty_out,
+                'movement_count': table.c.movement_count + stmt.excluded.movement_count,
+            },
+        )
+
+    if dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update(
+            qty_in=table.c.qty_in + stmt.inserted.qty_in,
+            qty_out=table.c.qty_out + stmt.inserted.qty_out,
+            movement_count=table.c.movement_count + stmt.inserted.movement_count,
+        )
+
+    return None
+
+
+def _increment_or_insert(row):
+    table = MovementRollup.__table__
+    updated = db.session.execute(
+        table.update()
+        .where(table.c.granularity == row['granularity'], table.c.dimension == row['dimension'],
+               table.c.entity_id == row['entity_id'], table.c.bucket == row['bucket'])
+        .values(qty_in=table.c.qty_in + row['qty_in'], qty_out=table.c.qty_out + row['qty_out'],
+                movement_count=table.c.movement_count + row['movement_count'])
+    ).rowcount
+    if not updated:
+        db.session.execute(table.insert().values(**row))
+
+
+def apply_rollup_deltas(deltas):
+    """Add `rollup_deltas` output to the stored rollups; caller commits"""
+    rows = [
+        {'granularity': granularity, 'dimension': dimension, 'entity_id': entity_id, 'bucket': bucket,
+         'qty_in': qty_in, 'qty_out': qty_out, 'movement_count': count}
+        for (granularity, dimension, entity_id, bucket), (qty_in, qty_out, count) in deltas.items()
+        if qty_in or qty_out or count
+    ]
+    if not rows:
+        return 0
+    stmt = _upsert_statement()
+    if stmt is None:
+        for row in rows:
+            _increment_or_insert(row)
+    else:
+        db.session.execute(stmt, rows)
+    return len(rows)
+
+
+def _bucket_expr(column, granularity):
+    """SQL truncating `column` to its bucket, or None where the dialect has no known way"""
+    dialect = db.session.get_bind(mapper=MovementRollup).dialect.name
+    if dialect == 'postgresql':
+        return func.date_trunc(granularity, column)
+    pattern = '%Y-%m-%d %H:00:00' if granularity == 'hour' else '%Y-%m-%d 00:00:00'
+    if dialect == 'sqlite':
+        return func.strftime(pattern, column)
+    if dialect in ('mysql', 'mariadb'):
+        return func.date_format(column, pattern)
+    return None
+
+
+def _streamed_rows(source, window, granularity):
+    """`_partition_rows` for other dialects: the window's movements streamed and bucketed here"""
+    rows = rollup_deltas(added=(
+        {'product_id': product_id, 'from_location': from_location, 'to_location': to_location,
+         'qty': qty, 'timestamp': timestamp}
+        for product_id, from_location, to_location, qty, timestamp in db.session.execute(
+            select(source.product_id, source.from_location, source.to_location, source.qty, source.timestamp)
+            .where(*window).execution_options(yield_per=5000)
+        )
+    ))
+    return ((key, values) for key, values in rows.items() if key[0] == granularity)
+
+
+def _partition_rows(source, bounds, granularity, start, end):
+    """Rollup rows for the movements of one table in [start, end), from two grouped queries"""
+    window = (source.timestamp >= start, source.timestamp < end, *bounds)
+    has_to = source.to_location.isnot(None)
+    has_from = source.from_location.isnot(None)
+
+    bucket = _bucket_expr(source.timestamp, granularity)
+    if bucket is None:
+        yield from _streamed_rows(source, window, granularity)
+        return
+    products = (
+        select(
+            literal('product').label('dimension'),
+            source.product_id.label('entity_id'),
+            bucket.label('bucket'),
+            func.sum(case((has_to, source.qty), else_=0)).label('qty_in'),
+            func.sum(case((has_from, source.qty), else_=0)).label('qty_out'),
+            func.count().label('movement_count'),
+        )
+        .where(*window)
+        .group_by(source.product_id, bucket)
+    )
+
+    legs = union_all(
+        select(source.to_location.label('entity_id'), source.timestamp,
+               source.qty.label('qty_in'), literal(0).label('qty_out'))
+        .where(*window, has_to),
+        select(source.from_location.label('entity_id'), source.timestamp,
+               literal(0).label('qty_in'), source.qty.label('qty_out'))
+        .where(*window, has_from),
+    ).subquery('legs')
+    leg_bucket = _bucket_expr(legs.c.timestamp, granularity)
+    locations = (
+        select(
+            literal('location').label('dimension'),
+            legs.c.entity_id,
+            leg_bucket.label('bucket'),
+            func.sum(legs.c.qty_in).label('qty_in'),
+            func.sum(legs.c.qty_out).label('qty_out'),
+            func.count().label('movement_count'),
+        )
+        .group_by(legs.c.entity_id, leg_bucket)
+    )
+
+    for query in (products, locations):
+        for row in db.session.execute(query):
+            value = row.bucket
+            yield (granularity, row.dimension, row.entity_id,
+                   value if isinstance(value, datetime) else datetime.fromisoformat(value)), \
+                [int(row.qty_in), int(row.qty_out), int(row.movement_count)]
+
+
+def _grouped_rows(granularity, start, end):
+    """Rollup rows for every movement in [start, end), hot and archived.
+
+    A bucket that straddles the archive boundary gets rows from both tables,
+    which are added up.
+    """
+    rows = {}
+    for source, bounds in partitions(start, end):
+        for key, values in _partition_rows(source, bounds, granularity, start, end):
+            if key in rows:
+                rows[key] = [a + b for a, b in zip(rows[key], values)]
+            else:
+                rows[key] = values
+    return rows
+
+
+def _movement_bounds():
+    ranges = [
+        db.session.execute(select(func.min(source.timestamp), func.max(source.timestamp)).where(*bounds)).one()
+        for source, bounds in partitions()
+    ]
+    firsts = [first for first, _ in ranges if first is not None]
+    lasts = [last for _, last in ranges if last is not None]
+    return (min(firsts), max(lasts)) if firsts else (None, None)
+
+
+def backfill(since=None, until=None, window_days=BACKFILL_DAYS, progress=None):
+    """Recompute the rollups of whole days in [since, until) from movements.
+
+    Defaults to the full movement history. Each window of `window_days`
+    days is deleted and rewritten in its own transaction. Live writes keep
+    going through the upsert, but callers should hold the
+    `rollups-backfill` single-runner lock. Returns the rows written.
+    """
+    first, last = _movement_bounds()
+    if first is None:
+        return 0
+    start = bucket_start(since or first, 'day')
+    end = until or last
+    if until is None or end > bucket_start(end, 'day'):
+        end = bucket_start(end, 'day') + timedelta(days=1)
+    if start >= end:
+        return 0
+
+    windows = []
+    cursor = start
+    while cursor < end:
+        windows.append((cursor, min(cursor + timedelta(days=window_days), end)))
+        cursor = windows[-1][1]
+
+    written = 0
+    for done, (window_start, window_end) in enumerate(windows, 1):
+        db.session.execute(delete(MovementRollup).where(
+            MovementRollup.bucket >= window_start, MovementRollup.bucket < window_end))
+        for granularity in GRANULARITIES:
+            written += apply_rollup_deltas(_grouped_rows(granularity, window_start, window_end))
+        db.session.commit()
+        if progress:
+            progress(done * 100 // len(windows), f"{window_end.date().isoformat()} done, {written} rows written")
+    return written
+
+
+def range_args(args):
+    """(period, since, until) from request args, with defaults and limits.
+
+    Raises ValueError for an unknown period or an invalid or oversized range.
+    """
+    from utils import parse_timestamp
+    period = args.get('granularity') or 'day'
+    if period not in PERIODS:
+        raise ValueError(f"granularity must be one of: {', '.join(PERIODS)}")
+    until = parse_timestamp(args.get('until')) or datetime.utcnow()
+    since = parse_timestamp(args.get('since')) or until - DEFAULT_SPAN[period]
+    if since >= until:
+        raise ValueError('since must be before until')
+    if until - since > MAX_SPAN[period]:
+        raise ValueError(f"Range is too long for {period} granularity; the limit is {MAX_SPAN[period].days} days")
+    # start on a period boundary so the first week or month is not a partial one
+    return period, period_start(since, period), until
+
+
+def _source(period):
+    return 'hour' if period == 'hour' else 'day'
+
+
+def series(dimension, entity_id, period, since, until):
+    """Totals per period for one entity, oldest first; empty periods are left out"""
+    rows = db.session.execute(
+        select(MovementRollup.bucket, MovementRollup.qty_in, MovementRollup.qty_out,
+               MovementRollup.movement_count)
+        .where(
+            MovementRollup.granularity == _source(period),
+            MovementRollup.dimension == dimension,
+            MovementRollup.entity_id == entity_id,
+            MovementRollup.bucket >= bucket_start(since, _source(period)),
+            MovementRollup.bucket < until,
+            MovementRollup.movement_count != 0,
+        )
+        .order_by(MovementRollup.bucket)
+    ).all()
+
+    periods = {}
+    for bucket, qty_in, qty_out, count in rows:
+        totals = periods.setdefault(period_start(bucket, period), [0, 0, 0])
+        totals[0] += qty_in
+        totals[1] += qty_out
+        totals[2] += count
+    return [
+        {'bucket': start.isoformat(), 'qty_in': qty_in, 'qty_out': qty_out, 'movements': count}
+        for start, (qty_in, qty_out, count) in periods.items()
+    ]
+
+
+def top(dimension, period, since, until, limit=TOP_LIMIT):
+    """Entities with the most qty moved in the range, busiest first"""
+    moved = func.sum(MovementRollup.qty_in) + func.sum(MovementRollup.qty_out)
+    rows = db.session.execute(
+        select(
+            MovementRollup.entity_id,
+            func.sum(MovementRollup.qty_in).label('qty_in'),
+            func.sum(MovementRollup.qty_out).label('qty_out'),
+            func.sum(MovementRollup.movement_count).label('movements'),
+        )
+        .where(
+            MovementRollup.granularity == _source(period),
+            MovementRollup.dimension == dimension,
+            MovementRollup.bucket >= bucket_start(since, _source(period)),
+            MovementRollup.bucket < until,
+        )
+        .group_by(MovementRollup.entity_id)
+        .having(func.sum(MovementRollup.movement_count) != 0)
+        .order_by(moved.desc(), MovementRollup.entity_id)
+        .limit(limit)
+    ).all()
+    return [
+        {'entity_id': row.entity_id, 'qty_in': int(row.qty_in), 'qty_out': int(row.qty_out),
+         'movements': int(row.movements)}
+        for row in rows
+    ]
+
+
+def activity(since, until, granularity='day'):
+    """Movements and qty in/out across all products for buckets in range"""
+    row = db.session.execute(
+        select(
+            func.coalesce(func.sum(MovementRollup.movement_count), 0),
+            func.coalesce(func.sum(MovementRollup.qty_in), 0),
+            func.coalesce(func.sum(MovementRollup.qty_out), 0),
+        )
+        .where(
+            MovementRollup.granularity == granularity,
+            MovementRollup.dimension == 'product',
+            MovementRollup.bucket >= bucket_start(since, granularity),
+            MovementRollup.bucket < until,
+        )
+    ).one()
+    return {'movements': int(row[0]), 'qty_in': int(row[1]), 'qty_out': int(row[2])}
+
+
+def _on_movements_changed(sender, added=(), removed=()):
+    if current_app.config.get('ROLLUPS_ENABLED', False):
+        apply_rollup_deltas(rollup_deltas(added, removed))
+
+
+def init_rollups(app):
+    app.config.setdefault('ROLLUPS_ENABLED', True)
+    # the receiver is process-wide and checks the current app's flag; connecting again is a no-op
+    movements_changed.connect(_on_movements_changed, weak=False)
@@ -1,30 +1,101 @@
-from flask import render_template, request, redirect, url_for, flash, current_app
+import json
+import os
+from datetime import datetime, timedelta
+from flask import (
+    render_template, request, redirect, url_for, flash, current_app, Response, stream_with_context, abort, send_file,
+)
 from database import db
-from models import Product, Location, ProductMovement, ProductBalance
-from forms import ProductForm, LocationForm, ProductMovementForm
-from sqlalchemy import func
+from models import Product, Location, ProductMovement, ProductBalance, ArchivedMovement
+from forms import ProductForm, LocationForm, ProductMovementForm, TransferOrderForm
+from sqlalchemy.exc import IntegrityError
+from signals import movements_changed
+from counters import bump
+from edits import (
+    VersionConflict, InsufficientStock, TransferLineMoved, update_movement, remove_movement, update_record, remove_record,
+)
+from ledger import MovementArchived, movement_page, iter_movements, movement_total, movement_count
+from cache import (
+    cache, cached_products, cached_locations, cached_product, cached_location, cached_balance,
+    invalidate_product, invalidate_location,
+)
+from reports import REPORT_SORTS, balance_totals, balance_rows_query, balance_report_page
+from pagination import (
+    page_args, product_search_query, location_search_query, fetch_page, list_total,
+)
+from jobs import jobs, get_job, recent_jobs, job_file
+from exports import DATASETS as EXPORT_DATASETS, FORMATS as EXPORT_FORMATS
+from utils import (
+    decode_cursor, parse_timestamp, movement_list_query, movement_row_to_dict,
+    get_product_summaries, get_location_summaries,
+)
+
+MOVEMENTS_PAGE_SIZE = 100
+MOVEMENTS_MAX_PAGE_SIZE = 1000
+MOVEMENTS_STREAM_BATCH = 1000
+VIEW_PAGE_SIZE = 50
+PAGING_ARGS = {'q', 'page', 'per_page', 'sort'}
+BULK_MAX_ROWS = 50000
+CONFLICT_MESSAGE = 'Someone else changed this record while you were editing it. Review the current values and try again.'
+REPORT_PAGE_SIZE = 100
+SUMMARY_MAX_IDS = 1000
+SUBMITTABLE_JOBS = (
+    'rebuild_balances', 'export_movements', 'reconcile_balances', 'backfill_rollups', 'reconcile_counters',
+)
+REPORT_MAX_PAGE_SIZE = 1000
+
+
+def edit_conflict(template, form_class, model, key, list_endpoint, name):
+    """Answer a version conflict with the edit form reloaded from the current row"""
+    db.session.rollback()
+    record = db.session.get(model, key)
+    if record is None:
+        flash(f'This {name} was deleted by someone else.', 'error')
+        return redirect(url_for(list_endpoint))
+    flash(CONFLICT_MESSAGE, 'error')
+    return render_template(template, form=form_class(formdata=None, obj=record), **{name: record}), 409
 
 
 def register_routes(app):
+    @app.template_filter('count_label')
+    def count_label(total):
+        """'N', or '~N' for a planner estimate and 'N+' for a capped count"""
+        if total['capped']:
+            return f"{total['count']:,}+"
+        return f"~{total['count']:,}" if total['approximate'] else f"{total['count']:,}"
 
     @app.route('/')
     def index():
-        product_count = Product.query.count()
-        location_count = Location.query.count()
-        movement_count = ProductMovement.query.count()
+        from counters import COUNTERS, counter_values, live_counts
+        from rollups import activity, top
+        counts = counter_values()
+        missing = [name for name in COUNTERS if name not in counts]
+        if missing:
+            # only until `init-db` or `counters reconcile` has run once
+            counts.update(live_counts(missing))
 
-        balance_count = ProductBalance.query.filter(ProductBalance.balance != 0).count()
+        now = datetime.utcnow()
+        week_ago = now - timedelta(days=7)
+        recent = {
+            'day': activity(now - timedelta(hours=24), now, 'hour'),
+            'week': activity(week_ago, now, 'day'),
+            'busiest': top('location', 'day', week_ago, now, limit=3),
+        }
 
         return render_template('index.html',
-                             product_count=product_count,
-                             location_count=location_count,
-                             movement_count=movement_count,
-                             balance_count=balance_count)
+                             product_count=counts['products'],
+                             location_count=counts['locations'],
+                             movement_count=counts['movements'],
+                             balance_count=counts['nonzero_balances'],
+                             recent=recent)
 
     @app.route('/products')
     def products():
-        products = Product.query.all()
-        return render_template('products.html', products=products)
+        page, per_page, sort, q = page_args(request.args, 'product_id')
+        query = product_search_query(q, sort)
+        products, has_more = fetch_page(query, page, per_page)
+        total = list_total(Product, query, filtered=bool(q))
+        return render_template('products.html', products=products, has_more=has_more, total=total,
+                               page=page, per_page=per_page, sort=sort, q=q)
 
     @app.route('/products/add', methods=['GET', 'POST'])
     def add_product():
@@ -41,6 +112,8 @@ def register_routes(app):
                 description=form.description.data
             )
             db.session.add(product)
+            bump({'products': 1})
+            invalidate_product(product.product_id)
             db.session.commit()
             flash('Product added successfully!', 'success')
             return redirect(url_for('products'))
@@ -52,8 +125,11 @@ def register_routes(app):
         form = ProductForm(obj=product)
         
         if form.validate_on_submit():
-            product.name = form.name.data
-            product.description = form.description.data
+            try:
+                update_record(product, form.version.data, name=form.name.data, description=form.description.data)
+            except VersionConflict:
+                return edit_conflict('edit_product.html', ProductForm, Product, product_id, 'products', 'product')
+            invalidate_product(product.product_id)
             db.session.commit()
             flash('Product updated successfully!', 'success')
             return redirect(url_for('products'))
@@ -63,27 +139,39 @@ def register_routes(app):
     @app.route('/products/view/<product_id>')
     def view_product(product_id):
         product = Product.query.get_or_404(product_id)
-        movements = ProductMovement.query.filter_by(product_id=product_id).order_by(ProductMovement.timestamp.desc()).all()
-        return render_template('view_product.html', product=product, movements=movements)
+        movements, next_cursor = movement_page(VIEW_PAGE_SIZE, product_id=product_id)
+        return render_template('view_product.html', product=product, movements=movements,
+                               next_cursor=next_cursor)
 
     @app.route('/products/delete/<product_id>', methods=['POST'])
     def delete_product(product_id):
         product = Product.query.get_or_404(product_id)
         
-        movement_count = ProductMovement.query.filter_by(product_id=product_id).count()
-        if movement_count > 0:
-            flash(f'Cannot delete product "{product.name}" because it has {movement_count} movement(s) associated with it.', 'error')
+        movements_total = movement_count(product_id=product_id)
+        if movements_total > 0:
+            flash(f'Cannot delete product "{product.name}" because it has {movements_total} movement(s) associated with it.', 'error')
             return redirect(url_for('view_product', product_id=product_id))
         
-        db.session.delete(product)
+        try:
+            remove_record(product, request.form.get('version', type=int))
+        except VersionConflict:
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'error')
+            return redirect(url_for('view_product', product_id=product_id))
+        bump({'products': -1})
+        invalidate_product(product_id)
         db.session.commit()
         flash(f'Product "{product.name}" has been deleted successfully!', 'success')
         return redirect(url_for('products'))
 
     @app.route('/locations')
     def locations():
-        locations = Location.query.all()
-        return render_template('locations.html', locations=locations)
+        page, per_page, sort, q = page_args(request.args, 'location_id')
+        query = location_search_query(q, sort)
+        locations, has_more = fetch_page(query, page, per_page)
+        total = list_total(Location, query, filtered=bool(q))
+        return render_template('locations.html', locations=locations, has_more=has_more, total=total,
+                               page=page, per_page=per_page, sort=sort, q=q)
 
     @app.route('/locations/add', methods=['GET', 'POST'])
     def add_location():
@@ -100,6 +188,8 @@ def register_routes(app):
                 description=form.description.data
             )
             db.session.add(location)
+            bump({'locations': 1})
+            invalidate_location(location.location_id)
             db.session.commit()
             flash('Location added successfully!', 'success')
             return redirect(url_for('locations'))
@@ -111,8 +201,11 @@ def register_routes(app):
         form = LocationForm(obj=location)
         
         if form.validate_on_submit():
-            location.name = form.name.data
-            location.description = form.description.data
+            try:
+                update_record(location, form.version.data, name=form.name.data, description=form.description.data)
+            except VersionConflict:
+                return edit_conflict('edit_location.html', LocationForm, Location, location_id, 'locations', 'location')
+            invalidate_location(location.location_id)
             db.session.commit()
             flash('Location updated successfully!', 'success')
             return redirect(url_for('locations'))
@@ -122,31 +215,49 @@ def register_routes(app):
     @app.route('/locations/view/<location_id>')
     def view_location(location_id):
         location = Location.query.get_or_404(location_id)
-        movements_from = ProductMovement.query.filter_by(from_location=location_id).order_by(ProductMovement.timestamp.desc()).all()
-        movements_to = ProductMovement.query.filter_by(to_location=location_id).order_by(ProductMovement.timestamp.desc()).all()
-        return render_template('view_location.html', location=location, movements_from=movements_from, movements_to=movements_to)
+        movements_from, next_from = movement_page(VIEW_PAGE_SIZE, location_id=location_id, direction='out')
+        movements_to, next_to = movement_page(VIEW_PAGE_SIZE, location_id=location_id, direction='in')
+        return render_template('view_location.html', location=location,
+                               movements_from=movements_from, next_from=next_from,
+                               movements_to=movements_to, next_to=next_to)
 
     @app.route('/locations/delete/<location_id>', methods=['POST'])
     def delete_location(location_id):
         location = Location.query.get_or_404(location_id)
         
-        movement_count_from = ProductMovement.query.filter_by(from_location=location_id).count()
-        movement_count_to = ProductMovement.query.filter_by(to_location=location_id).count()
+        movement_count_from = movement_count(from_location=location_id)
+        movement_count_to = movement_count(to_location=location_id)
         total_movements = movement_count_from + movement_count_to
         
         if total_movements > 0:
             flash(f'Cannot delete location "{location.name}" because it has {total_movements} movement(s) associated with it.', 'error')
             return redirect(url_for('view_location', location_id=location_id))
         
-        db.session.delete(location)
+        try:
+            remove_record(location, request.form.get('version', type=int))
+        except VersionConflict:
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'error')
+            return redirect(url_for('view_location', location_id=location_id))
+        bump({'locations': -1})
+        invalidate_location(location_id)
         db.session.commit()
         flash(f'Location "{location.name}" has been deleted successfully!', 'success')
         return redirect(url_for('locations'))
 
     @app.route('/movements')
     def movements():
-        movements = ProductMovement.query.order_by(ProductMovement.timestamp.desc()).all()
-        return render_template('movements.html', movements=movements)
+        q = (request.args.get('q') or '').strip()
+        per_page = max(1, min(request.args.get('per_page', VIEW_PAGE_SIZE, type=int), MOVEMENTS_MAX_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            abort(400)
+        movements, next_cursor = movement_page(per_page, search=q or None, after=after)
+        total = movement_total(search=q or None)
+        return render_template('movements.html', movements=movements, next_cursor=next_cursor,
+                               total=total, per_page=per_page, q=q)
 
     @app.route('/movements/add', methods=['GET', 'POST'])
     def add_movement():
@@ -157,31 +268,48 @@ def register_routes(app):
                 return render_template('add_movement.html', form=form)
             
             existing_movement = ProductMovement.query.filter_by(movement_id=form.movement_id.data).first()
-            if existing_movement:
+            if existing_movement or db.session.get(ArchivedMovement, form.movement_id.data):
                 flash('Movement ID already exists!', 'error')
                 return render_template('add_movement.html', form=form)
             
-            if form.from_location.data:
-                current_balance = ProductBalance.get_balance(form.product_id.data, form.from_location.data)
-                if current_balance < form.qty.data:
-                    flash(f'Insufficient stock! Current balance: {current_balance}, Requested: {form.qty.data}', 'error')
+            if current_app.extensions.get('intake') is not None:
+                from intake import enqueue, IntakeRejected
+                try:
+                    enqueue([{'movement_id': form.movement_id.data, 'product_id': form.product_id.data,
+                              'from_location': form.from_location.data, 'to_location': form.to_location.data,
+                              'qty': form.qty.data}])
+                except IntakeRejected as exc:
+                    flash('; '.join(exc.errors[0]['errors']), 'error')
                     return render_template('add_movement.html', form=form)
-            
+                flash('Movement queued; stock is checked when it is committed.', 'success')
+                return redirect(url_for('movements'))
+
             movement = ProductMovement(
                 movement_id=form.movement_id.data,
                 product_id=form.product_id.data,
                 from_location=form.from_location.data if form.from_location.data else None,
                 to_location=form.to_location.data if form.to_location.data else None,
-                qty=form.qty.data
+                qty=form.qty.data,
+                timestamp=datetime.utcnow()
             )
             db.session.add(movement)
             
             if form.from_location.data:
-                ProductBalance.update_balance(form.product_id.data, form.from_location.data, -form.qty.data)
+                if not ProductBalance.withdraw(form.product_id.data, form.from_location.data, form.qty.data):
+                    current_balance = ProductBalance.get_balance(form.product_id.data, form.from_location.data)
+                    db.session.rollback()
+                    flash(f'Insufficient stock! Current balance: {current_balance}, Requested: {form.qty.data}', 'error')
+                    return render_template('add_movement.html', form=form)
             if form.to_location.data:
                 ProductBalance.update_balance(form.product_id.data, form.to_location.data, form.qty.data)
+            movements_changed.send(ProductMovement, added=[movement.as_change()])
             
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                flash('Movement ID already exists!', 'error')
+                return render_template('add_movement.html', form=form)
             flash('Movement added successfully!', 'success')
             return redirect(url_for('movements'))
         return render_template('add_movement.html', form=form)
@@ -196,30 +324,16 @@ def register_routes(app):
                 flash('At least one location (From or To) must be specified!', 'error')
                 return render_template('edit_movement.html', form=form, movement=movement)
             
-            if movement.from_location:
-                ProductBalance.update_balance(movement.product_id, movement.from_location, movement.qty)
-            if movement.to_location:
-                ProductBalance.update_balance(movement.product_id, movement.to_location, -movement.qty)
-            
-            if form.from_location.data:
-                current_balance = ProductBalance.get_balance(form.product_id.data, form.from_location.data)
-                if current_balance < form.qty.data:
-                    if movement.from_location:
-                        ProductBalance.update_balance(movement.product_id, movement.from_location, -movement.qty)
-                    if movement.to_location:
-                        ProductBalance.update_balance(movement.product_id, movement.to_location, movement.qty)
-                    flash(f'Insufficient stock! Current balance: {current_balance}, Requested: {form.qty.data}', 'error')
-                    return render_template('edit_movement.html', form=form, movement=movement)
-            
-            movement.product_id = form.product_id.data
-            movement.from_location = form.from_location.data if form.from_location.data else None
-            movement.to_location = form.to_location.data if form.to_location.data else None
-            movement.qty = form.qty.data
-            
-            if form.from_location.data:
-                ProductBalance.update_balance(form.product_id.data, form.from_location.data, -form.qty.data)
-            if form.to_location.data:
-                ProductBalance.update_balance(form.product_id.data, form.to_location.data, form.qty.data)
+            try:
+                update_movement(movement, form.version.data, form.product_id.data,
+                                form.from_location.data, form.to_location.data, form.qty.data)
+            except VersionConflict:
+                return edit_conflict('edit_movement.html', ProductMovementForm, ProductMovement, movement_id,
+                                     'movements', 'movement')
+            except (InsufficientStock, MovementArchived, TransferLineMoved) as exc:
+                db.session.rollback()
+                flash(str(exc), 'error')
+                return render_template('edit_movement.html', form=form, movement=movement)
             
             db.session.commit()
             flash('Movement updated successfully!', 'success')
@@ -229,127 +343,899 @@ def register_routes(app):
 
     @app.route('/movements/view/<movement_id>')
     def view_movement(movement_id):
-        movement = ProductMovement.query.get_or_404(movement_id)
-        return render_template('view_movement.html', movement=movement)
+        movement = db.session.get(ProductMovement, movement_id)
+        if movement is None:
+            movement = db.session.get(ArchivedMovement, movement_id) or abort(404)
+            return render_template('view_movement.html', movement=movement, archived=True)
+        return render_template('view_movement.html', movement=movement, archived=False)
 
     @app.route('/movements/delete/<movement_id>', methods=['POST'])
     def delete_movement(movement_id):
         movement = ProductMovement.query.get_or_404(movement_id)
         
-        if movement.from_location:
-            ProductBalance.update_balance(movement.product_id, movement.from_location, movement.qty)
-        if movement.to_location:
-            ProductBalance.update_balance(movement.product_id, movement.to_location, -movement.qty)
-        
-        db.session.delete(movement)
+        try:
+            remove_movement(movement, request.form.get('version', type=int))
+        except VersionConflict:
+            db.session.rollback()
+            flash(CONFLICT_MESSAGE, 'error')
+            if db.session.get(ProductMovement, movement_id) is None:
+                return redirect(url_for('movements'))
+            return redirect(url_for('view_movement', movement_id=movement_id))
+        except MovementArchived as exc:
+            db.session.rollback()
+            flash(str(exc), 'error')
+            return redirect(url_for('view_movement', movement_id=movement_id))
         db.session.commit()
         flash(f'Movement "{movement.movement_id}" has been deleted successfully!', 'success')
         return redirect(url_for('movements'))
 
+    @app.route('/transfers')
+    def transfers():
+        from transfers import recent_transfers
+        return render_template('transfers.html', transfers=recent_transfers(limit=VIEW_PAGE_SIZE))
+
+    @app.route('/transfers/add', methods=['GET', 'POST'])
+    def add_transfer():
+        from transfers import create_transfer, TransferError
+        form = TransferOrderForm()
+        if form.validate_on_submit():
+            try:
+                transfer = create_transfer(form.transfer_id.data, form.from_location.data, form.to_location.data,
+                                           form.filled_lines(), note=form.note.data)
+            except TransferError as exc:
+                flash(str(exc), 'error')
+                for error in exc.errors:
+                    flash(f"Line {error['row'] + 1}: {'; '.join(error['errors'])}", 'error')
+                return render_template('add_transfer.html', form=form)
+            flash(f'Transfer "{transfer.transfer_id}" with {transfer.lines} lines added successfully!', 'success')
+            return redirect(url_for('view_transfer', transfer_id=transfer.transfer_id))
+        return render_template('add_transfer.html', form=form)
+
+    @app.route('/transfers/view/<transfer_id>')
+    def view_transfer(transfer_id):
+        from models import TransferOrder
+        from transfers import transfer_lines
+        transfer = db.session.get(TransferOrder, transfer_id) or abort(404)
+        return render_template('view_transfer.html', transfer=transfer, lines=transfer_lines(transfer_id))
+
     @app.route('/balance_report')
     def balance_report():
-        balances = ProductBalance.get_all_balances()
+        group = request.args.get('group', '')
+        if group not in ('product', 'location'):
+            group = ''
+        sort = request.args.get('sort') or group or 'product'
+        if sort not in REPORT_SORTS:
+            sort = 'product'
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = max(1, min(request.args.get('per_page', REPORT_PAGE_SIZE, type=int), REPORT_MAX_PAGE_SIZE))
+
+        totals = balance_totals()
+        balance_data = balance_report_page(page=page, per_page=per_page, sort=sort, group=group or None)
+        pages = max((totals['nonzero'] + per_page - 1) // per_page, 1)
 
-        positive_balances = ProductBalance.query.filter(ProductBalance.balance > 0).count()
-        negative_balances = ProductBalance.query.filter(ProductBalance.balance < 0).count()
-        total_units = db.session.query(func.sum(ProductBalance.balance)).scalar() or 0
-        
-        balance_data = []
-        for balance in balances:
-            balance_data.append({
-                'product_id': balance.product_id,
-                'product_name': balance.product.name,
-                'location_id': balance.location_id,
-                'location_name': balance.location.name,
-                'balance': balance.balance,
-                'last_updated': balance.last_updated
-            })
-        
-        balance_data.sort(key=lambda x: (x['product_id'], x['location_id']))
-        
         return render_template('balance_report.html', balance_data=balance_data,
-                               positive_balances=positive_balances,
-                               negative_balances=negative_balances,
-                               total_units=total_units)
+                               positive_balances=totals['positive'],
+                               negative_balances=totals['negative'],
+                               total_units=totals['total_units'],
+                               total_records=totals['nonzero'],
+                               page=page, pages=pages, per_page=per_page,
+                               sort=sort, group=group)
     
     @app.route('/api/products', methods=['GET'])
     def api_products():
-        """API endpoint to get all products"""
-        products = Product.query.all()
+        """API endpoint to get all products.
+
+        With any of `q`, `page`, `per_page` or `sort` it returns one page of
+        matching products instead, for incremental loading.
+        """
+        if not PAGING_ARGS.intersection(request.args):
+            return {'products': cached_products()}
+        page, per_page, sort, q = page_args(request.args, 'product_id')
+        products, has_more = fetch_page(product_search_query(q, sort), page, per_page)
         return {
             'products': [
-                {
-                    'product_id': p.product_id,
-                    'name': p.name,
-                    'description': p.description
-                } for p in products
-            ]
+                {'product_id': p.product_id, 'name': p.name, 'description': p.description, 'version': p.version}
+                for p in products
+            ],
+            'page': page,
+            'per_page': per_page,
+            'has_more': has_more
         }
     
     @app.route('/api/locations', methods=['GET'])
     def api_locations():
-        """API endpoint to get all locations"""
-        locations = Location.query.all()
+        """API endpoint to get all locations.
+
+        With any of `q`, `page`, `per_page` or `sort` it returns one page of
+        matching locations instead, for incremental loading.
+        """
+        if not PAGING_ARGS.intersection(request.args):
+            return {'locations': cached_locations()}
+        page, per_page, sort, q = page_args(request.args, 'location_id')
+        locations, has_more = fetch_page(location_search_query(q, sort), page, per_page)
         return {
             'locations': [
-                {
-                    'location_id': l.location_id,
-                    'name': l.name,
-                    'description': l.description
-                } for l in locations
-            ]
+                {'location_id': l.location_id, 'name': l.name, 'description': l.description,
+                 'version': l.version}
+                for l in locations
+            ],
+            'page': page,
+            'per_page': per_page,
+            'has_more': has_more
         }
     
     @app.route('/api/movements', methods=['GET'])
     def api_movements():
-        """API endpoint to get all movements"""
-        movements = ProductMovement.query.order_by(ProductMovement.timestamp.desc()).all()
+        """API endpoint to page through movements, newest first.
+
+        Query parameters: `product_id`, `location_id` (either side of the
+        movement, or one side with `direction=in|out`), `q` (movement id
+        prefix or exact product/location id), `since`/`until` (ISO
+        timestamps), `limit` and `cursor` (the `next_cursor` of the previous
+        page). With `format=ndjson` every matching row is streamed as one JSON
+        object per line instead.
+        """
+        try:
+            since = parse_timestamp(request.args.get('since'))
+            until = parse_timestamp(request.args.get('until'))
+            cursor = request.args.get('cursor')
+            after = decode_cursor(cursor) if cursor else None
+            limit = request.args.get('limit', MOVEMENTS_PAGE_SIZE, type=int)
+        except ValueError as exc:
+            return {'error': str(exc)}, 400
+        limit = max(1, min(limit, MOVEMENTS_MAX_PAGE_SIZE))
+
+        criteria = {
+            'product_id': request.args.get('product_id'),
+            'location_id': request.args.get('location_id'),
+            'direction': request.args.get('direction'),
+            'search': request.args.get('q') or None,
+            'since': since,
+            'until': until,
+            'after': after,
+        }
+
+        if request.args.get('format') == 'ndjson':
+            def generate():
+                for row in iter_movements(MOVEMENTS_STREAM_BATCH, **criteria):
+                    yield json.dumps(movement_row_to_dict(row)) + '\n'
+
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        rows, next_cursor = movement_page(limit, **criteria)
         return {
-            'movements': [
-                {
-                    'movement_id': m.movement_id,
-                    'product_id': m.product_id,
-                    'product_name': m.product.name,
-                    'from_location': m.from_location,
-                    'from_location_name': m.from_loc.name if m.from_loc else None,
-                    'to_location': m.to_location,
-                    'to_location_name': m.to_loc.name if m.to_loc else None,
-                    'qty': m.qty,
-                    'timestamp': m.timestamp.isoformat()
-                } for m in movements
-            ]
+            'movements': [movement_row_to_dict(row) for row in rows],
+            'next_cursor': next_cursor
         }
     
+    @app.route('/api/export/<dataset>', methods=['GET'])
+    def api_export(dataset):
+        """API endpoint streaming a full or incremental export.
+
+        `dataset` is `movements`, `balances` or `location_summary`;
+        `format` is `csv` (default), `csv.gz`, `ndjson` or `ndjson.gz`.
+        Movement exports run in recording order and accept `since` / `until`
+        (ISO timestamps), `cursor`, `product_id` and `location_id`; the
+        `X-Export-Next-Cursor` header is the `cursor` for the next
+        incremental export.
+        """
+        from exports import prepare, stream
+
+        fmt = request.args.get('format', 'csv')
+        if dataset not in EXPORT_DATASETS:
+            return {'error': f"dataset must be one of: {', '.join(EXPORT_DATASETS)}"}, 404
+        if fmt not in EXPORT_FORMATS:
+            return {'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}, 400
+        try:
+            since = parse_timestamp(request.args.get('since'))
+            until = parse_timestamp(request.args.get('until'))
+            cursor = request.args.get('cursor')
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as exc:
+            return {'error': str(exc)}, 400
+
+        query, next_cursor = prepare(
+            dataset, since=since, until=until, after=after,
+            product_id=request.args.get('product_id'),
+            location_id=request.args.get('location_id'),
+        )
+        mimetype, extension = EXPORT_FORMATS[fmt]
+        headers = {'Content-Disposition': f'attachment; filename="{dataset}{extension}"'}
+        if next_cursor:
+            headers['X-Export-Next-Cursor'] = next_cursor
+        return Response(stream_with_context(stream(query, fmt)), mimetype=mimetype, headers=headers)
+
+    @app.route('/api/movements/bulk', methods=['POST'])
+    def api_movements_bulk():
+        """API endpoint to record a batch of movements in one transaction.
+
+        Accepts a JSON list (or `{"movements": [...]}`) or CSV with a header
+        row. Rows are validated in order against current stock; pass
+        `allow_partial=1` to store the valid rows even if others are rejected.
+        With `async=1` the body is handed to a background import job and the
+        job is returned with status 202.
+        """
+        from ingest import parse_batch, ingest_movements, BatchError
+        allow_partial = request.args.get('allow_partial', '').lower() in ('1', 'true', 'yes')
+        try:
+            rows = parse_batch(request.get_data(), request.content_type)
+        except BatchError as exc:
+            return {'error': str(exc)}, 400
+
+        max_rows = current_app.config.get('BULK_MAX_ROWS', BULK_MAX_ROWS)
+        if len(rows) > max_rows:
+            return {'error': f'Batch too large: {len(rows)} rows (max {max_rows})'}, 413
+
+        if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+            path = job_file('import', '.csv' if 'csv' in (request.content_type or '') else '.json')
+            with open(path, 'wb') as fh:
+                fh.write(request.get_data())
+            job = jobs.submit('import_movements', {
+                'path': path,
+                'content_type': request.content_type,
+                'allow_partial': allow_partial,
+            })
+            return job.to_dict(), 202
+
+        result = ingest_movements(rows, allow_partial=allow_partial)
+        if result.get('conflicts'):
+            status = 409
+        else:
+            status = 201 if result['accepted'] else 422
+        return result, status
+
+    if 'csrf' in app.extensions:
+        app.extensions['csrf'].exempt(api_movements_bulk)
+
+    @app.route('/api/transfers', methods=['GET', 'POST'])
+    def api_transfers():
+        """API endpoint to list recent transfer orders or record one.
+
+        POST takes `transfer_id`, `from_location`, `to_location`, optional
+        `note` and `lines` (objects with `product_id`, `qty` and optionally
+        `movement_id`). All lines are stored in one transaction or none is:
+        201 with the transfer, 422 with per-line `errors`, 409 if the id is
+        taken or stock was taken by a concurrent writer.
+        """
+        from transfers import create_transfer, recent_transfers, transfer_lines, transfer_to_dict, TransferError
+        if request.method == 'GET':
+            limit = max(1, min(request.args.get('limit', VIEW_PAGE_SIZE, type=int), MOVEMENTS_MAX_PAGE_SIZE))
+            return {'transfers': [transfer_to_dict(t) for t in recent_transfers(limit=limit)]}
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return {'error': 'Expected a JSON object'}, 400
+        lines = data.get('lines')
+        if not isinstance(lines, list) or not all(isinstance(line, dict) for line in lines):
+            return {'error': 'lines must be a list of objects'}, 400
+        try:
+            transfer = create_transfer(data.get('transfer_id'), data.get('from_location'), data.get('to_location'),
+                                       lines, note=data.get('note'))
+        except TransferError as exc:
+            return exc.to_dict(), exc.status
+        return transfer_to_dict(transfer, transfer_lines(transfer.transfer_id)), 201
+
+    if 'csrf' in app.extensions:
+        app.extensions['csrf'].exempt(api_transfers)
+
+    @app.route('/api/transfers/<transfer_id>', methods=['GET'])
+    def api_transfer(transfer_id):
+        """API endpoint for one transfer order with its lines"""
+        from models import TransferOrder
+        from transfers import transfer_lines, transfer_to_dict
+        transfer = db.session.get(TransferOrder, transfer_id)
+        if transfer is None:
+            return {'error': 'Transfer not found'}, 404
+        return transfer_to_dict(transfer, transfer_lines(transfer_id))
+
+    @app.route('/api/intake/movements', methods=['POST'])
+    def api_intake_movements():
+        """API endpoint to queue movements for group commit (intake mode).
+
+        Takes the bodies `/api/movements/bulk` takes, or a single JSON
+        object. Rows are checked for shape only and acknowledged with 202
+        once durably queued; stock is checked when they are committed (see
+        `/api/intake/status/<movement_id>`). A malformed or already queued
+        row rejects the request with 422 and queues nothing.
+        """
+        from intake import enqueue, IntakeRejected
+        from ingest import parse_batch, BatchError
+        if current_app.extensions.get('intake') is None:
+            return {'error': 'Intake mode is off'}, 404
+        data = request.get_json(silent=True) if request.is_json else None
+        if isinstance(data, dict) and 'movements' not in data:
+            rows = [data]
+        else:
+            try:
+                rows = parse_batch(request.get_data(), request.content_type)
+            except BatchError as exc:
+                return {'error': str(exc)}, 400
+        max_rows = current_app.config.get('BULK_MAX_ROWS', BULK_MAX_ROWS)
+        if not rows:
+            return {'error': 'No movements given'}, 400
+        if len(rows) > max_rows:
+            return {'error': f'Batch too large: {len(rows)} rows (max {max_rows})'}, 413
+        try:
+            return enqueue(rows), 202
+        except IntakeRejected as exc:
+            return {'error': str(exc), 'errors': exc.errors}, 422
+
+    if 'csrf' in app.extensions:
+        app.extensions['csrf'].exempt(api_intake_movements)
+
+    @app.route('/api/intake', methods=['GET'])
+    def api_intake():
+        """API endpoint for queue depth, committer progress and recent rejections"""
+        from intake import intake_stats
+        intake = current_app.extensions.get('intake')
+        if intake is None:
+            return {'error': 'Intake mode is off'}, 404
+        limit = max(1, min(request.args.get('rejected', 20, type=int), 1000))
+        stats = intake_stats()
+        stats['recent_rejections'] = [
+            {'seq': row['seq'], 'movement_id': row['movement_id'], 'errors': json.loads(row['errors'] or '[]')}
+            for row in intake.queue.rejected(limit=limit)
+        ]
+        return stats
+
+    @app.route('/api/intake/status/<movement_id>', methods=['GET'])
+    def api_intake_status(movement_id):
+        """API endpoint: is a queued movement still pending, rejected or applied"""
+        from intake import intake_status
+        if current_app.extensions.get('intake') is None:
+            return {'error': 'Intake mode is off'}, 404
+        status = intake_status(movement_id)
+        if status is None:
+            return {'error': 'Movement not found'}, 404
+        return status
+
+    def version_arg(data):
+        version = data.get('version')
+        if not isinstance(version, int) or isinstance(version, bool):
+            raise ValueError('version (the integer last read) is required')
+        return version
+
+    def conflict_response(model, key):
+        db.session.rollback()
+        record = db.session.get(model, key)
+        if record is None:
+            return {'error': 'Deleted by someone else'}, 409
+        return {'error': CONFLICT_MESSAGE, 'current_version': record.version}, 409
+
+    @app.route('/api/movements/<movement_id>', methods=['GET', 'PUT', 'DELETE'])
+    def api_movement(movement_id):
+        """API endpoint to read, change or delete one movement.
+
+        PUT takes any of `product_id`, `from_location`, `to_location` and
+        `qty` plus the `version` that was read; DELETE takes `?version=`.
+        A stale version is answered with 409 and `current_version`.
+        """
+        movement = db.session.get(ProductMovement, movement_id)
+        if movement is None:
+            archived = db.session.execute(
+                movement_list_query(source=ArchivedMovement).where(ArchivedMovement.movement_id == movement_id)
+            ).first()
+            if archived is None:
+                return {'error': 'Movement not found'}, 404
+            if request.method != 'GET':
+                return {'error': 'Archived movements are read-only'}, 409
+            return movement_row_to_dict(archived)
+
+        if request.method == 'DELETE':
+            version = request.args.get('version', type=int)
+            if version is None:
+                return {'error': 'version (the integer last read) is required'}, 400
+            try:
+                remove_movement(movement, version)
+            except VersionConflict:
+                return conflict_response(ProductMovement, movement_id)
+            except MovementArchived as exc:
+                db.session.rollback()
+                return {'error': str(exc)}, 409
+            db.session.commit()
+            return {'deleted': True}
+
+        if request.method == 'PUT':
+            data = request.get_json(silent=True) or {}
+            try:
+                version = version_arg(data)
+            except ValueError as exc:
+                return {'error': str(exc)}, 400
+            product_id = data.get('product_id', movement.product_id)
+            from_location = data.get('from_location', movement.from_location) or None
+            to_location = data.get('to_location', movement.to_location) or None
+            qty = data.get('qty', movement.qty)
+            if not isinstance(qty, int) or isinstance(qty, bool) or qty < 1:
+                return {'error': 'qty must be a positive integer'}, 400
+            if not from_location and not to_location:
+                return {'error': 'At least one location (from or to) must be specified'}, 400
+            if cached_product(product_id) is None:
+                return {'error': 'Product not found'}, 400
+            if any(cached_location(l) is None for l in (from_location, to_location) if l):
+                return {'error': 'Location not found'}, 400
+            try:
+                update_movement(movement, version, product_id, from_location, to_location, qty)
+            except VersionConflict:
+                return conflict_response(ProductMovement, movement_id)
+            except InsufficientStock as exc:
+                db.session.rollback()
+                return {'error': str(exc), 'balance': exc.balance}, 422
+            except (MovementArchived, TransferLineMoved) as exc:
+                db.session.rollback()
+                return {'error': str(exc)}, 409
+            db.session.commit()
+
+        row = db.session.execute(
+            movement_list_query().where(ProductMovement.movement_id == movement_id)
+        ).first()
+        return movement_row_to_dict(row)
+
+    @app.route('/api/products/<product_id>', methods=['GET', 'PUT'])
+    def api_product(product_id):
+        """API endpoint to read one product, or to change its `name` and
+        `description` under the `version` that was read (409 if stale)"""
+        product = db.session.get(Product, product_id)
+        if product is None:
+            return {'error': 'Product not found'}, 404
+        if request.method == 'PUT':
+            data = request.get_json(silent=True) or {}
+            try:
+                version = version_arg(data)
+            except ValueError as exc:
+                return {'error': str(exc)}, 400
+            if not (data.get('name', product.name) or '').strip():
+                return {'error': 'name must not be empty'}, 400
+            try:
+                update_record(product, version, name=data.get('name', product.name),
+                              description=data.get('description', product.description))
+            except VersionConflict:
+                return conflict_response(Product, product_id)
+            invalidate_product(product_id)
+            db.session.commit()
+        return {'product_id': product.product_id, 'name': product.name,
+                'description': product.description, 'version': product.version}
+
+    @app.route('/api/locations/<location_id>', methods=['GET', 'PUT'])
+    def api_location(location_id):
+        """API endpoint to read one location, or to change its `name` and
+        `description` under the `version` that was read (409 if stale)"""
+        location = db.session.get(Location, location_id)
+        if location is None:
+            return {'error': 'Location not found'}, 404
+        if request.method == 'PUT':
+            data = request.get_json(silent=True) or {}
+            try:
+                version = version_arg(data)
+            except ValueError as exc:
+                return {'error': str(exc)}, 400
+            if not (data.get('name', location.name) or '').strip():
+                return {'error': 'name must not be empty'}, 400
+            try:
+                update_record(location, version, name=data.get('name', location.name),
+                              description=data.get('description', location.description))
+            except VersionConflict:
+                return conflict_response(Location, location_id)
+            invalidate_location(location_id)
+            db.session.commit()
+        return {'location_id': location.location_id, 'name': location.name,
+                'description': location.description, 'version': location.version}
+
+    if 'csrf' in app.extensions:
+        for view in (api_movement, api_product, api_location):
+            app.extensions['csrf'].exempt(view)
+    
     @app.route('/api/balance', methods=['GET'])
     def api_balance():
-        """API endpoint to get current balance report"""
-        balances = ProductBalance.get_all_balances()
+        """API endpoint to get current balance report.
+
+        With `as_of=<ISO timestamp>` the balances at that moment are returned
+        instead, starting from the nearest earlier snapshot; `product_id` and
+        `location_id` narrow the point-in-time result.
+        """
+        try:
+            as_of = parse_timestamp(request.args.get('as_of'))
+        except ValueError as exc:
+            return {'error': str(exc)}, 400
+        
+        if as_of is not None:
+            from snapshots import balances_as_of_query
+            query, base = balances_as_of_query(
+                as_of,
+                product_id=request.args.get('product_id'),
+                location_id=request.args.get('location_id'),
+            )
+            return {
+                'as_of': as_of.isoformat(),
+                'snapshot_at': base.isoformat() if base else None,
+                'balances': [
+                    {
+                        'product_id': b.product_id,
+                        'product_name': b.product_name,
+                        'location_id': b.location_id,
+                        'location_name': b.location_name,
+                        'balance': b.balance
+                    } for b in db.session.execute(query)
+                ]
+            }
+        
+        rows = db.session.execute(balance_rows_query())
         return {
             'balances': [
                 {
                     'product_id': b.product_id,
-                    'product_name': b.product.name,
+                    'product_name': b.product_name,
                     'location_id': b.location_id,
-                    'location_name': b.location.name,
+                    'location_name': b.location_name,
                     'balance': b.balance,
                     'last_updated': b.last_updated.isoformat()
-                } for b in balances
+                } for b in rows
             ]
         }
     
     @app.route('/api/balance/<product_id>/<location_id>', methods=['GET'])
     def api_product_balance(product_id, location_id):
-        """API endpoint to get balance for a specific product at a location"""
-        balance = ProductBalance.get_balance(product_id, location_id)
-        product = Product.query.get_or_404(product_id)
-        location = Location.query.get_or_404(location_id)
+        """API endpoint to get balance for a specific product at a location.
+
+        In intake mode `pending=1` (the default with INTAKE_READ_YOUR_WRITES)
+        adds movements still queued for commit: `balance` then includes
+        them, next to `committed_balance` and `pending_delta`.
+        """
+        product = cached_product(product_id)
+        location = cached_location(location_id)
+        if product is None or location is None:
+            abort(404)
         
-        return {
+        result = {
             'product_id': product_id,
-            'product_name': product.name,
+            'product_name': product['name'],
             'location_id': location_id,
-            'location_name': location.name,
-            'balance': balance
+            'location_name': location['name'],
+        }
+        default = '1' if current_app.config.get('INTAKE_READ_YOUR_WRITES') else ''
+        if (current_app.extensions.get('intake') is not None
+                and request.args.get('pending', default).lower() in ('1', 'true', 'yes')):
+            from intake import balance_with_pending
+            committed, pending = balance_with_pending(product_id, location_id)
+            result.update(balance=committed + pending, committed_balance=committed, pending_delta=pending)
+            return result
+        result['balance'] = cached_balance(product_id, location_id)
+        return result
+
+    def id_list_arg(name):
+        value = request.args.get(name)
+        if value is None:
+            return None
+        return [part.strip() for part in value.split(',') if part.strip()]
+
+    @app.route('/api/availability', methods=['GET'])
+    def api_availability():
+        """API endpoint: which locations could fulfil an order, answered from
+        the in-memory balance index when enabled.
+
+        The order is `product_id` + `qty`, or `items=PID:50,PID2:10`; the
+        same product listed twice needs the sum. `locations=L1,L2`
+        restricts the search to a region. Locations are ranked by their
+        stock of the first product.
+        """
+        from balance_index import availability
+        if request.args.get('items'):
+            wanted = [part.rpartition(':') for part in id_list_arg('items')]
+            pairs = [(product_id.strip(), qty.strip()) for product_id, _, qty in wanted]
+        elif request.args.get('product_id'):
+            pairs = [(request.args['product_id'], request.args.get('qty', '1'))]
+        else:
+            return {'error': 'product_id (with qty) or items=PID:QTY,... is required'}, 400
+        items = {}
+        for product_id, qty in pairs:
+            try:
+                wanted_qty = int(qty)
+            except ValueError:
+                wanted_qty = 0
+            if not product_id or wanted_qty < 1:
+                return {'error': f'Invalid item {product_id}:{qty}; quantities are positive integers'}, 400
+            items[product_id] = items.get(product_id, 0) + wanted_qty
+        if len(items) > 100:
+            return {'error': 'At most 100 products per query'}, 400
+        limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+        items = list(items.items())
+        totals, matches, matching, source = availability(items, id_list_arg('locations'), limit)
+        return {
+            'items': [
+                {'product_id': product_id, 'qty': qty, 'total': total}
+                for (product_id, qty), total in zip(items, totals)
+            ],
+            'matching': matching,
+            'locations': [
+                {'location_id': location_id, 'balances': dict(zip((p for p, _ in items), balances))}
+                for location_id, balances in matches
+            ],
+            'source': source,
+        }
+
+    @app.route('/api/availability/top', methods=['GET'])
+    def api_availability_top():
+        """API endpoint for the products (`by=product`, optionally at
+        `location_id`) or locations (`by=location`, optionally of
+        `product_id`) holding the most stock"""
+        from balance_index import top
+        by = request.args.get('by', 'product')
+        if by not in ('product', 'location'):
+            return {'error': 'by must be product or location'}, 400
+        within = request.args.get('location_id' if by == 'product' else 'product_id') or None
+        limit = max(1, min(request.args.get('limit', 20, type=int), 1000))
+        ranked, source = top(by, within, limit)
+        return {
+            'by': by,
+            'within': within,
+            'top': [{f'{by}_id': key, 'balance': balance} for key, balance in ranked],
+            'source': source,
+        }
+
+    @app.route('/api/availability/totals', methods=['GET'])
+    def api_availability_totals():
+        """API endpoint for summed balances per product or per location
+        (`by`), for `ids=a,b` or every id holding stock"""
+        from balance_index import totals
+        by = request.args.get('by', 'location')
+        if by not in ('product', 'location'):
+            return {'error': 'by must be product or location'}, 400
+        ids = id_list_arg('ids')
+        if ids is not None and len(ids) > 1000:
+            return {'error': 'At most 1000 ids per query'}, 400
+        summed, source = totals(by, ids)
+        return {'by': by, 'totals': summed, 'source': source}
+
+    @app.route('/api/availability/index', methods=['GET'])
+    def api_availability_index():
+        """API endpoint describing this process's balance index (size and freshness)"""
+        service = current_app.extensions.get('balance_index')
+        if service is None:
+            return {'enabled': False}
+        return service.stats()
+
+    @app.route('/api/jobs', methods=['GET'])
+    def api_jobs():
+        """API endpoint listing recent jobs, filtered by `kind` and `status`"""
+        limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+        return {
+            'jobs': [
+                job.to_dict() for job in recent_jobs(
+                    kind=request.args.get('kind'), status=request.args.get('status'), limit=limit)
+            ]
+        }
+
+    @app.route('/api/jobs', methods=['POST'])
+    def api_submit_job():
+        """API endpoint to start a background job.
+
+        Body: `{"kind": "rebuild_balances" | "export_movements" |
+        "reconcile_balances" | "backfill_rollups" | "reconcile_counters",
+        "params": {...}}`.
+        Bulk imports are submitted with `POST /api/movements/bulk?async=1`.
+        """
+        data = request.get_json(silent=True) or {}
+        kind = data.get('kind')
+        if kind not in SUBMITTABLE_JOBS:
+            return {'error': f"kind must be one of: {', '.join(SUBMITTABLE_JOBS)}"}, 400
+        params = data.get('params') or {}
+        if not isinstance(params, dict):
+            return {'error': 'params must be an object'}, 400
+        try:
+            parse_timestamp(params.get('since'))
+            parse_timestamp(params.get('until'))
+            if params.get('cursor'):
+                decode_cursor(params['cursor'])
+        except ValueError as exc:
+            return {'error': str(exc)}, 400
+        chunk_size = params.get('chunk_size')
+        if chunk_size is not None and (not isinstance(chunk_size, int) or isinstance(chunk_size, bool)
+                                       or chunk_size < 1):
+            return {'error': 'chunk_size must be a positive integer'}, 400
+        if kind == 'export_movements':
+            if params.get('dataset', 'movements') not in EXPORT_DATASETS:
+                return {'error': f"dataset must be one of: {', '.join(EXPORT_DATASETS)}"}, 400
+            if params.get('format', 'csv') not in EXPORT_FORMATS:
+                return {'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}, 400
+        job = jobs.submit(kind, params, unique=(kind != 'export_movements'))
+        return job.to_dict(), 202
+
+    @app.route('/api/jobs/<job_id>', methods=['GET'])
+    def api_job(job_id):
+        """API endpoint to poll one job's status, progress and result"""
+        job = get_job(job_id)
+        if job is None:
+            return {'error': 'Job not found'}, 404
+        return job.to_dict()
+
+    @app.route('/api/jobs/<job_id>/download', methods=['GET'])
+    def api_job_download(job_id):
+        """API endpoint to fetch the file produced by a finished export job"""
+        job = get_job(job_id)
+        if job is None:
+            return {'error': 'Job not found'}, 404
+        path = (job.to_dict()['result'] or {}).get('path')
+        if job.status != 'succeeded' or not path:
+            return {'error': 'Job has no file to download'}, 409
+        return send_file(path, as_attachment=True, download_name=os.path.basename(path))
+
+    if 'csrf' in app.extensions:
+        app.extensions['csrf'].exempt(api_submit_job)
+
+    def summary_ids():
+        ids = [value for arg in request.args.getlist('ids') for value in arg.split(',') if value.strip()]
+        return [value.strip() for value in ids]
+
+    @app.route('/api/summary/products', methods=['GET'])
+    def api_product_summaries():
+        """API endpoint summarising many products: `ids=PRD-1,PRD-2,...`"""
+        ids = summary_ids()
+        if not ids or len(ids) > SUMMARY_MAX_IDS:
+            return {'error': f'Pass between 1 and {SUMMARY_MAX_IDS} product ids in `ids`'}, 400
+        summaries = get_product_summaries(ids)
+        for summary in summaries.values():
+            for entry in summary['locations_with_stock']:
+                entry['last_updated'] = entry['last_updated'].isoformat()
+        return {'products': summaries, 'missing': [i for i in dict.fromkeys(ids) if i not in summaries]}
+
+    @app.route('/api/summary/locations', methods=['GET'])
+    def api_location_summaries():
+        """API endpoint summarising many locations: `ids=LOC-1,LOC-2,...`"""
+        ids = summary_ids()
+        if not ids or len(ids) > SUMMARY_MAX_IDS:
+            return {'error': f'Pass between 1 and {SUMMARY_MAX_IDS} location ids in `ids`'}, 400
+        summaries = get_location_summaries(ids)
+        for summary in summaries.values():
+            for entry in summary['products_in_location']:
+                entry['last_updated'] = entry['last_updated'].isoformat()
+        return {'locations': summaries, 'missing': [i for i in dict.fromkeys(ids) if i not in summaries]}
+
+    @app.route('/api/thresholds', methods=['GET'])
+    def api_thresholds():
+        """API endpoint listing reorder thresholds; `below=1` for low stock only"""
+        from alerts import thresholds_query
+        page, per_page, _, _ = page_args(request.args, None)
+        below = request.args.get('below', '').lower() in ('1', 'true', 'yes')
+        query = thresholds_query(below=below).limit(per_page + 1).offset((page - 1) * per_page)
+        rows = db.session.execute(query).all()
+        return {
+            'thresholds': [
+                {
+                    'product_id': row.product_id,
+                    'product_name': row.product_name,
+                    'location_id': row.location_id,
+                    'location_name': row.location_name,
+                    'threshold': row.threshold,
+                    'balance': row.balance or 0,
+                    'is_low': row.is_low,
+                    'updated_at': row.updated_at.isoformat()
+                } for row in rows[:per_page]
+            ],
+            'page': page,
+            'per_page': per_page,
+            'has_more': len(rows) > per_page
+        }
+
+    @app.route('/api/thresholds/<product_id>/<location_id>', methods=['PUT', 'DELETE'])
+    def api_threshold(product_id, location_id):
+        """API endpoint to set (`{"threshold": n}`) or remove a reorder threshold"""
+        from alerts import set_threshold, remove_threshold
+        if request.method == 'DELETE':
+            removed = remove_threshold(product_id, location_id)
+            db.session.commit()
+            if not removed:
+                return {'error': 'Threshold not found'}, 404
+            return {'deleted': True}
+
+        if cached_product(product_id) is None or cached_location(location_id) is None:
+            return {'error': 'Product or location not found'}, 404
+        threshold = (request.get_json(silent=True) or {}).get('threshold')
+        if not isinstance(threshold, int) or isinstance(threshold, bool) or threshold < 0:
+            return {'error': 'threshold must be a non-negative integer'}, 400
+        row = set_threshold(product_id, location_id, threshold)
+        db.session.commit()
+        return {
+            'product_id': row.product_id,
+            'location_id': row.location_id,
+            'threshold': row.threshold,
+            'is_low': row.is_low
+        }
+
+    @app.route('/api/alerts', methods=['GET'])
+    def api_alerts():
+        """API endpoint reading the low-stock alert outbox.
+
+        Events come oldest first; pass the returned `next_after` as `after`
+        to continue. `kind` is `low` or `recovered`.
+        """
+        from alerts import alerts_after
+        after = max(request.args.get('after', 0, type=int), 0)
+        limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+        alerts = alerts_after(after, limit, kind=request.args.get('kind'))
+        return {
+            'alerts': [alert.to_dict() for alert in alerts],
+            'next_after': alerts[-1].id if alerts else after
+        }
+
+    if 'csrf' in app.extensions:
+        app.extensions['csrf'].exempt(api_threshold)
+
+    @app.route('/api/reconcile', methods=['GET'])
+    def api_reconcile_report():
+        """API endpoint returning the drift report of the last reconcile run"""
+        from reconcile import last_report
+        report = last_report()
+        if report is None:
+            return {'error': 'Reconcile has not run yet'}, 404
+        return report
+
+    @app.route('/api/reconcile', methods=['POST'])
+    def api_reconcile():
+        """API endpoint to start a reconcile job; `full=1` and `dry_run=1` as in the CLI"""
+        job = jobs.submit('reconcile_balances', {
+            'full': request.args.get('full', '').lower() in ('1', 'true', 'yes'),
+            'repair': request.args.get('dry_run', '').lower() not in ('1', 'true', 'yes'),
+        }, unique=True)
+        return job.to_dict(), 202
+
+    if 'csrf' in app.extensions:
+        app.extensions['csrf'].exempt(api_reconcile)
+
+    @app.route('/api/analytics/<dimension>', methods=['GET'])
+    def api_analytics_top(dimension):
+        """API endpoint ranking products or locations by qty moved in a range.
+
+        `granularity` (hour, day, week, month), `since`, `until` and `limit`
+        are optional; totals come from the movement rollups.
+        """
+        from rollups import range_args, top
+        if dimension not in ('products', 'locations'):
+            return {'error': 'dimension must be products or locations'}, 404
+        try:
+            period, since, until = range_args(request.args)
+        except ValueError as exc:
+            return {'error': str(exc)}, 400
+        limit = max(1, min(request.args.get('limit', 20, type=int), 500))
+        return {
+            'dimension': dimension,
+            'granularity': period,
+            'since': since.isoformat(),
+            'until': until.isoformat(),
+            'top': top(dimension[:-1], period, since, until, limit)
+        }
+
+    @app.route('/api/analytics/<dimension>/<entity_id>', methods=['GET'])
+    def api_analytics_series(dimension, entity_id):
+        """API endpoint returning qty in, qty out and movement counts per
+        hour, day, week or month for one product or location"""
+        from rollups import range_args, series
+        if dimension == 'products':
+            found = cached_product(entity_id) is not None
+        elif dimension == 'locations':
+            found = cached_location(entity_id) is not None
+        else:
+            return {'error': 'dimension must be products or locations'}, 404
+        if not found:
+            return {'error': f"{dimension[:-1].capitalize()} not found"}, 404
+        try:
+            period, since, until = range_args(request.args)
+        except ValueError as exc:
+            return {'error': str(exc)}, 400
+        buckets = series(dimension[:-1], entity_id, period, since, until)
+        return {
+            'dimension': dimension,
+            'id': entity_id,
+            'granularity': period,
+            'since': since.isoformat(),
+            'until': until.isoformat(),
+            'buckets': buckets,
+            'totals': {
+                'qty_in': sum(bucket['qty_in'] for bucket in buckets),
+                'qty_out': sum(bucket['qty_out'] for bucket in buckets),
+                'movements': sum(bucket['movements'] for bucket in buckets)
+            }
         }
 
-   
+    @app.route('/api/cache/stats', methods=['GET'])
+    def api_cache_stats():
+        """API endpoint reporting cache hit/miss counters"""
+        return cache.stats()
@@ -0,0 +1,18 @@
+from blinker import Namespace
+
+_signals = Namespace()
+
+#: Sent whenever balances are mutated in the current transaction, with
+#: ``keys`` -- a list of affected (product_id, location_id) pairs -- or
+#: ``keys=None`` when the whole table was rebuilt. Incremental updates also
+#: pass ``changes``, a {(product_id, location_id): quantity_change} dict.
+balances_changed = _signals.signal('balances-changed')
+
+#: Sent after a full balance rebuild has been committed.
+balances_rebuilt = _signals.signal('balances-rebuilt')
+
+#: Sent whenever movements are written in the current transaction, with
+#: ``added`` and ``removed`` -- lists of dicts holding product_id,
+#: from_location, to_location, qty and timestamp. An edit sends the old
+#: values as ``removed`` and the new ones as ``added``.
+movements_changed = _signals.signal('movements-changed')
@@ -0,0 +1,285 @@
+"""Dated balances for point-in-time balance queries.
+
+A balance as of time T is the nearest snapshot taken at or before T plus the
+net effect of movements timestamped after that snapshot and up to T, so a
+month-end query only replays the movements since the preceding snapshot.
+
+`create_snapshot` stores the balances as of ``SNAPSHOT_SETTLE_SECONDS``
+(default 30) ago, derived from movements the same way, rather than copying
+`product_balances`: a movement is stamped before its transaction commits,
+so the newest seconds may still be missing movements that are in flight.
+
+Movements can still land at or before an existing snapshot: edits and
+deletes of older movements, bulk imports with explicit timestamps, intake
+rows queued long before they are committed, and transactions open for
+longer than the settle time. After such a change commits, `correct_snapshots`
+recomputes the affected product/location rows of every later snapshot from
+the movements. It runs in its own transaction, under the ``balance-snapshots``
+lock that `create_snapshot` holds while it writes, so it sees either the
+new snapshot or one whose read already included the change.
+"""
+import logging
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, insert, delete, func, literal, union_all, case, or_, event
+from sqlalchemy.orm import Session
+from database import db
+from models import Product, Location, BalanceSnapshot
+from rebuild import movement_deltas
+from ledger import partitions, split_at, boundary_query
+from locks import single_runner
+from signals import movements_changed
+
+logger = logging.getLogger(__name__)
+
+SETTLE_SECONDS = 30
+SNAPSHOT_LOCK = 'balance-snapshots'
+_PENDING_KEY = 'snapshots.pending'
+
+
+def create_snapshot(taken_at=None):
+    """Store the non-zero balances as of `taken_at` as a snapshot.
+
+    `taken_at` defaults to ``SNAPSHOT_SETTLE_SECONDS`` ago. Returns
+    (snapshot time, number of rows written).
+    """
+    with single_runner(SNAPSHOT_LOCK):
+        if taken_at is None:
+            settle = current_app.config.get('SNAPSHOT_SETTLE_SECONDS', SETTLE_SECONDS)
+            taken_at = datetime.utcnow() - timedelta(seconds=settle)
+        totals = balance_totals(taken_at)[0].subquery('totals')
+        result = db.session.execute(
+            insert(BalanceSnapshot).from_select(
+                ['snapshot_at', 'product_id', 'location_id', 'balance'],
+                select(
+                    literal(taken_at, BalanceSnapshot.snapshot_at.type),
+                    totals.c.product_id,
+                    totals.c.location_id,
+                    totals.c.balance,
+                ).where(totals.c.balance != 0),
+            )
+        )
+        db.session.commit()
+    return taken_at, result.rowcount
+
+
+def list_snapshots():
+    """(snapshot time, row count) for every snapshot, oldest first"""
+    return db.session.execute(
+        select(BalanceSnapshot.snapshot_at, func.count())
+        .group_by(BalanceSnapshot.snapshot_at)
+        .order_by(BalanceSnapshot.snapshot_at)
+    ).all()
+
+
+def prune_snapshots(older_than, keep_monthly=True):
+    """Delete snapshots taken before `older_than`.
+
+    With `keep_monthly` the last snapshot of every calendar month is kept so
+    month-end queries stay cheap. Returns the number of snapshots removed.
+    """
+    taken = [row.snapshot_at for row in list_snapshots() if row.snapshot_at < older_than]
+    if keep_monthly:
+        month_ends = {}
+        for snapshot_at in taken:
+            month_ends[(snapshot_at.year, snapshot_at.month)] = snapshot_at
+        kept = set(month_ends.values())
+        taken = [snapshot_at for snapshot_at in taken if snapshot_at not in kept]
+
+    for snapshot_at in taken:
+        db.session.execute(delete(BalanceSnapshot).where(BalanceSnapshot.snapshot_at == snapshot_at))
+        db.session.commit()
+    return len(taken)
+
+
+def nearest_snapshot(as_of):
+    """Time of the latest snapshot taken at or before `as_of`, or None"""
+    return db.session.execute(
+        select(func.max(BalanceSnapshot.snapshot_at)).where(BalanceSnapshot.snapshot_at <= as_of)
+    ).scalar()
+
+
+def _cell_rows(connection, boundary, product_id, location_id, since):
+    """Snapshot rows of one product at one location for every snapshot taken at or after `since`"""
+    base_at = connection.execute(
+        select(func.max(BalanceSnapshot.snapshot_at)).where(BalanceSnapshot.snapshot_at < since)
+    ).scalar()
+    taken = connection.execute(
+        select(BalanceSnapshot.snapshot_at).where(BalanceSnapshot.snapshot_at >= since)
+        .distinct().order_by(BalanceSnapshot.snapshot_at)
+    ).scalars().all()
+    if not taken:
+        return []
+    balance = 0
+    if base_at is not None:
+        balance = connection.execute(
+            select(BalanceSnapshot.balance).where(
+                BalanceSnapshot.snapshot_at == base_at,
+                BalanceSnapshot.product_id == product_id,
+                BalanceSnapshot.location_id == location_id,
+            )
+        ).scalar() or 0
+
+    legs = []
+    for source, bounds in split_at(boundary, base_at, taken[-1]):
+        window = [source.product_id == product_id, source.timestamp <= taken[-1], *bounds,
+                  or_(source.from_location == location_id, source.to_location == location_id)]
+        if base_at is not None:
+            window.append(source.timestamp > base_at)
+        qty = (case((source.to_location == location_id, source.qty), else_=0)
+               - case((source.from_location == location_id, source.qty), else_=0))
+        legs += connection.execute(select(source.timestamp, qty).where(*window)).all()
+    legs.sort()
+
+    rows, position = [], 0
+    for snapshot_at in taken:
+        while position < len(legs) and legs[position][0] <= snapshot_at:
+            balance += legs[position][1]
+            position += 1
+        if balance:
+            rows.append({'snapshot_at': snapshot_at, 'product_id': product_id,
+                         'location_id': location_id, 'balance': balance})
+    return rows
+
+
+def correct_snapshots(added=(), removed=()):
+    """Recompute the snapshot rows that committed movement changes at or
+    before the latest snapshot affect; returns the number of rows written.
+
+    Runs in a transaction of its own and is idempotent, so a change that a
+    snapshot already includes is not counted twice.
+    """
+    first_change = {}
+    for change in (*added, *removed):
+        timestamp = change.get('timestamp')
+        if timestamp is None:
+            continue
+        for location_id in (change['from_location'], change['to_location']):
+            if location_id:
+                key = (change['product_id'], location_id)
+                first_change[key] = min(first_change.get(key, timestamp), timestamp)
+    if not first_change:
+        return 0
+
+    written = 0
+    with single_runner(SNAPSHOT_LOCK), db.engine.begin() as connection:
+        latest = connection.execute(select(func.max(BalanceSnapshot.snapshot_at))).scalar()
+        if latest is None:
+            return 0
+        boundary = connection.execute(boundary_query()).scalar()
+        for (product_id, location_id), since in sorted(first_change.items()):
+            if since > latest:
+                continue
+            rows = _cell_rows(connection, boundary, product_id, location_id, since)
+            connection.execute(
+                delete(BalanceSnapshot).where(
+                    BalanceSnapshot.product_id == product_id,
+                    BalanceSnapshot.location_id == location_id,
+                    BalanceSnapshot.snapshot_at >= since,
+                )
+            )
+            if rows:
+                connection.execute(insert(BalanceSnapshot), rows)
+            written += len(rows)
+    return written
+
+
+def _on_movements_changed(sender, added=(), removed=()):
+    pending = db.session.info.setdefault(_PENDING_KEY, ([], []))
+    pending[0].extend(added)
+    pending[1].extend(removed)
+
+
+def _after_commit(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    # changes newer than this cannot be in any snapshot taken or being taken
+    settle = current_app.config.get('SNAPSHOT_SETTLE_SECONDS', SETTLE_SECONDS)
+    cutoff = datetime.utcnow() - timedelta(seconds=settle)
+    added, removed = ([change for change in changes if change.get('timestamp') and change['timestamp'] <= cutoff]
+                      for changes in pending)
+    if not added and not removed:
+        return
+    try:
+        correct_snapshots(added, removed)
+    except Exception:
+        # the movements are committed; a failure here must not fail the write
+        logger.exception("Correcting balance snapshots failed")
+
+
+def _after_rollback(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+
+
+def init_snapshots(app):
+    app.config.setdefault('SNAPSHOT_SETTLE_SECONDS', SETTLE_SECONDS)
+    movements_changed.connect(_on_movements_changed, weak=False)
+    if not event.contains(Session, 'after_commit', _after_commit):
+        event.listen(Session, 'after_commit', _after_commit)
+        event.listen(Session, 'after_soft_rollback', _after_rollback)
+
+
+def balance_totals(as_of, product_id=None, location_id=None):
+    """Grouped (product_id, location_id, balance) rows at `as_of`, zeros included.
+
+    Returns (query, base snapshot time or None).
+    """
+    base = nearest_snapshot(as_of)
+
+    parts = []
+    for source, bounds in partitions(base, as_of):
+        criteria = [source.timestamp <= as_of, *bounds]
+        if base is not None:
+            criteria.append(source.timestamp > base)
+        if product_id:
+            criteria.append(source.product_id == product_id)
+        legs = movement_deltas(*criteria, source=source)
+        parts.append(select(legs.c.product_id, legs.c.location_id, legs.c.qty))
+
+    snapshot_criteria = []
+    if product_id:
+        snapshot_criteria.append(BalanceSnapshot.product_id == product_id)
+    if base is not None:
+        parts.append(
+            select(BalanceSnapshot.product_id, BalanceSnapshot.location_id, BalanceSnapshot.balance)
+            .where(BalanceSnapshot.snapshot_at == base, *snapshot_criteria)
+        )
+    combined = union_all(*parts).subquery('combined')
+
+    totals = (
+        select(
+            combined.c.product_id,
+            combined.c.location_id,
+            func.sum(combined.c.qty).label('balance'),
+        )
+        .group_by(combined.c.product_id, combined.c.location_id)
+    )
+    if location_id:
+        totals = totals.where(combined.c.location_id == location_id)
+    return totals, base
+
+
+def balances_as_of_query(as_of, product_id=None, location_id=None):
+    """Non-zero balances at `as_of` with product and location names.
+
+    Returns (query, base snapshot time or None).
+    """
+    totals, base = balance_totals(as_of, product_id, location_id)
+    totals = totals.subquery('totals')
+
+    query = (
+        select(
+            totals.c.product_id,
+            Product.name.label('product_name'),
+            totals.c.location_id,
+            Location.name.label('location_name'),
+            totals.c.balance,
+        )
+        .join(Product, Product.product_id == totals.c.product_id)
+        .join(Location, Location.location_id == totals.c.location_id)
+        .where(totals.c.balance != 0)
+        .order_by(totals.c.product_id, totals.c.location_id)
+    )
+    return query, base
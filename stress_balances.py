@@ -0,0 +1,131 @@
+"""Multi-threaded stress test for concurrent balance mutations.
+
+Several threads hammer the same (product, location) pair, each in its own
+session and transaction:
+
+* receipts via `ProductBalance.update_balance` -- the final balance must equal
+  the sum of every committed increment (no lost updates), and first-time
+  inserts from many threads must not trip `unique_product_location`;
+* issues via `ProductBalance.withdraw` -- the balance must never go negative
+  and exactly the successful withdrawals must be reflected.
+
+The original read-modify-write implementation is run against the same load
+for comparison.
+
+Usage: python stress_balances.py [threads] [operations-per-thread]
+"""
+import sys
+import threading
+import time
+from sqlalchemy.exc import OperationalError
+from bench_utils import create_bench_app, seed
+
+PRODUCT = 'PRD-000000'
+LOCATION = 'LOC-00000'
+
+
+def legacy_update_balance(product_id, location_id, quantity_change):
+    """The original ORM read-modify-write implementation."""
+    from datetime import datetime
+    from database import db
+    from models import ProductBalance
+
+    balance = ProductBalance.query.filter_by(product_id=product_id, location_id=location_id).first()
+    if balance:
+        balance.balance += quantity_change
+        balance.last_updated = datetime.utcnow()
+    else:
+        db.session.add(ProductBalance(product_id=product_id, location_id=location_id,
+                                      balance=quantity_change, last_updated=datetime.utcnow()))
+
+
+def run_threads(app, threads, operations, operation):
+    """Run `operation()` `operations` times in each thread; count commits."""
+    from database import db
+
+    committed = [0] * threads
+    failed = [0] * threads
+
+    def worker(index):
+        with app.app_context():
+            for _ in range(operations):
+                for _attempt in range(50):
+                    try:
+                        if operation() is False:
+                            db.session.rollback()
+                            break
+                        db.session.commit()
+                        committed[index] += 1
+                        break
+                    except OperationalError:
+                        # SQLite reports writer contention as "database is locked"
+                        db.session.rollback()
+                        time.sleep(0.001)
+                    except Exception:
+                        db.session.rollback()
+                        failed[index] += 1
+                        break
+            db.session.remove()
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return sum(committed), sum(failed)
+
+
+def reset(app):
+    from database import db
+    from models import ProductBalance
+    with app.app_context():
+        ProductBalance.query.delete()
+        db.session.commit()
+
+
+def current(app):
+    from models import ProductBalance
+    with app.app_context():
+        return ProductBalance.get_balance(PRODUCT, LOCATION)
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    app = create_bench_app()
+    with app.app_context():
+        seed(products=1, locations=1, movements=0)
+
+    from models import ProductBalance
+    ok = True
+
+    reset(app)
+    committed, failed = run_threads(
+        app, threads, operations, lambda: legacy_update_balance(PRODUCT, LOCATION, 1))
+    balance = current(app)
+    print(f"legacy increments:  committed={committed} failed={failed} balance={balance} "
+          f"lost={committed - balance}")
+
+    reset(app)
+    committed, failed = run_threads(
+        app, threads, operations, lambda: ProductBalance.update_balance(PRODUCT, LOCATION, 1))
+    balance = current(app)
+    print(f"atomic increments:  committed={committed} failed={failed} balance={balance} "
+          f"lost={committed - balance}")
+    ok &= failed == 0 and committed == balance == threads * operations
+
+    stock = balance
+    committed, failed = run_threads(
+        app, threads, operations, lambda: ProductBalance.withdraw(PRODUCT, LOCATION, 3))
+    balance = current(app)
+    print(f"guarded withdraws:  committed={committed} failed={failed} balance={balance} "
+          f"expected={stock - 3 * committed}")
+    ok &= failed == 0 and balance >= 0 and balance == stock - 3 * committed
+
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Concurrent-editors stress test for versioned movement edits.
+
+A few movements are edited by many threads at once. Each operation reads a
+movement the way the edit form does, then submits a new quantity with the
+version it read:
+
+* versioned -- `edits.update_movement`: a stale version is refused with a
+  conflict, so every committed edit reversed exactly what was stored;
+* legacy    -- the original edit route: reverse what was read, re-apply,
+  and overwrite the row with no version check.
+
+Afterwards stored balances are compared with the totals implied by the
+movements; any mismatch is a corrupted balance. The report also shows the
+movement and balance rows written per committed edit, each one a row lock
+held until commit, and confirms that no table or SELECT ... FOR UPDATE
+locks are taken.
+
+Usage: python stress_edits.py [threads] [operations-per-thread] [movements]
+"""
+import random
+import sys
+import threading
+import time
+from sqlalchemy import event, select, update
+from sqlalchemy.exc import OperationalError
+from bench_utils import create_bench_app
+
+PRODUCT = 'PRD-STRESS'
+SOURCE = 'LOC-SOURCE'
+TARGET = 'LOC-TARGET'
+
+
+def prepare(app, movements):
+    from database import db
+    from models import Product, Location, ProductMovement, ProductBalance
+    from sqlalchemy import delete
+    with app.app_context():
+        db.session.execute(delete(ProductMovement))
+        db.session.execute(delete(ProductBalance))
+        if db.session.get(Product, PRODUCT) is None:
+            db.session.add(Product(product_id=PRODUCT, name='Stress product'))
+            db.session.add_all([Location(location_id=SOURCE, name='Source'),
+                                Location(location_id=TARGET, name='Target')])
+        db.session.flush()
+        db.session.add(ProductMovement(movement_id='MOV-STOCK', product_id=PRODUCT, to_location=SOURCE,
+                                       qty=1000000))
+        ProductBalance.update_balance(PRODUCT, SOURCE, 1000000)
+        for i in range(movements):
+            db.session.add(ProductMovement(movement_id=f'MOV-EDIT-{i}', product_id=PRODUCT,
+                                           from_location=SOURCE, to_location=TARGET, qty=10))
+            ProductBalance.update_balance(PRODUCT, SOURCE, -10)
+            ProductBalance.update_balance(PRODUCT, TARGET, 10)
+        db.session.commit()
+
+
+def legacy_edit(movement_id, qty):
+    """The original edit route: reverse what was read, re-apply, overwrite"""
+    from database import db
+    from models import ProductMovement, ProductBalance
+    movement = db.session.execute(
+        select(ProductMovement.__table__).where(ProductMovement.movement_id == movement_id)).one()
+    time.sleep(0.001)  # the operator looking at the form
+    ProductBalance.update_balance(movement.product_id, movement.from_location, movement.qty)
+    ProductBalance.update_balance(movement.product_id, movement.to_location, -movement.qty)
+    if not ProductBalance.withdraw(movement.product_id, movement.from_location, qty):
+        return False
+    ProductBalance.update_balance(movement.product_id, movement.to_location, qty)
+    db.session.execute(update(ProductMovement.__table__)
+                       .where(ProductMovement.movement_id == movement_id).values(qty=qty))
+
+
+def versioned_edit(movement_id, qty):
+    from database import db
+    from models import ProductMovement
+    from edits import update_movement
+    movement = db.session.get(ProductMovement, movement_id)
+    version = movement.version
+    time.sleep(0.001)  # the operator looking at the form
+    update_movement(movement, version, movement.product_id, movement.from_location, movement.to_location, qty)
+
+
+def run(app, threads, operations, movements, edit):
+    from database import db
+    from edits import VersionConflict, InsufficientStock
+
+    totals = {'committed': 0, 'conflicts': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        with app.app_context():
+            for _ in range(operations):
+                movement_id = f'MOV-EDIT-{rng.randrange(movements)}'
+                qty = rng.randint(1, 50)
+                outcome = 'failed'
+                for _attempt in range(100):
+                    try:
+                        outcome = 'failed' if edit(movement_id, qty) is False else 'committed'
+                        if outcome == 'committed':
+                            db.session.commit()
+                        else:
+                            db.session.rollback()
+                        break
+                    except VersionConflict:
+                        db.session.rollback()
+                        outcome = 'conflicts'
+                        break
+                    except OperationalError:
+                        # SQLite reports writer contention as "database is locked"
+                        db.session.rollback()
+                        time.sleep(0.001)
+                    except InsufficientStock:
+                        db.session.rollback()
+                        break
+                db.session.expunge_all()
+                with lock:
+                    totals[outcome] += 1
+            db.session.remove()
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return totals
+
+
+def drift(app):
+    from database import db
+    from reconcile import drift_query
+    with app.app_context():
+        return db.session.execute(drift_query()).all()
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    movements = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    app = create_bench_app()
+    from database import db
+
+    writes = {'rows': 0, 'locking_reads': 0}
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        head = statement.lstrip().split(None, 1)[0].upper()
+        # rollup and counter rows written by signal receivers are left out
+        touches = 'product_movements' in statement or 'product_balances' in statement
+        if head in ('UPDATE', 'INSERT', 'DELETE') and touches and cursor.rowcount > 0:
+            writes['rows'] += cursor.rowcount
+        if 'FOR UPDATE' in statement.upper() or head == 'LOCK':
+            writes['locking_reads'] += 1
+
+    ok = True
+    for name, edit in (('legacy', legacy_edit), ('versioned', versioned_edit)):
+        prepare(app, movements)
+        with app.app_context():
+            engine = db.engine
+        writes.update(rows=0, locking_reads=0)
+        event.listen(engine, 'after_cursor_execute', count)
+        started = time.perf_counter()
+        totals = run(app, threads, operations, movements, edit)
+        elapsed = time.perf_counter() - started
+        event.remove(engine, 'after_cursor_execute', count)
+        wrong = drift(app)
+        per_edit = writes['rows'] / totals['committed'] if totals['committed'] else 0
+        print(f"{name:<9} committed={totals['committed']} conflicts={totals['conflicts']} "
+              f"failed={totals['failed']} corrupted_balances={len(wrong)} "
+              f"rows_locked/edit={per_edit:.1f} locking_reads={writes['locking_reads']} {elapsed:.2f}s")
+        if name == 'versioned':
+            ok = not wrong and totals['failed'] == 0 and writes['locking_reads'] == 0
+
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
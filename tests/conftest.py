@@ -0,0 +1,61 @@
+"""Fixtures: a fresh application on its own SQLite database per test.
+
+`main` builds its module-level app at import time from DATABASE_URL, so
+that is pointed at a throwaway file before anything imports it.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='inventory-tests-'), 'import.db')}"
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Build and initialise an app on a new database, with extra `config`"""
+    from main import create_app
+    from migrations import init_database
+
+    def make(**config):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'inventory.db'}",
+            'WTF_CSRF_ENABLED': False,
+            'JOBS_EXECUTOR': 'inline',
+            **config,
+        })
+        with app.app_context():
+            init_database(echo=lambda message: None)
+        return app
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def stock(app):
+    """Products P1..P3 and locations L1..L3, with 100 of each product received at L1"""
+    from database import db
+    from models import Product, Location
+    from ingest import ingest_movements
+
+    db.session.add_all([Product(product_id=f"P{i}", name=f"Product {i}") for i in (1, 2, 3)])
+    db.session.add_all([Location(location_id=f"L{i}", name=f"Location {i}") for i in (1, 2, 3)])
+    db.session.commit()
+    result = ingest_movements([
+        {'movement_id': f"R{i}", 'product_id': f"P{i}", 'to_location': 'L1', 'qty': 100} for i in (1, 2, 3)
+    ])
+    assert result['accepted'] == 3
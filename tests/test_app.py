@@ -0,0 +1,30 @@
+from sqlalchemy import select, func
+
+
+def test_feature_flags_apply_per_app(make_app):
+    from database import db
+    from models import Product, Location, MovementRollup, StockAlert, ReorderThreshold
+    from ingest import ingest_movements
+    from counters import counter_values
+    from cache import cache
+
+    enabled = make_app()
+    disabled = make_app(COUNTERS_ENABLED=False, ROLLUPS_ENABLED=False, ALERTS_ENABLED=False, CACHE_BACKEND='null')
+
+    def store(movement_id):
+        assert ingest_movements([{'movement_id': movement_id, 'product_id': 'P1', 'to_location': 'L1', 'qty': 1}])['accepted']
+        return (db.session.execute(select(func.count()).select_from(MovementRollup)).scalar(),
+                counter_values()['movements'],
+                db.session.execute(select(func.count()).select_from(StockAlert)).scalar())
+
+    with enabled.app_context():
+        db.session.add_all([Product(product_id='P1', name='P1'), Location(location_id='L1', name='L1')])
+        db.session.add(ReorderThreshold(product_id='P1', location_id='L1', threshold=10))
+        db.session.commit()
+    with disabled.app_context():
+        assert store('M1') == (0, 0, 0)
+        assert cache.stats()['backend'] == 'NullBackend'
+    with enabled.app_context():
+        rollups, movements, alerts = store('M2')
+        assert rollups and movements == 1 and alerts == 1
+        assert cache.stats()['backend'] == 'LRUBackend'
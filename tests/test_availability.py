@@ -0,0 +1,21 @@
+import pytest
+
+
+@pytest.mark.parametrize('query', [
+    'product_id=P1&qty=%C2%B2',  # superscript two: a digit to str.isdigit, not to int
+    'product_id=P1&qty=abc',
+    'product_id=P1&qty=0',
+    'items=P1:5,P2:-1',
+    'items=P1:',
+])
+def test_invalid_quantities_are_refused(client, stock, query):
+    response = client.get(f'/api/availability?{query}')
+    assert response.status_code == 400
+    assert 'quantities are positive integers' in response.get_json()['error']
+
+
+def test_locations_holding_every_item(client, stock):
+    data = client.get('/api/availability?items=P1:60,P2:40,P1:30').get_json()
+    assert [item['qty'] for item in data['items']] == [90, 40]
+    assert [location['location_id'] for location in data['locations']] == ['L1']
+    assert client.get('/api/availability?product_id=P1&qty=101').get_json()['locations'] == []
@@ -0,0 +1,48 @@
+import threading
+
+from sqlalchemy import select, func
+
+
+def test_update_balance_creates_then_adds(app, stock):
+    from database import db
+    from models import ProductBalance
+
+    ProductBalance.update_balance('P1', 'L2', 5)
+    ProductBalance.update_balance('P1', 'L2', -2)
+    ProductBalance.apply_deltas({('P1', 'L2'): 10, ('P2', 'L2'): 3, ('P1', 'L1'): -40})
+    db.session.commit()
+
+    assert ProductBalance.get_balance('P1', 'L2') == 13
+    assert ProductBalance.get_balance('P2', 'L2') == 3
+    assert ProductBalance.get_balance('P1', 'L1') == 60
+    rows = db.session.execute(select(func.count()).select_from(ProductBalance)
+                              .where(ProductBalance.product_id == 'P1', ProductBalance.location_id == 'L2')).scalar()
+    assert rows == 1
+
+
+def test_withdraw_never_overdraws(app, stock):
+    from database import db
+    from models import ProductBalance
+
+    assert ProductBalance.withdraw('P1', 'L1', 60)
+    assert not ProductBalance.withdraw('P1', 'L1', 41)
+    assert not ProductBalance.withdraw('P1', 'L3', 1)
+    db.session.commit()
+    assert ProductBalance.get_balance('P1', 'L1') == 40
+
+
+def test_concurrent_upserts_lose_no_increment(app, stock):
+    from database import db
+    from models import ProductBalance
+
+    def add(times):
+        with app.app_context():
+            for _ in range(times):
+                ProductBalance.update_balance('P3', 'L3', 1)
+                db.session.commit()
+    threads = [threading.Thread(target=add, args=(25,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert ProductBalance.get_balance('P3', 'L3') == 100
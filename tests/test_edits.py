@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+
+def move(client, movement_id='M1', **fields):
+    """Store a transfer of 10 P1 from L1 to L2; returns its version"""
+    from ingest import ingest_movements
+
+    body = {'movement_id': movement_id, 'product_id': 'P1', 'from_location': 'L1', 'to_location': 'L2', 'qty': 10}
+    assert ingest_movements([{**body, **fields}])['accepted'] == 1
+    return client.get(f'/api/movements/{movement_id}').get_json()['version']
+
+
+def test_edit_moves_the_balance_effect(client, stock):
+    from models import ProductBalance
+
+    version = move(client)
+    response = client.put('/api/movements/M1', json={'version': version, 'qty': 25, 'to_location': 'L3'})
+    assert response.status_code == 200
+    assert response.get_json()['version'] == version + 1
+    assert [ProductBalance.get_balance('P1', location) for location in ('L1', 'L2', 'L3')] == [75, 0, 25]
+
+
+def test_stale_version_is_refused(client, stock):
+    from models import ProductBalance
+
+    version = move(client)
+    assert client.put('/api/movements/M1', json={'version': version, 'qty': 20}).status_code == 200
+
+    response = client.put('/api/movements/M1', json={'version': version, 'qty': 30})
+    assert response.status_code == 409
+    assert response.get_json()['current_version'] == version + 1
+    assert client.delete(f'/api/movements/M1?version={version}').status_code == 409
+    assert ProductBalance.get_balance('P1', 'L2') == 20
+
+    product_version = client.get('/api/products/P1').get_json()['version']
+    assert client.put('/api/products/P1', json={'version': product_version, 'name': 'Renamed'}).status_code == 200
+    response = client.put('/api/products/P1', json={'version': product_version, 'name': 'Again'})
+    assert response.status_code == 409
+    assert client.get('/api/products/P1').get_json()['name'] == 'Renamed'
+
+
+def test_writer_in_between_read_and_write_is_detected(app, client, stock):
+    """The version check is part of the UPDATE, not only of the request"""
+    from database import db
+    from models import ProductMovement, ProductBalance
+    from edits import update_movement, VersionConflict
+
+    version = move(client)
+    movement = db.session.get(ProductMovement, 'M1')
+
+    def other_writer():
+        with app.app_context():
+            update_movement(db.session.get(ProductMovement, 'M1'), version, 'P1', 'L1', 'L2', 15)
+            db.session.commit()
+    thread = threading.Thread(target=other_writer)
+    thread.start()
+    thread.join()
+
+    with pytest.raises(VersionConflict):
+        update_movement(movement, version, 'P1', 'L1', 'L2', 40)
+    db.session.rollback()
+    assert ProductBalance.get_balance('P1', 'L2') == 15
+
+
+def test_edit_that_would_overdraw_changes_nothing(client, stock):
+    from models import ProductBalance
+
+    version = move(client)
+    response = client.put('/api/movements/M1', json={'version': version, 'qty': 150})
+    assert response.status_code == 422
+    assert response.get_json()['balance'] == 100
+    assert [ProductBalance.get_balance('P1', location) for location in ('L1', 'L2')] == [90, 10]
+    assert client.get('/api/movements/M1').get_json()['version'] == version
@@ -0,0 +1,21 @@
+import json
+from datetime import datetime, timedelta
+
+
+def test_export_and_listing_share_a_half_open_range(app, client, stock):
+    from ingest import ingest_movements
+
+    app.config['EXPORT_SETTLE_SECONDS'] = 0
+    start = datetime.utcnow() - timedelta(days=1)
+    times = [start + timedelta(hours=hour) for hour in range(3)]
+    assert ingest_movements([
+        {'movement_id': f"M{hour}", 'product_id': 'P1', 'from_location': 'L1', 'to_location': 'L2', 'qty': 1,
+         'timestamp': timestamp.isoformat()}
+        for hour, timestamp in enumerate(times)
+    ])['accepted'] == 3
+    window = f"since={times[0].isoformat()}&until={times[2].isoformat()}"
+
+    listed = client.get(f'/api/movements?{window}').get_json()['movements']
+    exported = client.get(f'/api/export/movements?format=ndjson&{window}').get_data(as_text=True)
+    assert sorted(row['movement_id'] for row in listed) == ['M0', 'M1']
+    assert [json.loads(line)['movement_id'] for line in exported.splitlines()] == ['M0', 'M1']
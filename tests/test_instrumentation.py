@@ -0,0 +1,20 @@
+import pytest
+from flask import g
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+
+def test_failed_statements_leave_no_timing_behind(make_app):
+    from database import db
+
+    app = make_app(INSTRUMENTATION_ENABLED=True)
+    with app.test_request_context('/'):
+        app.preprocess_request()
+        connection = db.session.connection()
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text('SELECT * FROM no_such_table'))
+        connection.execute(text('SELECT 1'))
+
+        assert g._instrumentation.sql_count == 1
+        assert not connection.info.get('_instrumentation_started')
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, func
+
+
+def balances():
+    from database import db
+    from models import ProductBalance
+    return {(row.product_id, row.location_id): row.balance
+            for row in db.session.execute(select(ProductBalance)).scalars() if row.balance}
+
+
+@pytest.fixture
+def history(app):
+    """400 seeded movements over the past year, with balances rebuilt from them"""
+    from bench_utils import seed
+    from rebuild import rebuild_balances
+
+    seed(products=12, locations=4, movements=400, rng_seed=7)
+    rebuild_balances()
+    return balances()
+
+
+def test_rebuild_after_archiving_gives_the_same_balances(app, history):
+    from database import db
+    from models import ProductMovement, ArchivedMovement, LedgerCheckpoint
+    from ledger import archive_movements, archive_boundary
+    from rebuild import rebuild_balances
+
+    boundary = datetime.utcnow() - timedelta(days=120)
+    report = archive_movements(boundary, batch_size=50)
+    assert archive_boundary() == boundary
+    hot = db.session.execute(select(func.count()).select_from(ProductMovement)).scalar()
+    assert report['archived'] + hot == 400
+    assert report['removed'] == report['archived']
+
+    rebuild_balances(chunk_size=5)
+    assert balances() == history
+
+    # the checkpoint is the net of everything archived
+    archived = {}
+    for movement in db.session.execute(select(ArchivedMovement)).scalars():
+        for location_id, qty in ((movement.from_location, -movement.qty), (movement.to_location, movement.qty)):
+            if location_id:
+                key = (movement.product_id, location_id)
+                archived[key] = archived.get(key, 0) + qty
+    checkpoint = {(row.product_id, row.location_id): row.balance
+                  for row in db.session.execute(select(LedgerCheckpoint)).scalars()}
+    assert {key: value for key, value in checkpoint.items() if value} == \
+        {key: value for key, value in archived.items() if value}
+
+
+def test_second_archive_run_keeps_balances(app, history):
+    from ledger import archive_movements
+    from rebuild import rebuild_balances
+
+    archive_movements(datetime.utcnow() - timedelta(days=240))
+    archive_movements(datetime.utcnow() - timedelta(days=60))
+    rebuild_balances()
+    assert balances() == history
+
+
+def test_archived_movements_are_read_only(app, client, history):
+    from ledger import archive_movements
+
+    archive_movements(datetime.utcnow() - timedelta(days=120))
+    old = client.get('/api/movements/MOV-000000000')
+    assert old.status_code == 200
+    assert client.put('/api/movements/MOV-000000000', json={'version': old.get_json()['version'], 'qty': 1}) \
+        .status_code == 409
+    late = client.post('/api/movements/bulk', json=[{
+        'movement_id': 'LATE', 'product_id': 'PRD-000001', 'to_location': 'LOC-00001', 'qty': 1,
+        'timestamp': (datetime.utcnow() - timedelta(days=200)).isoformat(),
+    }])
+    assert late.status_code == 422
+    assert 'archive boundary' in late.get_json()['errors'][0]['errors'][0]
+    assert balances() == history
@@ -0,0 +1,50 @@
+TRANSFER = {'transfer_id': 'T', 'from_location': 'L1', 'to_location': 'L2'}
+
+
+def post_transfer(client, lines, **fields):
+    return client.post('/api/transfers', json={**TRANSFER, **fields, 'lines': lines})
+
+
+def test_lines_keep_the_order_they_were_given(client, stock):
+    from ingest import ingest_movements
+
+    assert ingest_movements([{'movement_id': 'R', 'product_id': 'P1', 'to_location': 'L1', 'qty': 900}])['accepted']
+    response = post_transfer(client, [{'product_id': 'P1', 'qty': 1} for _ in range(1000)])
+    assert response.status_code == 201
+    ids = [line['movement_id'] for line in client.get('/api/transfers/T').get_json()['movements']]
+    assert ids == [f"T-{number:03d}" for number in range(1, 1001)]
+
+    lines = [{'product_id': 'P2', 'qty': 1, 'movement_id': 'zz'}, {'product_id': 'P3', 'qty': 2, 'movement_id': 'aa'}]
+    assert post_transfer(client, lines, transfer_id='U').status_code == 201
+    assert [line['movement_id'] for line in client.get('/api/transfers/U').get_json()['movements']] == ['zz', 'aa']
+
+
+def test_rejected_line_stores_nothing(client, stock):
+    from models import ProductBalance
+
+    response = post_transfer(client, [{'product_id': 'P1', 'qty': 60}, {'product_id': 'P1', 'qty': 60}])
+    assert response.status_code == 422
+    assert response.get_json()['errors'][0]['row'] == 1
+    assert client.get('/api/transfers/T').status_code == 404
+    assert ProductBalance.get_balance('P1', 'L1') == 100
+
+
+def test_lines_keep_the_transfer_locations(client, stock):
+    assert post_transfer(client, [{'product_id': 'P1', 'qty': 5}]).status_code == 201
+    version = client.get('/api/movements/T-001').get_json()['version']
+
+    response = client.put('/api/movements/T-001', json={'version': version, 'to_location': 'L3'})
+    assert response.status_code == 409
+    response = client.put('/api/movements/T-001', json={'version': version, 'qty': 7})
+    assert response.status_code == 200
+    assert response.get_json()['qty'] == 7
+
+
+def test_deleting_a_line_updates_the_line_count(client, stock):
+    lines = [{'product_id': 'P1', 'qty': 5}, {'product_id': 'P2', 'qty': 5}]
+    assert post_transfer(client, lines).status_code == 201
+    version = client.get('/api/movements/T-002').get_json()['version']
+    assert client.delete(f'/api/movements/T-002?version={version}').status_code == 200
+
+    transfer = client.get('/api/transfers/T').get_json()
+    assert transfer['lines'] == len(transfer['movements']) == 1
@@ -0,0 +1,144 @@
+"""Transfer orders: many product lines moved between two locations as one unit.
+
+A transfer is a `TransferOrder` header plus one movement per line, each
+carrying the header's `transfer_id`. `create_transfer` validates every
+line with the bulk-import checks (`ingest.validate_batch`: ids, products,
+and stock for all lines read with one grouped balance query), then inserts
+the header and all lines, numbered in `line_no` in the order given, with a
+single multi-row INSERT and applies the net balance delta per (product,
+location) in the same transaction. Either every line is stored or none is.
+"""
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from database import db
+from models import Location, TransferOrder, ProductMovement, ArchivedMovement
+from ingest import validate_batch, store_batch
+
+TRANSFER_MAX_LINES = 1000
+
+
+class TransferError(ValueError):
+    """The transfer as a whole is invalid; `errors` lists per-line problems if any"""
+
+    def __init__(self, message, errors=None, status=422, conflicts=None):
+        super().__init__(message)
+        self.errors = errors or []
+        self.conflicts = conflicts or []
+        self.status = status
+
+    def to_dict(self):
+        data = {'error': str(self), 'errors': self.errors}
+        if self.conflicts:
+            data['conflicts'] = self.conflicts
+        return data
+
+
+def line_id(transfer_id, number):
+    """Movement id of the `number`-th line (1-based) of a transfer"""
+    return f"{transfer_id}-{number:03d}"
+
+
+def create_transfer(transfer_id, from_location, to_location, lines, note=None):
+    """Store a transfer order and all of its lines in one transaction.
+
+    `lines` are dicts with `product_id` and `qty`, and optionally a
+    `movement_id` (default `<transfer_id>-001`, `-002`, ...). Raises
+    `TransferError` and leaves nothing behind if the header or any line is
+    rejected, or (status 409) if another writer took the stock meanwhile.
+    Returns the committed `TransferOrder`.
+    """
+    transfer_id = str(transfer_id or '').strip()
+    if not transfer_id:
+        raise TransferError("transfer_id is required")
+    if len(transfer_id) > 45:  # leaves room for the line suffix in movement ids
+        raise TransferError("transfer_id must be at most 45 characters")
+    if not from_location or not to_location:
+        raise TransferError("Both from_location and to_location are required")
+    if from_location == to_location:
+        raise TransferError("from_location and to_location must differ")
+    if not lines:
+        raise TransferError("A transfer needs at least one line")
+    if len(lines) > TRANSFER_MAX_LINES:
+        raise TransferError(f"Too many lines: {len(lines)} (max {TRANSFER_MAX_LINES})", status=413)
+    if db.session.get(TransferOrder, transfer_id) is not None:
+        raise TransferError("Transfer ID already exists", status=409)
+    known = set(db.session.execute(
+        select(Location.location_id).where(Location.location_id.in_((from_location, to_location)))
+    ).scalars())
+    for location_id in (from_location, to_location):
+        if location_id not in known:
+            raise TransferError(f"Unknown location: {location_id}")
+
+    raw_rows = [
+        {
+            'movement_id': line.get('movement_id') or line_id(transfer_id, number),
+            'product_id': line.get('product_id'),
+            'from_location': from_location,
+            'to_location': to_location,
+            'qty': line.get('qty'),
+        }
+        for number, line in enumerate(lines, 1)
+    ]
+    accepted, errors, deltas = validate_batch(raw_rows)
+    if errors:
+        db.session.rollback()
+        raise TransferError(f"{len(errors)} of {len(raw_rows)} lines rejected", errors)
+
+    now = datetime.utcnow()
+    transfer = TransferOrder(transfer_id=transfer_id, from_location=from_location, to_location=to_location,
+                             note=note or None, lines=len(accepted), created_at=now)
+    for number, row in enumerate(accepted, 1):
+        row['timestamp'] = now
+        row['transfer_id'] = transfer_id
+        row['line_no'] = number
+    db.session.add(transfer)
+    try:
+        db.session.flush()  # the header row must exist before lines reference it
+        conflicts = store_batch(accepted, deltas)
+    except IntegrityError:
+        # a concurrent writer stored the same transfer or movement id first
+        db.session.rollback()
+        raise TransferError("Transfer or movement ID already exists", status=409)
+    if conflicts:
+        db.session.rollback()
+        raise TransferError("Stock was taken by another writer; nothing was stored", status=409,
+                            conflicts=conflicts)
+    db.session.commit()
+    return transfer
+
+
+def transfer_lines(transfer_id):
+    """Movements of a transfer, hot or archived, in line order.
+
+    Lines stored before `line_no` existed have none and keep movement id order.
+    """
+    lines = []
+    for source in (ProductMovement, ArchivedMovement):
+        lines += db.session.execute(
+            select(source).where(source.transfer_id == transfer_id)
+        ).scalars().all()
+    return sorted(lines, key=lambda movement: (movement.line_no or 0, movement.movement_id))
+
+
+def recent_transfers(limit=50):
+    return db.session.execute(
+        select(TransferOrder).order_by(TransferOrder.created_at.desc(), TransferOrder.transfer_id.desc())
+        .limit(limit)
+    ).scalars().all()
+
+
+def transfer_to_dict(transfer, lines=None):
+    data = {
+        'transfer_id': transfer.transfer_id,
+        'from_location': transfer.from_location,
+        'to_location': transfer.to_location,
+        'note': transfer.note,
+        'lines': transfer.lines,
+        'created_at': transfer.created_at.isoformat(),
+    }
+    if lines is not None:
+        data['movements'] = [
+            {'movement_id': m.movement_id, 'product_id': m.product_id, 'qty': m.qty} for m in lines
+        ]
+    return data
@@ -1,30 +1,17 @@
 from models import ProductMovement, ProductBalance
 from database import db
 from datetime import datetime
+from rebuild import rebuild_balances
+from pagination import escape_like
 
 
-def recalculate_all_balances():
-    
-    ProductBalance.query.delete()
-    
-    movements = ProductMovement.query.all()
-    
-    for movement in movements:
-        if movement.from_location:
-            ProductBalance.update_balance(
-                movement.product_id, 
-                movement.from_location, 
-                -movement.qty
-            )
-        
-        if movement.to_location:
-            ProductBalance.update_balance(
-                movement.product_id, 
-                movement.to_location, 
-                movement.qty
-            )
-    
-    db.session.commit()
+def recalculate_all_balances(chunk_size=None):
+    """Recompute every balance from the movement history.
+
+    Delegates to the set-based engine in `rebuild.py`; pass `chunk_size` to
+    rebuild in per-product-range transactions on very large histories.
+    """
+    rebuild_balances(chunk_size=chunk_size)
     return True
 
 
@@ -46,65 +33,129 @@ def validate_movement_data(product_id, from_location, to_location, qty):
     return errors
 
 
+SUMMARY_CHUNK = 500
+
+
+def _chunked(ids, size=SUMMARY_CHUNK):
+    ids = list(dict.fromkeys(ids))
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def get_product_summaries(product_ids):
+    """Summaries for many products, keyed by product_id.
+
+    Same output as `get_product_summary` for each id (unknown ids are left
+    out), built from three queries per 500 ids: the products, grouped
+    totals and the joined per-location breakdown.
+    """
+    from sqlalchemy import select, func, case
+    from models import Product, Location
+
+    summaries = {}
+    for chunk in _chunked(product_ids):
+        for product in db.session.execute(select(Product).where(Product.product_id.in_(chunk))).scalars():
+            summaries[product.product_id] = {
+                'product_id': product.product_id,
+                'product_name': product.name,
+                'product_description': product.description,
+                'total_stock': 0,
+                'locations_with_stock': [],
+                'total_locations': 0
+            }
+
+        totals = db.session.execute(
+            select(
+                ProductBalance.product_id,
+                func.sum(ProductBalance.balance),
+                func.count(case((ProductBalance.balance > 0, 1))),
+            )
+            .where(ProductBalance.product_id.in_(chunk))
+            .group_by(ProductBalance.product_id)
+        )
+        for product_id, total_stock, stocked in totals:
+            if product_id in summaries:
+                summaries[product_id]['total_stock'] = int(total_stock or 0)
+                summaries[product_id]['total_locations'] = stocked
+
+        breakdown = db.session.execute(
+            select(ProductBalance.product_id, ProductBalance.location_id, Location.name,
+                   ProductBalance.balance, ProductBalance.last_updated)
+            .join(Location, Location.location_id == ProductBalance.location_id)
+            .where(ProductBalance.product_id.in_(chunk), ProductBalance.balance > 0)
+            .order_by(ProductBalance.id)
+        )
+        for product_id, location_id, location_name, balance, last_updated in breakdown:
+            if product_id in summaries:
+                summaries[product_id]['locations_with_stock'].append({
+                    'location_id': location_id,
+                    'location_name': location_name,
+                    'balance': balance,
+                    'last_updated': last_updated
+                })
+    return summaries
+
+
 def get_product_summary(product_id):
-    from models import Product
-    
-    product = Product.query.get(product_id)
-    if not product:
-        return None
-    
-    balances = ProductBalance.query.filter_by(product_id=product_id).all()
-    
-    total_stock = sum(balance.balance for balance in balances)
-    locations_with_stock = [
-        {
-            'location_id': balance.location_id,
-            'location_name': balance.location.name,
-            'balance': balance.balance,
-            'last_updated': balance.last_updated
-        }
-        for balance in balances if balance.balance > 0
-    ]
-    
-    return {
-        'product_id': product_id,
-        'product_name': product.name,
-        'product_description': product.description,
-        'total_stock': total_stock,
-        'locations_with_stock': locations_with_stock,
-        'total_locations': len(locations_with_stock)
-    }
+    return get_product_summaries([product_id]).get(product_id)
+
+
+def get_location_summaries(location_ids):
+    """Summaries for many locations, keyed by location_id.
+
+    Same output as `get_location_summary` for each id (unknown ids are left
+    out), built from three queries per 500 ids: the locations, grouped
+    totals and the joined per-product breakdown.
+    """
+    from sqlalchemy import select, func
+    from models import Product, Location
+
+    summaries = {}
+    for chunk in _chunked(location_ids):
+        for location in db.session.execute(select(Location).where(Location.location_id.in_(chunk))).scalars():
+            summaries[location.location_id] = {
+                'location_id': location.location_id,
+                'location_name': location.name,
+                'location_description': location.description,
+                'total_items': 0,
+                'products_in_location': [],
+                'total_product_types': 0
+            }
+
+        totals = db.session.execute(
+            select(
+                ProductBalance.location_id,
+                func.sum(ProductBalance.balance),
+                func.count(),
+            )
+            .where(ProductBalance.location_id.in_(chunk), ProductBalance.balance > 0)
+            .group_by(ProductBalance.location_id)
+        )
+        for location_id, total_items, product_types in totals:
+            if location_id in summaries:
+                summaries[location_id]['total_items'] = int(total_items or 0)
+                summaries[location_id]['total_product_types'] = product_types
+
+        breakdown = db.session.execute(
+            select(ProductBalance.location_id, ProductBalance.product_id, Product.name,
+                   ProductBalance.balance, ProductBalance.last_updated)
+            .join(Product, Product.product_id == ProductBalance.product_id)
+            .where(ProductBalance.location_id.in_(chunk), ProductBalance.balance > 0)
+            .order_by(ProductBalance.id)
+        )
+        for location_id, product_id, product_name, balance, last_updated in breakdown:
+            if location_id in summaries:
+                summaries[location_id]['products_in_location'].append({
+                    'product_id': product_id,
+                    'product_name': product_name,
+                    'balance': balance,
+                    'last_updated': last_updated
+                })
+    return summaries
 
 
 def get_location_summary(location_id):
-    from models import Location
-    
-    location = Location.query.get(location_id)
-    if not location:
-        return None
-    
-    balances = ProductBalance.query.filter_by(location_id=location_id).all()
-    
-    products_in_location = [
-        {
-            'product_id': balance.product_id,
-            'product_name': balance.product.name,
-            'balance': balance.balance,
-            'last_updated': balance.last_updated
-        }
-        for balance in balances if balance.balance > 0
-    ]
-    
-    total_items = sum(balance.balance for balance in balances if balance.balance > 0)
-    
-    return {
-        'location_id': location_id,
-        'location_name': location.name,
-        'location_description': location.description,
-        'total_items': total_items,
-        'products_in_location': products_in_location,
-        'total_product_types': len(products_in_location)
-    }
+    return get_location_summaries([location_id]).get(location_id)
 
 
 def generate_movement_id():
@@ -119,4 +170,116 @@ def generate_product_id():
 
 def generate_location_id():
     import uuid
-    return f"LOC-{uuid.uuid4().hex[:8].upper()}"
\ No newline at end of file
+    return f"LOC-{uuid.uuid4().hex[:8].upper()}"
+
+def encode_cursor(timestamp, movement_id):
+    """Opaque keyset cursor for (timestamp, movement_id) ordered listings"""
+    import base64
+    raw = f"{timestamp.isoformat()}|{movement_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of `encode_cursor`; raises ValueError on malformed input"""
+    import base64
+    import binascii
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, movement_id = raw.split('|', 1)
+        return datetime.fromisoformat(timestamp), movement_id
+    except (binascii.Error, UnicodeDecodeError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor}") from exc
+
+
+def parse_timestamp(value):
+    """Parse an ISO-8601 query parameter; None passes through"""
+    if value in (None, ''):
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError as exc:
+        raise ValueError(f"Invalid timestamp: {value}") from exc
+
+
+def movement_list_query(product_id=None, location_id=None, since=None, until=None, after=None,
+                        direction=None, search=None, source=ProductMovement):
+    """Core SELECT of movements with product/location names joined in.
+
+    Rows are ordered newest first on (timestamp, movement_id) so that `after`
+    -- a decoded (timestamp, movement_id) cursor -- continues a listing with
+    a keyset predicate instead of an OFFSET. `direction` ('in' or 'out')
+    restricts a `location_id` filter to one side of the movement; `search`
+    matches a movement id prefix or an exact product or location id.
+    `source` is `ProductMovement` or `ArchivedMovement`; `ledger.movement_page`
+    routes a listing between the two.
+    """
+    from sqlalchemy import select, or_, and_
+    from sqlalchemy.orm import aliased
+    from models import Product, Location
+
+    from_loc = aliased(Location)
+    to_loc = aliased(Location)
+    query = (
+        select(
+            source.movement_id,
+            source.product_id,
+            Product.name.label('product_name'),
+            source.from_location,
+            from_loc.name.label('from_location_name'),
+            source.to_location,
+            to_loc.name.label('to_location_name'),
+            source.qty,
+            source.timestamp,
+            source.version,
+        )
+        .join(Product, Product.product_id == source.product_id)
+        .outerjoin(from_loc, from_loc.location_id == source.from_location)
+        .outerjoin(to_loc, to_loc.location_id == source.to_location)
+        .order_by(source.timestamp.desc(), source.movement_id.desc())
+    )
+
+    if product_id:
+        query = query.where(source.product_id == product_id)
+    if location_id and direction == 'out':
+        query = query.where(source.from_location == location_id)
+    elif location_id and direction == 'in':
+        query = query.where(source.to_location == location_id)
+    elif location_id:
+        query = query.where(or_(
+            source.from_location == location_id,
+            source.to_location == location_id,
+        ))
+    if search:
+        pattern = escape_like(search)
+        query = query.where(or_(
+            source.movement_id.like(f"{pattern}%", escape='\\'),
+            source.product_id == search,
+            source.from_location == search,
+            source.to_location == search,
+        ))
+    if since:
+        query = query.where(source.timestamp >= since)
+    if until:
+        query = query.where(source.timestamp < until)
+    if after:
+        timestamp, movement_id = after
+        query = query.where(or_(
+            source.timestamp < timestamp,
+            and_(source.timestamp == timestamp, source.movement_id < movement_id),
+        ))
+    return query
+
+
+def movement_row_to_dict(row):
+    return {
+        'movement_id': row.movement_id,
+        'product_id': row.product_id,
+        'product_name': row.product_name,
+        'from_location': row.from_location,
+        'from_location_name': row.from_location_name,
+        'to_location': row.to_location,
+        'to_location_name': row.to_location_name,
+        'qty': row.qty,
+        'timestamp': row.timestamp.isoformat(),
+        'version': row.version
+    }